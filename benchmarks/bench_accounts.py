@@ -0,0 +1,134 @@
+# Several Tinder accounts driven at once against the local fake Tinder (benchmarks/fake_server.py):
+# every account fills its own partition through /accounts/<id>/all-matches, enriches it and dispatches openers,
+# first alone and then all together, and checks that no account sees another one's token or rows
+# (tests/test_accounts.py asserts the same isolation under pytest).
+# The app, the eager tasks and the fake server share this one Python process. When the time goes to waiting on
+# Tinder (--latency 0.05) the accounts overlap: 3 accounts x 200 matches took 11.7s together against 10.2s for the
+# slowest alone and 29.5s summed. At --latency 0 the run is pure CPU under one GIL and the accounts add up
+# (6.2s together, 6.0s summed). Separate API and worker processes do not share that limit.
+#
+#   python -m benchmarks.bench_accounts [--accounts 4] [--matches 2000] [--latency 0.05]
+#
+# Needs Redis like bench_e2e (database 15 of the local one by default). Celery tasks run eagerly in this process.
+import argparse
+import contextlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.fake_server import FakeConfig, serve_in_thread
+from benchmarks.bench_e2e import check
+
+
+def drive(client, account_id):
+    # one account's whole flow, returns its seconds
+    prefix = f'/accounts/{account_id}'
+    started = time.perf_counter()
+    check(client.get(prefix + '/all-matches', params={'limit': 1}))
+    check(client.get(prefix + '/all-persons'))
+    check(client.get(prefix + '/dispatch-openers-from-table', params={'include_unenriched': False}))
+    return time.perf_counter() - started
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--accounts', type=int, default=4)
+    parser.add_argument('--matches', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0.05, help='fake Tinder latency per request, seconds')
+    parser.add_argument('--redis', default='redis://localhost:6379/15')
+    args = parser.parse_args(argv)
+
+    config = FakeConfig(matches=args.matches, latency=args.latency, seed=1)
+    base_url, server = serve_in_thread(config)
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if root not in sys.path:
+        sys.path.insert(0, root)
+    workdir = tempfile.mkdtemp(prefix='pytinder-accounts-')
+    os.makedirs(os.path.join(workdir, 'logs'))
+    os.chdir(workdir)
+    account_ids = [f'acct{i}' for i in range(args.accounts)]
+    with open('accounts.json', 'w') as f:
+        json.dump({account_id: {'token': f'token-{account_id}'} for account_id in account_ids}, f)
+    os.environ.update({
+        'TINDER_URL': base_url,
+        'TINDER_TOKEN': 'token-default',
+        'TINDER_RATE': '1000000',
+        'TINDER_BURST': '1000000',
+        'STORAGE_BACKEND': 'sqlite',
+        'DATABASE_PATH': os.path.join(workdir, 'db.sqlite3'),
+        'ACCOUNTS_FILE': os.path.join(workdir, 'accounts.json'),
+        'ACCOUNTS_DIR': os.path.join(workdir, 'accounts'),
+        'REDIS_URL': args.redis,
+        # the benchmark drives the reply cycle itself
+        'SCHEDULER_ENABLED': 'false',
+        'GREETING_MESSAGE': 'Hi <match_name>, how are you?',
+    })
+    from fastapi.testclient import TestClient
+    import main as app_main
+    import worker
+
+    worker.celery.conf.task_always_eager = True
+    logging.getLogger('app_logger').setLevel(logging.WARNING)
+    redis_client = app_main.tinder_limiter.redis
+    for key in redis_client.scan_iter('inflight:*'):
+        redis_client.delete(key)
+
+    def reset():
+        for account_id in account_ids:
+            services = app_main.account_services(account_id)
+            services.matches_table.truncate()
+            services.outbox.table.truncate()
+        for key in redis_client.scan_iter('inflight:*'):
+            redis_client.delete(key)
+
+    # one client per account: with eager tasks an async route runs them on its event loop, and a shared loop
+    # would serialize the accounts in a way a real broker does not
+    with contextlib.ExitStack() as stack:
+        clients = {account_id: stack.enter_context(TestClient(app_main.app)) for account_id in account_ids}
+        alone = {}
+        for account_id in account_ids:
+            reset()
+            alone[account_id] = drive(clients[account_id], account_id)
+        reset()
+        config.requests_by_token.clear()
+        config.sent_by_token.clear()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(len(account_ids)) as executor:
+            together = dict(zip(account_ids, executor.map(lambda account_id: drive(clients[account_id], account_id),
+                                                          account_ids)))
+        wall = time.perf_counter() - started
+        unknown = clients[account_ids[0]].get('/accounts/nobody/matches/totals').status_code
+
+    print(f"{'account':<10} {'alone s':>9} {'together s':>11} {'rows':>7} {'requests':>9} {'openers':>8} {'queue':>14}")
+    problems = []
+    for account_id in account_ids:
+        services = app_main.account_services(account_id)
+        rows = services.matches_table.count()
+        token = services.token
+        print(f"{account_id:<10} {alone[account_id]:>9.2f} {together[account_id]:>11.2f} {rows:>7} "
+              f"{config.requests_by_token[token]:>9} {config.sent_by_token[token]:>8} {services.account.queue:>14}")
+        if rows != args.matches:
+            problems.append(f'{account_id}: {rows} rows, expected {args.matches}')
+        if not config.sent_by_token[token]:
+            problems.append(f'{account_id}: no opener sent with its token')
+    if config.requests_by_token['token-default']:
+        problems.append('the default account was called while only the others were driven')
+    if app_main.matches_table.count():
+        problems.append('rows leaked into the default partition')
+    if unknown != 404:
+        problems.append(f'unknown account answered {unknown}, expected 404')
+    print(f'{len(account_ids)} accounts together: {wall:.2f}s, slowest alone: {max(alone.values()):.2f}s, '
+          f'sum alone: {sum(alone.values()):.2f}s')
+    server.should_exit = True
+    for problem in problems:
+        print('FAIL', problem)
+    return not problems
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main(sys.argv[1:]) else 1)
@@ -0,0 +1,152 @@
+# End-to-end throughput of the app against the local fake Tinder (benchmarks/fake_server.py) and a fake model:
+# /all-matches, /all-persons, /matches/totals, /dispatch-openers-from-table (twice, the second run goes
+# through the outbox only) and one reply_messages cycle, at each scale, reported as p50/p99 latency and requests (and matches) per second.
+#
+#   python -m benchmarks.bench_e2e [--scales 1000,10000,100000] [--latency 0.0] [--llm-latency 0.5] [--json out.json]
+#
+# Needs Redis (the rate limiter and the in-flight set live there), by default database 15 of the local one so
+# the app's own keys are not touched. Celery tasks run eagerly in this process, the database and logs/ go to a
+# temporary directory. The Tinder rate limit is lifted, the numbers are the app's own cost.
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.fake_server import FakeConfig, FakeModel, serve_in_thread
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p * (len(ordered) - 1))))]
+
+
+class Bench:
+    def __init__(self):
+        self.results = []
+
+    def run(self, name, scale, call, runs=1, items=None):
+        # items: matches handled per call, reported as matches/s next to requests/s
+        samples = []
+        started = time.perf_counter()
+        for _ in range(runs):
+            t = time.perf_counter()
+            call()
+            samples.append(time.perf_counter() - t)
+        elapsed = time.perf_counter() - started
+        result = {
+            'scenario': name,
+            'scale': scale,
+            'runs': runs,
+            'p50_ms': percentile(samples, 0.5) * 1000,
+            'p99_ms': percentile(samples, 0.99) * 1000,
+            'rps': runs / elapsed,
+            'items_per_s': items * runs / elapsed if items else None,
+        }
+        self.results.append(result)
+        print(f"{name:<38} {scale:>7} {runs:>5} {result['p50_ms']:>11.1f} {result['p99_ms']:>11.1f} "
+              f"{result['rps']:>9.1f} {result['items_per_s'] or 0:>11.0f}", flush=True)
+        return result
+
+
+def check(response):
+    if response.status_code != 200:
+        raise RuntimeError(f'{response.request.url}: {response.status_code} {response.text[:200]}')
+    return response
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', default='1000,10000,100000')
+    parser.add_argument('--latency', type=float, default=0.0, help='fake Tinder latency per request, seconds')
+    parser.add_argument('--llm-latency', type=float, default=0.5, help='fake model latency per completion, seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--totals-runs', type=int, default=200)
+    parser.add_argument('--reply-runs', type=int, default=3)
+    parser.add_argument('--redis', default='redis://localhost:6379/15')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args(argv)
+
+    config = FakeConfig(error_rate=args.error_rate, throttle_rate=args.throttle_rate, latency=args.latency,
+                        retry_after=0, seed=1)
+    base_url, server = serve_in_thread(config)
+
+    # main reads its configuration at import time
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if root not in sys.path:
+        sys.path.insert(0, root)
+    output = os.path.abspath(args.json) if args.json else None
+    workdir = tempfile.mkdtemp(prefix='pytinder-bench-')
+    os.makedirs(os.path.join(workdir, 'logs'))
+    os.chdir(workdir)
+    os.environ.update({
+        'TINDER_URL': base_url,
+        'TINDER_TOKEN': 'bench',
+        'TINDER_RATE': '1000000',
+        'TINDER_BURST': '1000000',
+        'TINDER_BACKOFF_FACTOR': '0.01',
+        'STORAGE_BACKEND': 'sqlite',
+        'DATABASE_PATH': os.path.join(workdir, 'db.sqlite3'),
+        'REDIS_URL': args.redis,
+        # the benchmark drives the reply cycle itself
+        'SCHEDULER_ENABLED': 'false',
+        'GREETING_MESSAGE': 'Hi <match_name>, how are you?',
+        'LANGUAGE': 'English',
+    })
+    from fastapi.testclient import TestClient
+    import main as app_main
+    import worker
+
+    worker.celery.conf.task_always_eager = True
+    # one line per page and per reply would drown the report
+    logging.getLogger('app_logger').setLevel(logging.WARNING)
+    model = FakeModel(latency=args.llm_latency)
+    # behind the real completion cache, like the OpenAI model
+    app_main.chatgpt.model.model = model
+    redis_client = app_main.tinder_limiter.redis
+    redis_client.ping()
+
+    bench = Bench()
+    print(f"{'scenario':<38} {'scale':>7} {'runs':>5} {'p50 ms':>11} {'p99 ms':>11} {'req/s':>9} {'matches/s':>11}")
+    with TestClient(app_main.app) as client:
+        for scale in (int(s) for s in args.scales.split(',')):
+            config.matches = scale
+            for name in ('matches', 'messages', 'sync', 'completions', 'outbox'):
+                app_main.storage.table(name).truncate()
+            for key in redis_client.scan_iter('inflight:*'):
+                redis_client.delete(key)
+
+            bench.run('/all-matches (new)', scale, lambda: check(client.get('/all-matches', params={'limit': 1})),
+                      items=scale)
+            bench.run('/all-matches (unchanged)', scale, lambda: check(client.get('/all-matches', params={'limit': 1})),
+                      items=scale)
+            bench.run('/all-persons', scale, lambda: check(client.get('/all-persons')), items=scale)
+            bench.run('/matches/totals', scale, lambda: check(client.get('/matches/totals')), runs=args.totals_runs)
+            sent = config.sent
+            bench.run('/dispatch-openers-from-table', scale,
+                      lambda: check(client.get('/dispatch-openers-from-table', params={'include_unenriched': False})))
+            print(f'  {config.sent - sent} openers sent', flush=True)
+            sent = config.sent
+            # everything is in the outbox now, the second run should not reach Tinder
+            bench.run('/dispatch-openers-from-table (again)', scale,
+                      lambda: check(client.get('/dispatch-openers-from-table', params={'include_unenriched': False})))
+            print(f'  {config.sent - sent} openers sent', flush=True)
+            calls = model.calls
+            # on the TestClient's event loop, where the async Tinder client already lives
+            bench.run('reply_messages cycle', scale, lambda: client.portal.call(app_main.reply_messages),
+                      runs=args.reply_runs, items=app_main.reply_pipeline.match_count)
+            print(f'  {model.calls - calls} completions', flush=True)
+
+    print(f'{config.requests} fake Tinder requests')
+    server.should_exit = True
+    if output:
+        with open(output, 'w') as f:
+            json.dump(bench.results, f, indent=2)
+    return bench.results
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,49 @@
+# Cold import cost of the Celery entry point against the web app: wall time and peak RSS of a fresh
+# interpreter importing each module (what every new worker process pays before its first task).
+#
+#   python -m benchmarks.bench_import [runs]
+import os
+import sys
+import json
+import statistics
+import subprocess
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# prints seconds spent importing, peak RSS in KiB and how many modules ended up loaded
+PROBE = """
+import sys, json, time, resource
+started = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - started
+print(json.dumps({{"seconds": elapsed, "rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, "modules": len(sys.modules)}}))
+"""
+
+
+def measure(module, runs, workdir):
+    samples = []
+    env = dict(os.environ, PYTHONPATH=ROOT, DATABASE_PATH=os.path.join(workdir, 'db.sqlite3'))
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', PROBE.format(module=module)], cwd=workdir, env=env,
+                             capture_output=True, text=True, check=True).stdout
+        samples.append(json.loads(out.strip().splitlines()[-1]))
+    return {
+        'seconds': statistics.median(s['seconds'] for s in samples),
+        'rss_kib': statistics.median(s['rss_kib'] for s in samples),
+        'modules': samples[-1]['modules'],
+    }
+
+
+def main(runs=5):
+    # main opens the database and logs/ relative to the working directory, keep them out of the repo
+    workdir = tempfile.mkdtemp(prefix='pytinder-import-')
+    results = {module: measure(module, runs, workdir) for module in ('worker', 'main')}
+    print(f"{'module':<10} {'import ms':>10} {'peak RSS MiB':>13} {'modules':>8}")
+    for module, result in results.items():
+        print(f"{module:<10} {result['seconds'] * 1000:>10.0f} {result['rss_kib'] / 1024:>13.1f} {result['modules']:>8}")
+    return results
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,71 @@
+# Decode cost of the Tinder models: a listing pass over synthetic matches (reads id and name only,
+# like /all-matches) and a pass over messages reading sent_date twice (like the reply cycle).
+#
+#   python -m benchmarks.bench_models [count]
+import sys
+import time
+import tracemalloc
+
+from src.tinder import Match, Message
+
+
+def synthetic_match(i):
+    return {
+        'id': f'match{i:08d}',
+        'last_activity_date': '2024-05-01T12:00:00.000Z',
+        'person': {
+            '_id': f'person{i:08d}',
+            'name': f'Person {i}',
+            'bio': 'Coffee, dogs and long walks. ' * 4,
+            'birth_date': '1995-03-14T00:00:00.000Z',
+            'gender': 1,
+            'distance_mi': i % 60,
+            'city': {'name': 'São Paulo'},
+            'photos': [{'url': f'https://images.example/{i}/{n}.jpg'} for n in range(6)],
+            'jobs': [{'title': {'name': 'Designer'}, 'company': {'name': 'Studio'}}],
+            'schools': [{'name': 'USP'}],
+            'selected_descriptors': [
+                {'name': 'Pets', 'choice_selections': [{'name': 'Dog'}, {'name': 'Cat'}]},
+                {'prompt': 'Zodiac', 'choice_selections': [{'name': 'Leo'}]},
+            ],
+            'relationship_intent': {'body_text': 'Long-term partner'},
+        },
+    }
+
+
+def synthetic_message(i):
+    return {
+        '_id': f'message{i:08d}',
+        'match_id': f'match{i % 100:08d}',
+        'sent_date': '2024-05-01T12:00:00.123Z',
+        'message': 'Hi! How was your weekend?',
+        'to': 'me',
+        'from': f'person{i % 100:08d}',
+    }
+
+
+def measure(label, build):
+    tracemalloc.start()
+    started = time.perf_counter()
+    kept = build()
+    elapsed = time.perf_counter() - started
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{label:<40} {elapsed * 1000:9.1f} ms {current / 1024:10.0f} KiB retained {peak / 1024:10.0f} KiB peak')
+    return kept
+
+
+def main(count=10000):
+    matches = [synthetic_match(i) for i in range(count)]
+    messages = [synthetic_message(i) for i in range(count)]
+
+    # the decoded objects are kept so "retained" is what a page of models costs in memory
+    measure(f'{count} matches, id + name', lambda: [m for m in (Match(data) for data in matches)
+                                                    if (m.match_id, m.person.id, m.person.name)])
+    measure(f'{count} matches, every field', lambda: [m for m in (Match(data) for data in matches) if m.person.infos()])
+    measure(f'{count} messages, sent_date read twice', lambda: [m for m in (Message(data['match_id'], data) for data in messages)
+                                                                if (m.sent_date, m.sent_date)])
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,200 @@
+# Fixed 5-minute reply cycle against the adaptive poller (src/poller.py), in simulated time: Tinder calls
+# spent and how long a message waits for its reply, on live and on quiet chats, over a day of matches where a few
+# chats go live now and then.
+# The pipeline is modelled by its Tinder calls (listing, pulling a moved chat, sending the reply), not run.
+# Fails unless the adaptive poller answers live chats faster at the p95, keeps quiet chats' p95 under the fixed
+# cycle's interval, and spends fewer Tinder calls (polls and sends) in total.
+#
+#   python -m benchmarks.bench_polling [--matches 50] [--hours 24] [--live 10] [--seed 1]
+import sys
+import heapq
+import random
+import asyncio
+import argparse
+import statistics
+from datetime import datetime, timedelta
+
+from src.poller import AdaptivePoller, CallBudget
+from src.ratelimit import RateLimited
+from src.replier import SENT, IDLE
+
+EPOCH = datetime(2024, 1, 1)
+FIXED_INTERVAL = 300
+
+
+def iso(seconds):
+    return (EPOCH + timedelta(seconds=seconds)).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class SimMatch:
+    __slots__ = ('match_id', 'last_activity_date')
+
+    def __init__(self, match_id, last_activity_date):
+        self.match_id = match_id
+        self.last_activity_date = last_activity_date
+
+
+class World:
+    # incoming messages as (time, match_id, live): a live chat gets one every 30s-3min for 10-30 minutes
+    def __init__(self, matches, hours, live, seed):
+        rng = random.Random(seed)
+        self.ids = [f'match{i:04d}' for i in range(matches)]
+        self.clock = Clock()
+        self.calls = 0
+        self.sends = 0
+        self.incoming = []
+        for _ in range(live):
+            match_id = rng.choice(self.ids)
+            t = rng.uniform(0, hours * 3600)
+            end = t + rng.uniform(600, 1800)
+            while t < end:
+                self.incoming.append((t, match_id, True))
+                t += rng.uniform(30, 180)
+        # the occasional message on a quiet chat
+        for match_id in self.ids:
+            self.incoming.extend((rng.uniform(0, hours * 3600), match_id, False) for _ in range(rng.randint(0, 2)))
+        heapq.heapify(self.incoming)
+        self.arrived = {}      # match_id -> [(time, live) of messages not pulled yet]
+        self.unanswered = {}   # match_id -> [(time, live) of pulled messages not answered yet]
+        self.last_activity = {match_id: 0.0 for match_id in self.ids}
+        self.seen = {}         # what the pipeline has pulled: match_id -> last activity
+        self.waits = {True: [], False: []}
+
+    def advance(self, now):
+        while self.incoming and self.incoming[0][0] <= now:
+            t, match_id, live = heapq.heappop(self.incoming)
+            self.arrived.setdefault(match_id, []).append((t, live))
+            self.last_activity[match_id] = t
+        self.clock.now = now
+
+    async def matches(self, count=50, message=0, page_token=None):
+        self.calls += 1
+        listed = sorted(self.ids, key=lambda match_id: -self.last_activity[match_id])[:count]
+        return [SimMatch(match_id, iso(self.last_activity[match_id])) for match_id in listed], None
+
+
+class SimPipeline:
+    # the reply pipeline's cost: a pull per moved (or forced) chat, a send per chat with unanswered messages
+    match_count = 50
+    deadline = 240
+
+    def __init__(self, world):
+        self.world = world
+
+    async def poll(self, api, profile, matches, force=False):
+        world, outcomes = self.world, {}
+        for match in matches:
+            moved = world.seen.get(match.match_id) != match.last_activity_date
+            try:
+                if force or moved:
+                    await api.get_message_data(match.match_id)
+                    world.seen[match.match_id] = match.last_activity_date
+                    world.unanswered.setdefault(match.match_id, []).extend(world.arrived.pop(match.match_id, []))
+                # pulled but not answered yet (a reply the budget refused) needs no new pull
+                pending = world.unanswered.get(match.match_id)
+                if pending:
+                    await api.send_message(match.match_id)
+                    for t, live in world.unanswered.pop(match.match_id):
+                        world.waits[live].append(world.clock.now - t)
+                outcomes[match.match_id] = SENT if pending else IDLE
+            except RateLimited:
+                outcomes[match.match_id] = 'error'
+        return outcomes
+
+    async def run(self, api, profile):
+        matches, _ = await api.matches(count=self.match_count, message=1)
+        return await self.poll(api, profile, matches)
+
+
+class SimAPI:
+    def __init__(self, world):
+        self.world = world
+
+    async def matches(self, count=50, message=0, page_token=None):
+        return await self.world.matches(count, message)
+
+    async def get_message_data(self, match_id, count=50):
+        self.world.calls += 1
+
+    async def send_message(self, match_id, *args):
+        self.world.sends += 1
+
+
+async def simulate(policy, args):
+    world = World(args.matches, args.hours, args.live, args.seed)
+    pipeline, api = SimPipeline(world), SimAPI(world)
+    end = args.hours * 3600
+    if policy == 'fixed 5 min':
+        t = 0.0
+        while t < end:
+            world.advance(t)
+            await pipeline.run(api, None)
+            t += FIXED_INTERVAL
+    else:
+        poller = AdaptivePoller(pipeline, min_interval=args.min_interval, listing_interval=args.listing_interval,
+                                backoff=args.backoff, budget=CallBudget(args.budget, 60), clock=world.clock)
+        t = 0.0
+        while t < end:
+            world.advance(t)
+            await poller.tick(api, None)
+            t += args.tick
+    live, quiet = sorted(world.waits[True]), sorted(world.waits[False])
+    return {
+        'policy': policy,
+        'poll_calls': world.calls,
+        'poll_calls_per_hour': world.calls / args.hours,
+        'sends': world.sends,
+        'total_calls': world.calls + world.sends,
+        'live_median_s': statistics.median(live) if live else 0,
+        'live_p95_s': live[int(0.95 * (len(live) - 1))] if live else 0,
+        'quiet_median_s': statistics.median(quiet) if quiet else 0,
+        'quiet_p95_s': quiet[int(0.95 * (len(quiet) - 1))] if quiet else 0,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--matches', type=int, default=50)
+    parser.add_argument('--hours', type=float, default=24)
+    parser.add_argument('--live', type=int, default=10, help='live conversations over the period')
+    parser.add_argument('--tick', type=float, default=15)
+    parser.add_argument('--min-interval', type=float, default=60)
+    parser.add_argument('--listing-interval', type=float, default=FIXED_INTERVAL)
+    parser.add_argument('--backoff', type=float, default=4)
+    parser.add_argument('--budget', type=int, default=30, help='Tinder calls per minute')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+    # waits: seconds from their message to our reply, on live chats and on quiet ones
+    print(f"{'policy':<12} {'poll calls':>10} {'per hour':>9} {'sends':>6} {'total':>6} {'live p50 s':>11} "
+          f"{'live p95 s':>11} {'quiet p50 s':>12} {'quiet p95 s':>12}")
+    results = []
+    for policy in ('fixed 5 min', 'adaptive'):
+        result = asyncio.run(simulate(policy, args))
+        results.append(result)
+        print(f"{policy:<12} {result['poll_calls']:>10} {result['poll_calls_per_hour']:>9.1f} {result['sends']:>6} "
+              f"{result['total_calls']:>6} {result['live_median_s']:>11.0f} {result['live_p95_s']:>11.0f} "
+              f"{result['quiet_median_s']:>12.0f} {result['quiet_p95_s']:>12.0f}")
+    fixed, adaptive = results
+    problems = []
+    if adaptive['live_p95_s'] >= fixed['live_p95_s']:
+        problems.append(f"live p95 {adaptive['live_p95_s']:.0f}s, fixed {fixed['live_p95_s']:.0f}s")
+    # a few dozen quiet messages: both p95 land anywhere under the interval, the bound is what the listing keeps
+    if adaptive['quiet_p95_s'] > FIXED_INTERVAL:
+        problems.append(f"quiet p95 {adaptive['quiet_p95_s']:.0f}s, over the fixed cycle's {FIXED_INTERVAL:.0f}s")
+    if adaptive['total_calls'] >= fixed['total_calls']:
+        problems.append(f"{adaptive['total_calls']} Tinder calls, fixed {fixed['total_calls']}")
+    for problem in problems:
+        print('FAIL', problem)
+    return not problems
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main(sys.argv[1:]) else 1)
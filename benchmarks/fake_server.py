@@ -0,0 +1,205 @@
+# Local stand-in for the Tinder endpoints TinderAPI/AsyncTinderAPI call, plus a fake ModelInterface,
+# so routes and tasks can be measured without touching Tinder or OpenAI.
+#
+#   python -m benchmarks.fake_server [--matches 10000] [--latency 0.05] [--error-rate 0.01] [--throttle-rate 0.01]
+#
+# then start the app with TINDER_URL=http://127.0.0.1:9000. Matches are generated from their index,
+# nothing is stored, so 100k matches cost no memory; /user/{id} of match i is person i.
+import argparse
+import asyncio
+import collections
+import itertools
+import random
+import socket
+import threading
+import time
+from datetime import datetime
+
+import uvicorn  # type: ignore
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+from benchmarks.bench_models import synthetic_match
+from src.models import ModelInterface
+
+PROFILE_ID = 'me0000000000'
+
+
+class FakeConfig:
+    # mutable while the server runs, the e2e benchmark resizes it between scales
+    def __init__(self, matches=1000, latency=0.0, error_rate=0.0, throttle_rate=0.0, retry_after=1, seed=None):
+        self.matches = matches
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.sent = 0
+        self.unmatched = 0
+        # per X-Auth-Token, to check that several accounts never borrow each other's token
+        self.requests_by_token = collections.Counter()
+        self.sent_by_token = collections.Counter()
+        self.requests_by_method = collections.Counter()
+        # (status, retry_after, deliver) answered to the next requests in order, before the random dice;
+        # with deliver the request is handled first, as when Tinder took it but the answer went wrong
+        self.scripted = collections.deque()
+        # messages we sent, per match; with echo_sent the chat lists them too, newest first
+        self.outgoing = collections.defaultdict(list)
+        self.echo_sent = False
+
+    def fail_next(self, status, times=1, retry_after=None, deliver=False):
+        self.scripted.extend([(status, retry_after, deliver)] * times)
+
+
+def now():
+    return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def create_app(config: FakeConfig):
+    app = FastAPI()
+    counter = itertools.count()
+
+    @app.middleware('http')
+    async def inject(request: Request, call_next):
+        # latency first, then the 429/5xx dice, the same for every endpoint
+        config.requests += 1
+        config.requests_by_token[request.headers.get('X-Auth-Token')] += 1
+        config.requests_by_method[request.method] += 1
+        if config.latency:
+            await asyncio.sleep(config.latency)
+        if config.scripted:
+            status, retry_after, deliver = config.scripted.popleft()
+            if deliver:
+                await call_next(request)
+            headers = {'Retry-After': str(retry_after)} if retry_after is not None else {}
+            return JSONResponse({'status': status}, status_code=status, headers=headers)
+        roll = config.random.random()
+        if roll < config.throttle_rate:
+            return JSONResponse({'status': 429}, status_code=429, headers={'Retry-After': str(config.retry_after)})
+        if roll < config.throttle_rate + config.error_rate:
+            return JSONResponse({'status': 500}, status_code=500)
+        return await call_next(request)
+
+    @app.get('/v2/profile')
+    def profile():
+        return {'data': {
+            'account': {'account_email': 'me@example.com', 'account_phone_number': '0000'},
+            'user': {
+                '_id': PROFILE_ID,
+                'bio': 'Coffee, climbing and bad puns.',
+                'age_filter_min': 18,
+                'age_filter_max': 40,
+                'distance_filter': 50,
+                'gender_filter': 1,
+                'user_interests': {'selected_interests': [{'name': 'Climbing'}, {'name': 'Coffee'}]},
+            },
+        }}
+
+    @app.get('/v2/matches')
+    def matches(count: int = 60, message: int = 0, page_token: str = None):
+        start = int(page_token) if page_token else 0
+        end = min(start + count, config.matches)
+        page = []
+        for i in range(start, end):
+            match = synthetic_match(i)
+            # always fresh so every reply cycle sees activity
+            match['last_activity_date'] = now()
+            page.append(match)
+        data = {'matches': page}
+        if end < config.matches:
+            data['next_page_token'] = str(end)
+        return {'data': data}
+
+    @app.get('/v2/matches/{match_id}/messages')
+    def messages(match_id: str, count: int = 50):
+        person_id = 'person' + match_id[len('match'):]
+        n = next(counter)
+        # newest first, the newest one is theirs and new on every call, so it always needs a reply
+        data = [{
+            '_id': f'{match_id}-{n}-{k}',
+            'match_id': match_id,
+            'sent_date': now(),
+            # unique text too, or the completion cache would answer every chat after the first
+            'message': f'Haha, and what do you do for fun? ({n})' if k % 2 == 0 else 'Mostly climbing, you?',
+            'to': PROFILE_ID if k % 2 == 0 else person_id,
+            'from': person_id if k % 2 == 0 else PROFILE_ID,
+        } for k in range(min(count, 6))]
+        if config.echo_sent:
+            data = (config.outgoing[match_id][::-1] + data)[:count]
+        return {'data': {'messages': data}}
+
+    @app.get('/user/{user_id}')
+    def user(user_id: str):
+        return {'status': 200, 'results': synthetic_match(int(user_id[len('person'):]))['person']}
+
+    @app.post('/user/matches/{match_id}')
+    async def send(match_id: str, request: Request):
+        body = await request.json()
+        config.sent += 1
+        config.sent_by_token[request.headers.get('X-Auth-Token')] += 1
+        message = {'_id': f'sent{next(counter)}', 'match_id': match_id, 'message': body.get('message'),
+                   'sent_date': now(), 'from': body.get('userId'), 'to': body.get('otherId')}
+        config.outgoing[match_id].append(message)
+        return message
+
+    @app.delete('/user/matches/{match_id}')
+    def unmatch(match_id: str):
+        config.unmatched += 1
+        return {'status': 200}
+
+    return app
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def serve_in_thread(config: FakeConfig, port=None):
+    # returns (base_url, server), server.should_exit = True stops it
+    port = port or free_port()
+    server = uvicorn.Server(uvicorn.Config(create_app(config), host='127.0.0.1', port=port, log_level='warning'))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return f'http://127.0.0.1:{port}', server
+
+
+class FakeModel(ModelInterface):
+    # answers after `latency` seconds, the async path sleeps without holding a thread
+    def __init__(self, latency: float = 0.5, reply: str = 'Climbing sounds fun! Coffee this weekend?'):
+        self.model_engine = 'fake'
+        self.latency = latency
+        self.reply = reply
+        self.calls = 0
+
+    def _response(self, messages):
+        self.calls += 1
+        return {'choices': [{'message': {'role': 'assistant', 'content': self.reply}}]}
+
+    def chat_completion(self, messages):
+        time.sleep(self.latency)
+        return self._response(messages)
+
+    async def achat_completion(self, messages):
+        await asyncio.sleep(self.latency)
+        return self._response(messages)
+
+    def image_generation(self, prompt):
+        time.sleep(self.latency)
+        return 'https://images.example/fake.png'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--matches', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=float, default=1)
+    args = parser.parse_args()
+    config = FakeConfig(args.matches, args.latency, args.error_rate, args.throttle_rate, args.retry_after)
+    uvicorn.run(create_app(config), host='127.0.0.1', port=args.port)
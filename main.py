@@ -1,98 +1,159 @@
 # import time
 import random
-from fastapi import FastAPI
+from fastapi import FastAPI, APIRouter, HTTPException, Query
+from fastapi.responses import StreamingResponse, Response
 from celery.result import AsyncResult # type: ignore
 import os
 from dotenv import load_dotenv # type: ignore
 import requests
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
 import asyncio
+import threading
 from apscheduler.schedulers.asyncio import AsyncIOScheduler # type: ignore
 import uvicorn # type: ignore
-from tinydb import TinyDB, Query # type: ignore
-from celery import Celery # type: ignore
-from src.logger import logger
+from src.logger import logger, get_audit_logger
 from src.chatgpt import ChatGPT, DALLE
-from src.models import OpenAIModel
-from src.tinder import TinderAPI
+from src.models import OpenAIModel, CachedModel
+from src.tinder import get_tinder_api, get_async_tinder_api, close_async_tinder_apis, request_not_sent
+from src.outbox import SENT
 from src.dialog import Dialog
+from src.cache import ProfileCache, CompletionCache
+from src.replier import ReplyPipeline
+from src.exporter import TrainingExporter
+from src.sync import ConversationSync
+from src.poller import AdaptivePoller
+from src.ratelimit import CallBudget
+from src.leader import LeaderLock
+from src import metrics
+from src.accounts import DEFAULT_ACCOUNT, UnknownAccount
+import worker
+from worker import dispatch, send_tinder_opener, reconcile_openers, enrich_persons, unmatch_tinder_person, person_fields
 
 os.environ['TZ'] = 'Brazil/East'
 
 load_dotenv()
 
-models = OpenAIModel(api_key=os.getenv('OPENAI_API'), model_engine=os.getenv('OPENAI_MODEL_ENGINE'))
+models = OpenAIModel(api_key=os.getenv('OPENAI_API'), model_engine=os.getenv('OPENAI_MODEL_ENGINE'),
+                     timeout=float(os.getenv('OPENAI_TIMEOUT', 30)),
+                     max_retries=int(os.getenv('OPENAI_MAX_RETRIES', 3)),
+                     concurrency=int(os.getenv('OPENAI_CONCURRENCY', 5)),
+                     base_url=os.getenv('OPENAI_BASE_URL') or None)
 
-chatgpt = ChatGPT(models)
 dalle = DALLE(models)
-dialog = Dialog()
+dialog = Dialog(max_tokens=int(os.getenv('DIALOG_MAX_TOKENS', 1500)))
 
 app = FastAPI()
 scheduler = AsyncIOScheduler()
 
-db = TinyDB('database/db.json')
-matches_table = db.table('matches')
-profile_table = db.table('profile')
+# the completion cache lives in the default account's storage and is shared by every account
+storage = worker.get_storage()
+
+# identical conversations are answered from the cache instead of paying for the same completion again
+completion_cache = CompletionCache(
+    storage.table('completions'),
+    ttl=float(os.getenv('LLM_CACHE_TTL', 86400)),
+    max_entries=int(os.getenv('LLM_CACHE_SIZE', 1000)),
+)
+chatgpt = ChatGPT(CachedModel(models, completion_cache))
+
+# audit trail of every opener and message sent, written by the logging thread
+openers_log = get_audit_logger('openers')
+messages_log = get_audit_logger('messages')
 
-TINDER_TOKEN = os.getenv('TINDER_TOKEN')
 GREETING_MESSAGE = os.getenv("GREETING_MESSAGE")
+DISTANCE_BUCKETS = os.getenv("DISTANCE_BUCKETS", "5,10,15,25,50,100")
+ENRICH_CHUNK_SIZE = int(os.getenv('ENRICH_CHUNK_SIZE', 25))
+
+
+class AccountServices:
+    # Everything the API keeps per Tinder account, over that account's own storage partition,
+    # rate limiter and in-flight keys (see src/accounts.py), so accounts never wait on each other's locks
+    def __init__(self, account):
+        self.account = account
+        self.account_id = account.account_id
+        self.token = account.token
+        self.storage = worker.get_storage(self.account_id)
+        self.matches_table = self.storage.table('matches')
+        self.profile_cache = ProfileCache(self.storage.table('profile'), ttl=float(os.getenv('PROFILE_TTL', 86400)))
+        self.reply_pipeline = ReplyPipeline(
+            chatgpt,
+            dialog,
+            sync=ConversationSync(self.storage.table('sync'), self.storage.table('messages')),
+            language=os.getenv('LANGUAGE'),
+            fetch_concurrency=int(os.getenv('REPLY_FETCH_CONCURRENCY', 5)),
+            llm_concurrency=int(os.getenv('REPLY_LLM_CONCURRENCY', 3)),
+            deadline=float(os.getenv('REPLY_DEADLINE', 240)),
+        )
+        self.training_exporter = TrainingExporter(
+            dialog,
+            self.storage.table('exports'),
+            min_messages=int(os.getenv('EXPORT_MIN_MESSAGES', 20)),
+            concurrency=int(os.getenv('EXPORT_CONCURRENCY', 5)),
+        )
+        # the Celery app and tasks live in worker.py, the API shares its Redis clients
+        self.tinder_limiter = worker.get_rate_limiter(self.account_id)
+        self.enrich_inflight = worker.get_enrich_inflight(self.account_id)
+        self.outbox = worker.get_outbox(self.account_id)
+        self.person_cache = worker.get_person_cache(self.account_id)
+        self.poller = AdaptivePoller(
+            self.reply_pipeline,
+            min_interval=float(os.getenv('POLL_MIN_INTERVAL', 60)),
+            backoff=float(os.getenv('POLL_BACKOFF', 4)),
+            listing_interval=float(os.getenv('POLL_LISTING_INTERVAL', 300)),
+            budget=CallBudget(int(os.getenv('POLL_BUDGET', 30)), float(os.getenv('POLL_BUDGET_INTERVAL', 60))),
+        )
 
-# Configure Celery
-celery = Celery(
-    __name__,
-    broker="redis://localhost:6379/0",
-    backend="redis://localhost:6379/0"
-)
+    # routes and the poller take their tokens from the account's limiter like its Celery tasks do
+    def tinder_api(self):
+        return get_tinder_api(self.token, rate_limiter=self.tinder_limiter)
 
-@celery.task(name='main.send_tinder_opener')
-def send_tinder_opener(match_id, from_id, to_id, message):
-    with open("logs/openers.txt", "a") as file:
-        file.write(f'\n {message}')
-    tinder_api = TinderAPI(TINDER_TOKEN)
-    message = tinder_api.send_message(match_id, from_id, to_id, message)
-    with open("logs/openers.txt", "a") as file:
-        file.write("\n" + json.dumps(message))
-    if message.get("_id"):  # Check if "_id" exists and is not empty
-        return message
-    else:
-        raise ValueError("Failed to send message to user")
-    
-@celery.task(name='main.get_tinder_person')
-def get_tinder_person(match_id, person_id):
-    tinder_api = TinderAPI(TINDER_TOKEN)
-    person = tinder_api.get_user_info(person_id)
-    if hasattr(person, "id") and person.id:  # Check if "id" exists and is not empty
-        birth_date = person.birth_date.strftime('%Y-%m-%d') if isinstance(person.birth_date, datetime) else person.birth_date
-        # add only missing fields not present in match
-        objPerson = {
-            'distance' : person.distance, 
-            'birth_date': person.birth_date.strftime('%Y-%m-%dT%H:%M:%S.%fZ') if person.birth_date else None,
-            'bio': person.bio
-        }
-        MatchQuery = Query()
-        matches_table.update(objPerson, MatchQuery.match_id == match_id)
-        return matches_table.get(MatchQuery.match_id == match_id)
-    else:
-        raise ValueError("Failed to get profile")
-    
-@celery.task(name='main.unmatch_tinder_person')
-def unmatch_tinder_person(match_id):
-    tinder_api = TinderAPI(TINDER_TOKEN)
-    response = tinder_api.unmatch(match_id)
-    if response.status_code == 200:
-        matches_table.remove(match_id == match_id)
-        return "ok"
-    raise ValueError("Failed to unmatch")
+    def async_tinder_api(self):
+        return get_async_tinder_api(self.token, rate_limiter=self.tinder_limiter)
+
+
+_services = {}
+_services_lock = threading.Lock()
+
+
+def account_services(account_id=DEFAULT_ACCOUNT):
+    services = _services.get(account_id)
+    if services is None:
+        with _services_lock:
+            services = _services.get(account_id)
+            if services is None:
+                try:
+                    account = worker.get_account(account_id)
+                except UnknownAccount:
+                    raise HTTPException(status_code=404, detail=f'Unknown account: {account_id}')
+                services = _services[account_id] = AccountServices(account)
+    return services
+
+
+# the default account, under the names the routes used before there were several
+default_services = account_services()
+matches_table = default_services.matches_table
+profile_cache = default_services.profile_cache
+reply_pipeline = default_services.reply_pipeline
+training_exporter = default_services.training_exporter
+tinder_limiter = default_services.tinder_limiter
+enrich_inflight = default_services.enrich_inflight
+outbox = default_services.outbox
+person_cache = default_services.person_cache
+
+# routes of one account: served as before for the default account and under /accounts/{account_id} for any account
+router = APIRouter()
 
 @app.get('/')
 def hello_world():
     # logger.info(f'/ visited!')
     return 'This is a Tinder automation app!'
 
-@app.get('/matches')
-def get_matches():
-    tinder_api = TinderAPI(TINDER_TOKEN)
+@router.get('/matches')
+def get_matches(account_id: str = DEFAULT_ACCOUNT):
+    services = account_services(account_id)
+    matches_table = services.matches_table
+    tinder_api = services.tinder_api()
     message=0
     matches = tinder_api.matches(count=100, message=message)
     for match in matches:
@@ -101,15 +162,14 @@ def get_matches():
         # with open("logs/matches.txt", "a") as file:
             # file.write(f'\n match_id: {match.match_id}, id: {match.person.id}, name: {match.person.name}, message: {message}')
         # save all matches
-        MatchQuery = Query()
         # Check if a record with the same match_id exists
-        # if matches_table.contains(MatchQuery.match_id == match.match_id):
+        # if matches_table.contains(match.match_id):
         #     # Update the existing record
         #     matches_table.update({'match_id': match.match_id, 'person_id' : match.person.id, 'name' : match.person.name})
         # else:
         #     # Insert as a new record
         #     matches_table.insert({'match_id': match.match_id, 'person_id' : match.person.id, 'name' : match.person.name})
-        if not matches_table.contains(MatchQuery.match_id == match.match_id):
+        if not matches_table.contains(match.match_id):
             # Insert as a new record
             matches_table.insert({'match_id': match.match_id, 'person_id' : match.person.id, 'name' : match.person.name})
                  
@@ -121,13 +181,38 @@ def get_matches():
     #     data = json.load(file)
     return 'ok'
 
+# rows of matches_table in match_id order, see /matches/show for the parameters
+def list_matches(matches_table, limit, after, fields, format):
+    fields = [field.strip() for field in fields.split(',') if field.strip()] if fields else None
+
+    def project(row):
+        return {field: row.get(field) for field in fields} if fields else row
+
+    if format == 'ndjson':
+        # one JSON object per line, rows are read lazily from storage while the response is sent
+        def stream():
+            for row in matches_table.iter(after=after, limit=limit):
+                yield json.dumps(project(row), ensure_ascii=False) + '\n'
+        return StreamingResponse(stream(), media_type='application/x-ndjson')
+
+    limit = min(limit or 100, 1000)
+    rows = list(matches_table.iter(after=after, limit=limit))
+    return {
+        "matches": [project(row) for row in rows],
+        # pass it back as ?after= to get the next page
+        "next_after": rows[-1]['match_id'] if len(rows) == limit else None
+    }
+
 # save all matches in matches_table
-@app.get('/all-matches')
-def get_all_matches():
-    tinder_api = TinderAPI(TINDER_TOKEN)
+@router.get('/all-matches')
+def get_all_matches(limit: int = Query(None, ge=1, le=1000), after: str = None, fields: str = None,
+                    format: str = 'json', account_id: str = DEFAULT_ACCOUNT):
+    services = account_services(account_id)
+    matches_table = services.matches_table
+    tinder_api = services.tinder_api()
     message = 1 # 1 for one or more messages, 0 for matches with no messages between them
-    all_matches = []
     page_token = None
+    page = 0
 
     while True:
         # Fetch matches with pagination
@@ -135,79 +220,120 @@ def get_all_matches():
         if not matches:
             break  # Stop if no more matches
 
-        # Process each match
-        for match in matches:
-            MatchQuery = Query()
-            if not matches_table.contains(MatchQuery.match_id == match.match_id):
-                # Insert as a new record
-                matches_table.insert({
-                    'match_id': match.match_id,
-                    'person_id': match.person.id,
-                    'name': match.person.name
-                })
-        
-        # add the new batch of matches to the all_matches list
-        all_matches.extend(matches)
+        # Upsert the whole page in one write, fields filled in later (distance, bio...) are kept
+        counts = matches_table.bulk_upsert({
+            'match_id': match.match_id,
+            'person_id': match.person.id,
+            'name': match.person.name
+        } for match in matches)
+        page += 1
+        logger.info(f'/all-matches page {page}: {counts}')
 
         # If no page_token is returned, it means there are no more pages
         if not page_token:
             break
 
-    return matches_table.all()
+    return list_matches(matches_table, limit, after, fields, format)
+
+# matches whose distance is in [min_km, max_km) and, when given, whose age (from birth_date) is in [min_age, max_age];
+# only the rows inside the range are read, through the distance and birth_date indexes
+def select_matches(matches_table, min_km=None, max_km=None, min_age=None, max_age=None, include_unenriched=False):
+    today = datetime.utcnow().date()
+
+    def years_ago(years):
+        # 29 February falls back to the 28th in non-leap years
+        return today.replace(year=today.year - years, day=min(today.day, 28) if today.month == 2 else today.day)
+
+    born_after = born_before = None
+    if max_age is not None:
+        born_after = (years_ago(max_age + 1) + timedelta(days=1)).isoformat()
+    if min_age is not None:
+        born_before = (years_ago(min_age) + timedelta(days=1)).isoformat()
+
+    if min_km is None and max_km is None and (born_after or born_before):
+        rows = matches_table.range('birth_date', born_after, born_before)
+    else:
+        rows = matches_table.range('distance', min_km, max_km)
+        if born_after or born_before:
+            rows = (row for row in rows if row.get('birth_date') and
+                    (born_after is None or row['birth_date'] >= born_after) and
+                    (born_before is None or row['birth_date'] < born_before))
+    yield from rows
+    if include_unenriched:
+        # no distance yet, the age filter cannot apply to them either
+        yield from matches_table.missing('distance')
 
 # first run '/all-matches' route to fill your table
 # it will only append the task if match does not already have distance att
 # make sure celery and flow are running, see: ## Running the app, flower and celery queues in README.md
-@app.get('/all-persons')
-def get_all_persons():
+# tasks are paced by the shared rate limiter, pass ?jitter=true to also spread them with random delays
+# and ?stale=true to also refresh the persons fetched more than PERSON_MAX_AGE ago
+@router.get('/all-persons')
+def get_all_persons(jitter: bool = False, stale: bool = False, account_id: str = DEFAULT_ACCOUNT):
+    services = account_services(account_id)
     cumulative_delay = 0
     task_info = []
     # limit table rows
     # limit = 5
     # matches = matches_table.all()[:limit]
-    matches = matches_table.all()
-    for row in matches:
-        if 'distance' not in row:
-            delay = random.randint(5, 10)
-            cumulative_delay += delay
-            task = get_tinder_person.apply_async((row.get('match_id'),row.get('person_id'),),countdown=cumulative_delay)  # 15-20-second cumulative delay before starting
-            task_info.append({"status": "Task started", "task_id": task.id, "delay": delay})
+    matches = services.matches_table.all()
+    pairs = {row.get('match_id'): row.get('person_id') for row in matches
+             if 'distance' not in row or (stale and not services.person_cache.is_fresh(row))}
+    # skip the matches another call already queued
+    claimed = services.enrich_inflight.claim(list(pairs))
+    for start in range(0, len(claimed), ENRICH_CHUNK_SIZE):
+        chunk = [(match_id, pairs[match_id]) for match_id in claimed[start:start + ENRICH_CHUNK_SIZE]]
+        delay = random.randint(5, 10) if jitter else 0
+        cumulative_delay += delay
+        task = dispatch(enrich_persons, (chunk,), account_id, countdown=cumulative_delay)
+        task_info.append({"status": "Task started", "task_id": task.id, "delay": delay, "matches": len(chunk)})
     return task_info
 
-@app.get('/matches/show')
-def show_matches():
-    return matches_table.all()
-
-@app.get('/matches/totals')
-def show_matches_totals():
-    MatchQuery = Query()
-    total_matches = len(matches_table)
-    under_15 = len(matches_table.search(MatchQuery.distance < 15))
-    over_15 = len(matches_table.search(MatchQuery.distance >= 15))
+# ?limit=100&after=<match_id> pages through the table, ?fields=match_id,name keeps only those fields
+# and ?format=ndjson streams every row (or `limit` rows) as newline-delimited JSON
+@router.get('/matches/show')
+def show_matches(limit: int = Query(None, ge=1, le=1000), after: str = None, fields: str = None,
+                 format: str = 'json', account_id: str = DEFAULT_ACCOUNT):
+    return list_matches(account_services(account_id).matches_table, limit, after, fields, format)
+
+# answered from the per-km counts storage keeps up to date, no table scan:
+# ?threshold=20 moves the under/over split, ?buckets=5,10,25 overrides DISTANCE_BUCKETS
+@router.get('/matches/totals')
+def show_matches_totals(threshold: int = 15, buckets: str = None, account_id: str = DEFAULT_ACCOUNT):
+    per_km = account_services(account_id).matches_table.histogram('distance')
+    unenriched = per_km.pop(None, 0)
+    enriched = sum(per_km.values())
+    under = sum(count for km, count in per_km.items() if km < threshold)
+
+    edges = sorted(int(edge) for edge in (buckets or DISTANCE_BUCKETS).split(',') if edge.strip())
+    histogram = []
+    for lo, hi in zip([0] + edges, edges + [None]):
+        histogram.append({
+            "min_km": lo,
+            "max_km": hi,
+            "count": sum(count for km, count in per_km.items() if km >= lo and (hi is None or km < hi))
+        })
     return {
-        "total_matches": total_matches,
-        "under_15": under_15,
-        "over_15": over_15
+        "total_matches": enriched + unenriched,
+        "enriched": enriched,
+        "unenriched": unenriched,
+        f"under_{threshold}": under,
+        f"over_{threshold}": enriched - under,
+        "histogram": histogram
     }
 
-@app.get('/match/{match_id}')
-def get_match(match_id):
-    match_query = Query()
-    row = matches_table.get(match_query.match_id == match_id)
-    if row:
-            person_id = row['person_id']
-            tinder_api = TinderAPI(TINDER_TOKEN)
-            person = tinder_api.get_user_info(person_id)
-            obj_person = {
-                'distance': person.distance,
-                'birth_date': person.birth_date.strftime('%Y-%m-%dT%H:%M:%S.%fZ') if person.birth_date else None,
-                'bio': person.bio
-            }
-            
-            # Update existing row
-            matches_table.update(obj_person, match_query.match_id == match_id)
-            return matches_table.get(match_query.match_id == match_id)
+# served from the table while the person is younger than PERSON_MAX_AGE, a stale one is served while a
+# background task refreshes it; ?refresh=true fetches it from Tinder now
+@router.get('/match/{match_id}')
+def get_match(match_id, refresh: bool = False, account_id: str = DEFAULT_ACCOUNT):
+    services = account_services(account_id)
+
+    def fetch(person_id):
+        return person_fields(services.tinder_api().get_user_info(person_id))
 
+    row = services.person_cache.get(match_id, fetch, refresh=refresh)
+    if row:
+        return row
     else:
         return {"error": "Match no found"}
 
@@ -230,195 +356,236 @@ def get_match(match_id):
     # else:
     #     return {"error": "Failed to fetch data"}, response.status_code
 
-@app.get('/unmatch/{match_id}')
-async def unmatch(match_id):
-    tinder_api = TinderAPI(TINDER_TOKEN)
-    response = tinder_api.unmatch(match_id)
-    if response.status_code == 200:
-        matches_table.remove(match_id == match_id)
+@router.get('/unmatch/{match_id}')
+async def unmatch(match_id, account_id: str = DEFAULT_ACCOUNT):
+    services = account_services(account_id)
+    response = await services.async_tinder_api().unmatch(match_id)
+    if response.get("status") == 200:
+        await asyncio.to_thread(services.matches_table.remove, match_id)
         return "ok"
     raise ValueError("Failed to unmatch")
 
-@app.get('/unmatch-all-persons-distant')
-def unmatch_all_distant():
-    tinder_api = TinderAPI(TINDER_TOKEN)
+# unmatch everyone at min_km or further (and under max_km / within min_age-max_age when given),
+# matches without a distance are never touched
+@router.get('/unmatch-all-persons-distant')
+def unmatch_all_distant(min_km: float = 15, max_km: float = None, min_age: int = None, max_age: int = None,
+                        jitter: bool = False, account_id: str = DEFAULT_ACCOUNT):
+    matches_table = account_services(account_id).matches_table
     cumulative_delay = 0
     task_info = []
-    # limit table rows
-    # limit = 5
-    # matches = matches_table.all()[:limit]
-    matches = matches_table.all()
-    for row in matches:
+    for row in select_matches(matches_table, min_km, max_km, min_age, max_age):
         match_id = row.get("match_id")
         if not match_id:
             continue  # Skip rows with no match_id
-        # Skip persons distant more than 15 km
-        if row.get("distance") < 15:
-            continue
-        # Schedule task with a cumulative delay
-        delay = random.randint(10, 20)
+        # Schedule task, with a cumulative delay on top of the rate limiter when jitter is on
+        delay = random.randint(10, 20) if jitter else 0
         cumulative_delay += delay
         # unmatch distant persons
-        task = unmatch_tinder_person.apply_async((match_id,), countdown=cumulative_delay)
+        task = dispatch(unmatch_tinder_person, (match_id,), account_id, countdown=cumulative_delay)
         task_info.append({"status": "Task started", "task_id": task.id, "delay": delay})
     return task_info
 
-@app.get('/profile')
-def get_profile():
-    # Check if the profile table is empty
-    if len(profile_table.all()) > 0:
-        # If the profile table is not empty, fetch and return the first profile entry
-        profile_data = profile_table.all()[0]  # there's only one profile entry
-        return profile_data
-    
-    # If the profile table is empty, fetch profile from the Tinder API
-    tinder_api = TinderAPI(TINDER_TOKEN)
-    profile = tinder_api.profile()
-
-    # Save the profile information to the table
-    profile_data = {
-        'id': profile.id,
-        # '_api': profile._api,
-        'bio': profile.bio,
-    }
-    profile_table.insert(profile_data)
+# pass ?refresh=true to drop the cached profile and fetch it again from Tinder
+@router.get('/profile')
+def get_profile(refresh: bool = False, account_id: str = DEFAULT_ACCOUNT):
+    # Serve the persisted id/bio/interests snapshot while it is fresh, otherwise fetch it from the Tinder API
+    services = account_services(account_id)
+    return services.profile_cache.get_snapshot(services.tinder_api(), refresh=refresh)
 
-    # Return the profile information as a dictionary (which will be automatically converted to JSON)
-    return profile_data
-
-@app.get('/send-opener/{match_id}')
-async def send_opener(match_id):
-    tinder_api = TinderAPI(TINDER_TOKEN)
-    profile = tinder_api.profile()
+@router.get('/send-opener/{match_id}')
+async def send_opener(match_id, account_id: str = DEFAULT_ACCOUNT):
+    services = account_services(account_id)
+    tinder_api = services.async_tinder_api()
+    profile = await services.profile_cache.aget(tinder_api)
 
     # Fetch person details from matches_table using match_id
-    MatchQuery = Query()
-    match = matches_table.get(MatchQuery.match_id == match_id)
+    match = await asyncio.to_thread(services.matches_table.get, match_id)
 
     if not match:
         return {"error": "Match not found"}
 
-    # write your opener message below
-    # message = f'Hi {to_name}, how are you doing?'
-    first_name = match["name"].strip().split()[0] if match["name"].strip() else ''
-    message = GREETING_MESSAGE.replace("<match_name>", first_name)
-    with open("logs/messages.txt", "a") as file:
-        file.write(f'\n {message}')
-    tinder_api = TinderAPI(TINDER_TOKEN)
-    message = tinder_api.send_message(match_id, profile.id, match["person_id"], message)
-    with open("logs/messages.txt", "a") as file:
-        file.write("\n" + json.dumps(message))
-    return message if message.get("_id") else {"error": "Failed to send message to user"}
+    # the same greeting as the dispatched openers, so both share one outbox key per match
+    message = opener(match_id, match["person_id"], match["name"])["message"]
+    # through the outbox like the dispatched openers, the same opener is never sent twice
+    outbox = services.outbox
+    key = outbox.key(match_id, message)
+    # the outbox is a SQLite transaction that may wait on a lock, kept off the event loop like every storage call
+    if not await asyncio.to_thread(outbox.start, key, match_id=match_id, person_id=match["person_id"], message=message):
+        state = (await asyncio.to_thread(outbox.get, key) or {}).get("state")
+        return {"error": "Opener already sent or being sent", "state": state}
+    messages_log.info(f' {message}')
+    try:
+        response = await tinder_api.post_message(match_id, profile.id, match["person_id"], message)
+    except Exception as e:
+        # failed when no connection was made, otherwise it may have gone out and waits for /reconcile-openers
+        await asyncio.to_thread(outbox.failed if request_not_sent(e) else outbox.unknown, key, repr(e))
+        raise
+    try:
+        message = response.json()
+    except ValueError:
+        message = None
+    messages_log.info(json.dumps(message))
+    state = await asyncio.to_thread(outbox.settle, key, response.status_code, message)
+    if state == SENT:
+        return message
+    return {"error": "Failed to send message to user", "status": response.status_code, "state": state}
 
     # delay = random.randint(5, 10)
     # task = send_tinder_opener.apply_async((match_id, profile.id, person.id, message),countdown=delay)  # 5-10-second delay before starting
     # return {"status": "Task started", "task_id": task.id, "delay": delay}
 
-@app.get('/dispatch-openers')
-async def dispatch_openers():
-    tinder_api = TinderAPI(TINDER_TOKEN)
-    profile = tinder_api.profile()
-    message=0
-    matches = tinder_api.matches(count=30, message=message)
-    task_info = []
-    cumulative_delay = 0
-    for match in matches:
-        first_name = match.person.name.strip().split()[0] if match.person.name.strip() else ''
-        message = GREETING_MESSAGE.replace("<match_name>", first_name)
-        with open("logs/openers.txt", "a") as file:
-            file.write(f'\n match_id: {match.match_id}, id: {match.person.id}, name: {match.person.name}, first_name: {first_name}, message: {message}')
-        delay = random.randint(5, 10)
-        cumulative_delay += delay
-        task = send_tinder_opener.apply_async((match.match_id, profile.id, match.person.id, message),countdown=cumulative_delay)  # 15-60-second cumulative delay before starting
-        task_info.append({"status": "Task started", "task_id": task.id, "delay": delay})
-    return task_info
-
-@app.get('/dispatch-openers-from-table')
-async def dispatch_openers_from_table():
-    tinder_api = TinderAPI(TINDER_TOKEN)
-    profile = tinder_api.profile()
+# the greeting for one match, GREETING_MESSAGE with <match_name> replaced by their first name
+def opener(match_id, person_id, name):
+    first_name = name.strip().split()[0] if name.strip() else ''
+    return {"match_id": match_id, "person_id": person_id, "name": name,
+            "message": GREETING_MESSAGE.replace("<match_name>", first_name)}
+
+def dispatch_opener(services, profile, item, countdown):
+    try:
+        return dispatch(send_tinder_opener, (item["match_id"], profile.id, item["person_id"], item["message"]),
+                        services.account_id, countdown=countdown, key=item["key"])
+    except Exception as e:
+        # never reached the broker, a later dispatch may queue it again
+        services.outbox.failed(item["key"], repr(e))
+        raise
+
+# one broker call per queued opener, with a 5-10-second cumulative delay each when jitter is on (reported as the
+# countdown the task waits); once the broker fails, the openers not dispatched yet are failed too so none stays
+# queued without a task behind it
+def dispatch_queued(services, profile, queued, jitter):
     task_info = []
     cumulative_delay = 0
-    counter = 0
-    matches = matches_table.all()  # Get all matches from the TinyDB table
-    for match in matches:
-        if match.get("distance", 0) > 15:  # Skip matches with a distance over 15
-            continue
-        first_name = match["name"].strip().split()[0] if match["name"].strip() else ''
-        message = GREETING_MESSAGE.replace("<match_name>", first_name)
-        with open("logs/openers.txt", "a") as file:
-            file.write(
-                f'\n match_id: {match["match_id"]}, id: {match["person_id"]}, name: {match["name"]}, '
-                f'first_name: {first_name}, message: {message}'
-            )
-        delay = random.randint(5, 10)
-        cumulative_delay += delay
-        counter += 1
-        task = send_tinder_opener.apply_async(
-            (match["match_id"], profile.id, match["person_id"], message),
-            countdown=cumulative_delay
+    for i, item in enumerate(queued):
+        openers_log.info(
+            f' match_id: {item["match_id"]}, id: {item["person_id"]}, name: {item["name"]}, '
+            f'message: {item["message"]}'
         )
+        delay = random.randint(5, 10) if jitter else 0
+        cumulative_delay += delay
+        try:
+            task = dispatch_opener(services, profile, item, cumulative_delay)
+        except Exception as e:
+            for rest in queued[i + 1:]:
+                services.outbox.failed(rest["key"], f'not dispatched: {e!r}')
+            raise
         task_info.append({"status": "Task started", "task_id": task.id, "delay": cumulative_delay})
-    
     return task_info
 
-@app.get('/export-messages')
-def export_valuable_messages():
-    tinder_api = TinderAPI(TINDER_TOKEN)
-    profile = tinder_api.profile()
-    user_id = profile.id
-    for match in tinder_api.matches(limit=100):
-        chatroom = tinder_api.get_messages(match.match_id)
-        count = len(chatroom.messages)
-        dialog.export_message_json(user_id, chatroom.messages[::-1]) if count > 20 else None
-    combine_json_files(user_id)
-
-def combine_json_files(user_id):
-    file_path = f'logs/chat_data/{user_id}'
-    json_files = [file for file in os.listdir(file_path) if file.endswith('.json')]
-    combined_data = []
-    for file in json_files:
-        with open(f'logs/chat_data/{user_id}/{file}', 'r') as f:
-            data = json.load(f)
-            combined_data.append(data)
-    with open(f'logs/chat_data/{user_id}/combined.jsonl', 'w', encoding="utf-8") as f:
-        for item in combined_data:
-            json.dump(item, f, ensure_ascii=False)
-            f.write('\n')
-
-@scheduler.scheduled_job("cron", minute='*/5', second=0, id='reply_messages')
-def reply_messages():
-    tinder_api = TinderAPI(TINDER_TOKEN)
-    profile = tinder_api.profile()
-    interests = ', '.join(profile.user_interests)
-    user_id = profile.id
-
-    for match in tinder_api.matches(limit=50):
-        chatroom = tinder_api.get_messages(match.match_id)
-        lastest_message = chatroom.get_lastest_message()
-        if lastest_message:
-            if lastest_message.from_id == user_id:
-                from_user_id = lastest_message.from_id
-                to_user_id = lastest_message.to_id
-                last_message = 'me'
-            else:
-                from_user_id = lastest_message.to_id
-                to_user_id = lastest_message.from_id
-                last_message = 'other'
-            sent_date = lastest_message.sent_date
-            if last_message == 'other' or (sent_date + datetime.timedelta(days=5)) < datetime.datetime.now():
-                content = dialog.generate_input(from_user_id, to_user_id, chatroom.messages[::-1])
-                response = chatgpt.get_response(profile.bio, interests, content)
-                if response:
-                    if response.startswith('[Sender]'):
-                        chatroom.send(response[8:], from_user_id, to_user_id)
-                    else:
-                        chatroom.send(response, from_user_id, to_user_id)
-                logger.info(f'Content: {content}, Reply: {response}')
+@router.get('/dispatch-openers')
+async def dispatch_openers(jitter: bool = False, account_id: str = DEFAULT_ACCOUNT):
+    services = account_services(account_id)
+    tinder_api = services.async_tinder_api()
+    profile = await services.profile_cache.aget(tinder_api)
+    message=0
+    matches, _ = await tinder_api.matches(count=30, message=message)
+
+    # the outbox transaction and one broker call per opener block, they run in a worker thread
+    def queue():
+        # only the matches the outbox has no opener queued, in flight or sent for
+        queued = services.outbox.enqueue(opener(match.match_id, match.person.id, match.person.name) for match in matches)
+        return dispatch_queued(services, profile, queued, jitter)
+    return await asyncio.to_thread(queue)
+
+# openers for matches under max_km (and from min_km / within min_age-max_age when given),
+# matches without a distance yet are included unless include_unenriched=false
+@router.get('/dispatch-openers-from-table')
+async def dispatch_openers_from_table(min_km: float = None, max_km: float = 15, min_age: int = None, max_age: int = None,
+                                      include_unenriched: bool = True, jitter: bool = False,
+                                      account_id: str = DEFAULT_ACCOUNT):
+    services = account_services(account_id)
+    tinder_api = services.async_tinder_api()
+    profile = await services.profile_cache.aget(tinder_api)
+
+    # the table scan, the outbox transaction and the broker calls block, they run in a worker thread
+    def queue():
+        # re-running it only queues the matches the outbox has not seen, a local lookup instead of a Tinder call each
+        queued = services.outbox.enqueue(
+            opener(match["match_id"], match["person_id"], match["name"])
+            for match in select_matches(services.matches_table, min_km, max_km, min_age, max_age, include_unenriched)
+        )
+        return dispatch_queued(services, profile, queued, jitter)
+    return await asyncio.to_thread(queue)
+
+# openers that may have gone out (unknown state, or a worker lost while sending) are never sent again blindly:
+# this checks their chats, marks the ones found as sent and lets the next dispatch queue the others again
+@router.get('/reconcile-openers')
+def reconcile_unsettled_openers(account_id: str = DEFAULT_ACCOUNT):
+    services = account_services(account_id)
+    unsettled = len(services.outbox.unsettled())
+    if not unsettled:
+        return {"unsettled": 0}
+    task = dispatch(reconcile_openers, (), account_id)
+    return {"status": "Task started", "task_id": task.id, "unsettled": unsettled}
+
+# appends the conversations longer than EXPORT_MIN_MESSAGES that are new or grew since the last run
+# to logs/chat_data/<user_id>/combined.jsonl, ?compact=true then drops the records they superseded
+@router.get('/export-messages')
+async def export_valuable_messages(compact: bool = False, account_id: str = DEFAULT_ACCOUNT):
+    services = account_services(account_id)
+    tinder_api = services.async_tinder_api()
+    profile = await services.profile_cache.aget(tinder_api)
+    path = f'logs/chat_data/{profile.id}/combined.jsonl'
+    counts = await services.training_exporter.export(tinder_api, profile.id, path)
+    if compact:
+        counts['records'] = await asyncio.to_thread(services.training_exporter.compact, path)
+    return counts
+
+async def reply_account_messages(services):
+    tinder_api = services.async_tinder_api()
+    profile = await services.profile_cache.aget(tinder_api)
+    await services.reply_pipeline.run(tinder_api, profile)
+
+async def active_accounts():
+    registry = worker.get_accounts()
+    await asyncio.to_thread(registry.load)
+    return [account_services(account.account_id) for account in registry.all() if account.token]
+
+# one full cycle over the latest matches of every account with a token, each with its own pipeline and rate limit;
+# the scheduler polls through poll_messages instead, this is the whole sweep at once
+async def reply_messages():
+    accounts = await active_accounts()
+    results = await asyncio.gather(*(reply_account_messages(services) for services in accounts), return_exceptions=True)
+    for services, result in zip(accounts, results):
+        if isinstance(result, Exception):
+            logger.error(f'reply_messages: account {services.account_id} failed: {result!r}')
+
+async def poll_account_messages(services):
+    tinder_api = services.async_tinder_api()
+    profile = await services.profile_cache.aget(tinder_api)
+    return await services.poller.tick(tinder_api, profile)
+
+# every API process ticks, only the one holding the lock in Redis polls; its TTL outlasts a tick cut at REPLY_DEADLINE,
+# and a new holder takes over within that TTL when the old one is gone
+POLL_TICK = float(os.getenv('POLL_TICK', 15))
+scheduler_lock = LeaderLock(worker.get_redis(), 'reply_messages', ttl=float(os.getenv('SCHEDULER_LOCK_TTL', 300)))
+
+# max_instances/coalesce keep APScheduler from stacking ticks, the pollers pick what is due each time
+@scheduler.scheduled_job("interval", seconds=POLL_TICK, id='poll_messages', max_instances=1, coalesce=True)
+async def poll_messages():
+    if not await asyncio.to_thread(scheduler_lock.acquire):
+        return
+    accounts = await active_accounts()
+    results = await asyncio.gather(*(poll_account_messages(services) for services in accounts), return_exceptions=True)
+    for services, result in zip(accounts, results):
+        if isinstance(result, Exception):
+            logger.error(f'poll_messages: account {services.account_id} failed: {result!r}')
+        elif result['calls']:
+            logger.info(f'poll_messages: account {services.account_id}: {result}')
+
+app.include_router(router)
+app.include_router(router, prefix='/accounts/{account_id}')
+
+@app.get('/accounts')
+def list_accounts():
+    registry = worker.get_accounts()
+    registry.load()
+    return [{"account_id": account.account_id, "queue": account.queue} for account in registry.all()]
 
 @app.get('/task-status/{task_id}')
 async def get_task_status(task_id):
     task = AsyncResult(task_id)
+    # AsyncResult talks to the Redis backend synchronously, keep it off the event loop
+    ready = await asyncio.to_thread(task.ready)
     # if task.state == 'PENDING':
     #     response = {"status": "Pending..."}
     # elif task.state == 'SUCCESS':
@@ -426,22 +593,38 @@ async def get_task_status(task_id):
     # else:
     #     response = {"status": task.state}
     # return response
-    if task.ready():
-            return {"task_id": task_id, "result": task.result}
+    if ready:
+            return {"task_id": task_id, "result": await asyncio.to_thread(lambda: task.result)}
     return {"task_id": task_id, "status": "Processing"}
 
 @app.get("/monitor")
 async def monitor():
     return {"flower_url": "http://localhost:5555"}
 
-# @app.on_event("startup")
-# async def startup():
-#     scheduler.start()
-
-
-# @app.on_event("shutdown")
-# async def shutdown():
-#     scheduler.remove_job('reply_messages')
+# Prometheus metrics of this API process (Tinder calls, storage, reply cycle, OpenAI calls)
+@app.get("/metrics")
+def get_metrics():
+    body, content_type = metrics.render()
+    return Response(body, media_type=content_type)
+
+# SCHEDULER_ENABLED=false keeps a process from polling at all (benchmarks, one-off scripts)
+@app.on_event("startup")
+async def startup():
+    if os.getenv('SCHEDULER_ENABLED', 'true').lower() == 'true':
+        scheduler.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+        # hand the lock over now rather than when it expires
+        await asyncio.to_thread(scheduler_lock.release)
+
+@app.on_event("shutdown")
+async def close_tinder_clients():
+    await close_async_tinder_apis()
+    await models.aclose()
 
 if __name__ == "__main__":
     uvicorn.run('main:app', host='0.0.0.0', port=8080, reload=True)
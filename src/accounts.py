@@ -0,0 +1,103 @@
+import os
+import json
+import threading
+from typing import Dict, List, Optional
+
+DEFAULT_ACCOUNT = 'default'
+
+
+class UnknownAccount(KeyError):
+    pass
+
+
+class Account:
+    # One Tinder account and everything partitioned by it: its own SQLite file (no lock shared with other
+    # accounts), its own rate limiter and in-flight keys in Redis, and its own Celery queue.
+    # The default account keeps the names used before accounts existed, so its data and queued tasks carry over.
+    def __init__(self, account_id: str, token: str, database_path: str = None, queue: str = None,
+                 rate: float = None, accounts_dir: str = 'database/accounts'):
+        self.account_id = account_id
+        self.token = token
+        default = account_id == DEFAULT_ACCOUNT
+        self.database_path = database_path or (None if default else os.path.join(accounts_dir, account_id, 'db.sqlite3'))
+        self.queue = queue or ('celery' if default else f'account.{account_id}')
+        self.rate = rate
+        self.limiter_name = 'tinder' if default else f'tinder:{account_id}'
+        self.inflight_name = 'enrich' if default else f'enrich:{account_id}'
+        self._storage = None
+        self._lock = threading.Lock()
+
+    def storage(self):
+        # opened on first use, in the process that uses it
+        if self._storage is None:
+            with self._lock:
+                if self._storage is None:
+                    from src.storage import open_storage
+                    if self.database_path:
+                        os.makedirs(os.path.dirname(self.database_path) or '.', exist_ok=True)
+                    # only the default account picks up the legacy TinyDB file
+                    self._storage = open_storage(path=self.database_path,
+                                                 migrate=self.account_id == DEFAULT_ACCOUNT)
+        return self._storage
+
+    def __repr__(self):
+        return f'Account({self.account_id}, queue={self.queue})'
+
+
+class AccountRegistry:
+    # Accounts come from ACCOUNTS_FILE, a JSON object of account id -> {"token", and optionally
+    # "database_path", "queue", "rate"}; TINDER_TOKEN alone still works as the "default" account.
+    # Every process reads the same file, an id it does not know yet makes it read the file again.
+    def __init__(self, path: Optional[str] = None, default_token: Optional[str] = None,
+                 accounts_dir: str = 'database/accounts'):
+        self.path = path
+        self.default_token = default_token
+        self.accounts_dir = accounts_dir
+        self._accounts: Dict[str, Account] = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        entries = {}
+        if self.path and os.path.exists(self.path):
+            with open(self.path, encoding='utf-8') as f:
+                entries = json.load(f)
+        # the default account always exists, it also holds what is shared by every account (completion cache)
+        if DEFAULT_ACCOUNT not in entries:
+            entries[DEFAULT_ACCOUNT] = {'token': self.default_token}
+        with self._lock:
+            for account_id, entry in entries.items():
+                # already opened accounts are kept, with their storage
+                if account_id not in self._accounts:
+                    self._accounts[account_id] = Account(
+                        account_id,
+                        entry['token'],
+                        database_path=entry.get('database_path'),
+                        queue=entry.get('queue'),
+                        rate=entry.get('rate'),
+                        accounts_dir=self.accounts_dir,
+                    )
+
+    def get(self, account_id: Optional[str] = None) -> Account:
+        account_id = account_id or DEFAULT_ACCOUNT
+        account = self._accounts.get(account_id)
+        if account is None:
+            self.load()
+            account = self._accounts.get(account_id)
+        if account is None:
+            raise UnknownAccount(account_id)
+        return account
+
+    def all(self) -> List[Account]:
+        return list(self._accounts.values())
+
+    def ids(self) -> List[str]:
+        return list(self._accounts)
+
+
+def registry_from_env() -> AccountRegistry:
+    return AccountRegistry(
+        os.getenv('ACCOUNTS_FILE', 'database/accounts.json'),
+        default_token=os.getenv('TINDER_TOKEN'),
+        accounts_dir=os.getenv('ACCOUNTS_DIR', 'database/accounts'),
+    )
@@ -0,0 +1,204 @@
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from src.logger import logger
+from src.metrics import LLM_CACHE, PERSON_CACHE, PERSON_REVALIDATIONS
+from src.ratelimit import CallBudget
+
+
+class ProfileCache:
+    # Our own profile barely changes, so it is fetched once per TTL and shared by every route, task and job.
+    # A id/bio/interests snapshot is persisted in the profile table for processes that must not call Tinder.
+    def __init__(self, table, ttl: float = 86400):
+        self.table = table
+        self.ttl = ttl
+        self._profile = None
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+        self._async_lock = None
+
+    def _is_fresh(self) -> bool:
+        return self._profile is not None and time.time() - self._fetched_at < self.ttl
+
+    def _store(self, profile):
+        self._profile = profile
+        self._fetched_at = time.time()
+        self.table.truncate()
+        self.table.insert({
+            'id': profile.id,
+            'bio': profile.bio,
+            'interests': profile.user_interests,
+            'fetched_at': self._fetched_at,
+        })
+        return profile
+
+    def get(self, tinder_api, refresh: bool = False):
+        if refresh:
+            self.invalidate()
+        if self._is_fresh():
+            return self._profile
+        with self._lock:
+            if self._is_fresh():
+                return self._profile
+            return self._store(tinder_api.profile())
+
+    async def aget(self, tinder_api, refresh: bool = False):
+        if refresh:
+            self.invalidate()
+        if self._is_fresh():
+            return self._profile
+        # created lazily so it binds to the running loop and not the one active at import time
+        if self._async_lock is None:
+            self._async_lock = asyncio.Lock()
+        async with self._async_lock:
+            if self._is_fresh():
+                return self._profile
+            profile = await tinder_api.profile()
+            return await asyncio.to_thread(self._store, profile)
+
+    def invalidate(self):
+        self._profile = None
+        self._fetched_at = 0.0
+
+    def snapshot(self):
+        # read straight from the table, another process may have refreshed it
+        rows = self.table.all()
+        return dict(rows[0]) if rows else None
+
+    def get_snapshot(self, tinder_api, refresh: bool = False):
+        snapshot = None if refresh else self.snapshot()
+        if snapshot and time.time() - snapshot.get('fetched_at', 0) < self.ttl:
+            return snapshot
+        self.get(tinder_api, refresh=True)
+        return self.snapshot()
+
+
+class CompletionCache:
+    # Chat completions keyed on a hash of the model and the full message list (system prompt included),
+    # so an unchanged conversation is answered from here instead of a second OpenAI call.
+    # Recent entries live in an in-memory LRU, every entry is also persisted in `table` until it expires.
+    def __init__(self, table, ttl: float = 86400, max_entries: int = 1000, prune_every: int = 100):
+        self.table = table
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.prune_every = prune_every
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._puts = 0
+
+    @staticmethod
+    def make_key(model: str, messages) -> str:
+        payload = json.dumps({'model': model, 'messages': messages}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry['stored_at'] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                LLM_CACHE.labels('hit').inc()
+                return entry['response']
+        entry = self.table.get(key)
+        with self._lock:
+            if entry is not None and now - entry['stored_at'] < self.ttl:
+                self._remember(key, entry)
+                self.hits += 1
+                LLM_CACHE.labels('hit').inc()
+                return entry['response']
+            self._entries.pop(key, None)
+            self.misses += 1
+            LLM_CACHE.labels('miss').inc()
+            return None
+
+    def put(self, key: str, response):
+        entry = {'key': key, 'response': response, 'stored_at': time.time()}
+        with self._lock:
+            self._remember(key, entry)
+            self._puts += 1
+            prune = self._puts % self.prune_every == 0
+        self.table.upsert(entry)
+        if prune:
+            self.prune()
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def prune(self):
+        # drop the persisted entries past their TTL
+        for entry in list(self.table.range('stored_at', hi=time.time() - self.ttl)):
+            self.table.remove(entry['key'])
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+class PersonCache:
+    # The person fields of a match row (distance, birth_date, bio) stamped with the time they were fetched.
+    # A row younger than max_age is served as is; an older one is served too, while `revalidate(match_id, person_id)`
+    # queues a background refresh, at most `budget` of them per window. `claim(match_id)` marks the refresh in
+    # flight first: a row already being refreshed costs no budget. A refresh that cannot be queued gives its
+    # claim (`release(match_id)`) and its budget back, the row is served all the same. Only a row never
+    # enriched, or a ?refresh=true, is fetched inline. Rows enriched before the stamp existed count as stale.
+    def __init__(self, table, max_age: float = 86400, revalidate=None, claim=None, release=None,
+                 budget: CallBudget = None):
+        self.table = table
+        self.max_age = max_age
+        self.revalidate = revalidate
+        self.claim = claim
+        self.release = release
+        self.budget = budget or CallBudget(10, 60)
+        self._lock = threading.Lock()
+
+    def is_fresh(self, row) -> bool:
+        fetched_at = row.get('fetched_at')
+        return fetched_at is not None and time.time() - fetched_at < self.max_age
+
+    def _revalidate(self, row):
+        now = time.time()
+        with self._lock:
+            # nothing is claimed that the budget could not pay for, and only a claimed refresh is paid
+            if self.budget.available(now) <= 0:
+                PERSON_REVALIDATIONS.labels('deferred').inc()
+                return
+            if self.claim is not None and not self.claim(row['match_id']):
+                PERSON_REVALIDATIONS.labels('inflight').inc()
+                return
+            self.budget.spend(1, now)
+        try:
+            self.revalidate(row['match_id'], row['person_id'])
+        except Exception as e:
+            logger.warning(f'person cache: refresh of match {row["match_id"]} not queued: {e!r}')
+            PERSON_REVALIDATIONS.labels('failed').inc()
+            if self.release is not None:
+                self.release(row['match_id'])
+            with self._lock:
+                self.budget.refund(1, now)
+            return
+        PERSON_REVALIDATIONS.labels('queued').inc()
+
+    def get(self, match_id, fetch, refresh: bool = False):
+        # fetch(person_id) -> the person fields, only called when the row cannot be served
+        row = self.table.get(match_id)
+        if row is None:
+            return None
+        if not refresh and 'distance' in row:
+            if self.is_fresh(row):
+                PERSON_CACHE.labels('fresh').inc()
+            else:
+                PERSON_CACHE.labels('stale').inc()
+                if self.revalidate is not None:
+                    self._revalidate(row)
+            return row
+        PERSON_CACHE.labels('refresh' if refresh else 'miss').inc()
+        self.table.update(match_id, fetch(row['person_id']))
+        return self.table.get(match_id)
@@ -1,13 +1,14 @@
+from typing import AsyncIterator, Iterator, List, Tuple
 from src.models import ModelInterface
 
 class ChatGPT:
     def __init__(self, model: ModelInterface):
         self.model = model
 
-    def get_response(self, interests: str, bio: str, text: str, language: str) -> str:
-        messages = [{
+    def _messages(self, interests: str, bio: str, text: str, language: str) -> list:
+        return [{
             'role': 'system',
-            'content': '''
+            'content': f'''
                 This chatbot will act on behalf of the user to chat with other girls on the dating app. The chatbot should follow these guidelines to ensure engaging and natural conversations:
                 1. Keep the conversation light, natural, and not awkward.
                 2. Infuse humor and fun into the conversation.
@@ -23,10 +24,27 @@ class ChatGPT:
         }, {
             'role': 'user', 'content': text
         }]
-        response = self.model.chat_completion(messages)
+
+    def get_response(self, interests: str, bio: str, text: str, language: str) -> str:
+        response = self.model.chat_completion(self._messages(interests, bio, text, language))
         content = response['choices'][0]['message']['content']
         return content
 
+    async def aget_response(self, interests: str, bio: str, text: str, language: str) -> str:
+        response = await self.model.achat_completion(self._messages(interests, bio, text, language))
+        return response['choices'][0]['message']['content']
+
+    def get_responses(self, requests: List[Tuple[str, str, str, str]]) -> List[str]:
+        # one (interests, bio, text, language) tuple per conversation, answered concurrently
+        responses = self.model.chat_completion_many([self._messages(*request) for request in requests])
+        return [response['choices'][0]['message']['content'] for response in responses]
+
+    def stream_response(self, interests: str, bio: str, text: str, language: str) -> Iterator[str]:
+        return self.model.stream_chat_completion(self._messages(interests, bio, text, language))
+
+    def astream_response(self, interests: str, bio: str, text: str, language: str) -> AsyncIterator[str]:
+        return self.model.astream_chat_completion(self._messages(interests, bio, text, language))
+
 
 class DALLE:
     def __init__(self, model: ModelInterface):
@@ -34,3 +52,6 @@ class DALLE:
 
     def generate(self, text: str) -> str:
         return self.model.image_generation(text)
+
+    async def agenerate(self, text: str) -> str:
+        return await self.model.aimage_generation(text)
@@ -1,34 +1,77 @@
-import os
-import json
+from collections import OrderedDict
 
 class Dialog:
     PREFIX = """
         You are now playing the role of [Sender] and your task is to respond to [Receiver] in the conversation below. Your response should not exceed 50 words and end with a question. Please respond in the language used by [Sender].
     """
+    # rough size of a token for the budget, OpenAI's rule of thumb for English text
+    CHARS_PER_TOKEN = 4
+
+    def __init__(self, max_tokens=1500, max_cached=1000):
+        self.max_chars = max_tokens * self.CHARS_PER_TOKEN
+        self.max_cached = max_cached
+        # match_id -> rendered lines of the conversation, kept per sender and trimmed to the budget
+        self._contexts = OrderedDict()
 
     def generate_input(self, from_user_id, to_user_id, dialog):
-        context = '\n'.join([str(d).replace(from_user_id, '[Sender]').replace(to_user_id, '[Receiver]') for d in dialog])
+        # dialog is oldest first; only the messages after the last one rendered are added
+        lines = self._render(from_user_id, dialog)
+        context = '\n'.join(self._fit(lines))
         return f'{self.PREFIX} \n\n{context}\n[Sender]:'
 
-    def export_message_json(self, user_id, dialog):
-            receiver_id = dialog[0].to_id if dialog[0].from_id == user_id else dialog[0].from_id
-            messages = [{
-                "role": "system",
-                "content": self.PREFIX
-            }]
-            for d in dialog:
-                if d.from_id == user_id:
-                    messages.append({
-                        "role": "assistant",
-                        "content": d.message
-                    })
-                else:
-                    messages.append({
-                        "role": "user",
-                        "content": d.message
-                    })
-            file_name = f"chat_data/{user_id}/{receiver_id}.json"
-            folder_path = os.path.dirname(file_name)
-            os.makedirs(folder_path, exist_ok=True)
-            with open(file_name, "w", encoding="utf-8") as f:
-                json.dump({"messages": messages}, f, ensure_ascii=False, indent=4)
\ No newline at end of file
+    def _render(self, from_user_id, dialog):
+        if not dialog:
+            return []
+        match_id = dialog[-1].match_id
+        cached = self._contexts.get(match_id)
+        start = 0
+        if cached and cached['sender'] == from_user_id:
+            start = self._after(dialog, cached['last_message_id'])
+        if start == 0:
+            cached = {'sender': from_user_id, 'lines': []}
+        for d in dialog[start:]:
+            role = '[Sender]' if d.from_id == from_user_id else '[Receiver]'
+            cached['lines'].append(f'{role}: {d.message}')
+        cached['last_message_id'] = dialog[-1].message_id
+        # older lines past the budget will never be sent again
+        cached['lines'] = self._fit(cached['lines'])
+        self._contexts[match_id] = cached
+        self._contexts.move_to_end(match_id)
+        while len(self._contexts) > self.max_cached:
+            self._contexts.popitem(last=False)
+        return cached['lines']
+
+    def _after(self, dialog, message_id):
+        # index right after `message_id`, searched from the newest end; 0 when it is not there
+        for i in range(len(dialog) - 1, -1, -1):
+            if dialog[i].message_id == message_id:
+                return i + 1
+        return 0
+
+    def _fit(self, lines):
+        # the most recent turns that fit in the budget, always at least the last one
+        size = 0
+        for i in range(len(lines) - 1, -1, -1):
+            size += len(lines[i]) + 1
+            if size > self.max_chars and i < len(lines) - 1:
+                return lines[i + 1:]
+        return lines
+
+    def training_record(self, user_id, dialog):
+        # one fine-tuning example, dialog is oldest first
+        messages = [{
+            "role": "system",
+            "content": self.PREFIX
+        }]
+        for d in dialog:
+            if d.from_id == user_id:
+                messages.append({
+                    "role": "assistant",
+                    "content": d.message
+                })
+            else:
+                messages.append({
+                    "role": "user",
+                    "content": d.message
+                })
+        return {"messages": messages}
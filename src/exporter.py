@@ -0,0 +1,100 @@
+import os
+import json
+import time
+import asyncio
+from typing import Dict
+from src.tinder import Message
+from src.logger import logger
+
+
+class TrainingExporter:
+    # Streams conversations straight into one append-only JSONL file, one fine-tuning record per line.
+    # A per-match watermark (last activity, newest message, record offset) means a re-run only fetches and
+    # appends the conversations that moved since; a grown conversation gets a new record and `compact`
+    # drops the superseded ones. Matches are handled a page at a time, memory does not grow with the account.
+    def __init__(self, dialog, watermarks, min_messages: int = 20, history: int = 100, concurrency: int = 5,
+                 page_size: int = 100):
+        self.dialog = dialog
+        self.watermarks = watermarks
+        self.min_messages = min_messages
+        self.history = history
+        self.concurrency = concurrency
+        self.page_size = page_size
+
+    def _prepare(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        if not os.path.exists(path):
+            # the watermarks describe a file that is gone, start over
+            self.watermarks.truncate()
+
+    async def export(self, tinder_api, user_id, path: str) -> Dict[str, int]:
+        # storage and file work runs in threads, the event loop only waits on Tinder
+        await asyncio.to_thread(self._prepare, path)
+        counts = {'exported': 0, 'unchanged': 0, 'skipped': 0}
+        semaphore = asyncio.Semaphore(self.concurrency)
+        page_token = None
+        started = time.monotonic()
+        with open(path, 'ab') as out:
+            while True:
+                matches, page_token = await tinder_api.matches(count=self.page_size, message=1, page_token=page_token)
+                watermarks = await asyncio.to_thread(self._watermarks, matches)
+                tasks = [self._fetch(tinder_api, match, watermarks.get(match.match_id), semaphore) for match in matches]
+                # records are written as each chat arrives, in whatever order they finish
+                for task in asyncio.as_completed(tasks):
+                    match, data = await task
+                    counts[await asyncio.to_thread(self._write, out, user_id, match, data)] += 1
+                if not matches or not page_token:
+                    break
+        logger.info(f'export-messages: {counts} in {time.monotonic() - started:.1f}s')
+        return counts
+
+    def _watermarks(self, matches):
+        return {match.match_id: self.watermarks.get(match.match_id) for match in matches}
+
+    async def _fetch(self, tinder_api, match, watermark, semaphore):
+        # ISO timestamps in the same format compare in time order
+        if watermark and match.last_activity_date and match.last_activity_date <= watermark.get('last_activity_date', ''):
+            return match, None
+        async with semaphore:
+            return match, await tinder_api.get_message_data(match.match_id, count=self.history)
+
+    def _write(self, out, user_id, match, data) -> str:
+        if data is None:
+            return 'unchanged'
+        watermark = self.watermarks.get(match.match_id) or {}
+        if data and data[0]['_id'] == watermark.get('last_message_id'):
+            self.watermarks.update(match.match_id, {'last_activity_date': match.last_activity_date or ''})
+            return 'unchanged'
+        watermark = {
+            'match_id': match.match_id,
+            'last_activity_date': match.last_activity_date or '',
+            'last_message_id': data[0]['_id'] if data else None,
+            'message_count': len(data),
+        }
+        if len(data) <= self.min_messages:
+            # too short for now, looked at again once it has new activity
+            self.watermarks.upsert(watermark)
+            return 'skipped'
+        # newest first from Tinder, oldest first in the record
+        dialog = [Message(match.match_id, message) for message in reversed(data)]
+        watermark['offset'] = out.tell()
+        out.write((json.dumps(self.dialog.training_record(user_id, dialog), ensure_ascii=False) + '\n').encode('utf-8'))
+        out.flush()
+        self.watermarks.upsert(watermark)
+        return 'exported'
+
+    def compact(self, path: str) -> int:
+        # keeps only the latest record of every match, streaming the file into a new one
+        latest = {row['offset']: row['match_id'] for row in self.watermarks.iter() if 'offset' in row}
+        moved = {}
+        tmp_path = path + '.tmp'
+        with open(path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            offset = src.tell()
+            for line in iter(src.readline, b''):
+                if offset in latest:
+                    moved[latest[offset]] = {'offset': dst.tell()}
+                    dst.write(line)
+                offset += len(line)
+        os.replace(tmp_path, path)
+        self.watermarks.update_many(moved)
+        return len(moved)
@@ -0,0 +1,22 @@
+from typing import Iterable, List
+
+
+class InFlightSet:
+    # Redis keys marking work that is already queued, so a repeated request does not enqueue it twice.
+    # Each key expires on its own, a lost worker cannot hold an id forever.
+    def __init__(self, redis_client, name: str, ttl: int = 3600):
+        self.redis = redis_client
+        self.prefix = f'inflight:{name}:'
+        self.ttl = ttl
+
+    def claim(self, ids: Iterable[str]) -> List[str]:
+        ids = list(ids)
+        pipe = self.redis.pipeline(transaction=False)
+        for id in ids:
+            pipe.set(self.prefix + id, 1, nx=True, ex=self.ttl)
+        return [id for id, claimed in zip(ids, pipe.execute()) if claimed]
+
+    def release(self, ids: Iterable[str]):
+        keys = [self.prefix + id for id in ids]
+        if keys:
+            self.redis.delete(*keys)
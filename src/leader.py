@@ -0,0 +1,48 @@
+import os
+import uuid
+import socket
+from src.metrics import SCHEDULER_LEADER
+
+# Take the lock when it is free, or extend it when this process already holds it
+ACQUIRE_SCRIPT = """
+local holder = redis.call('GET', KEYS[1])
+if holder == false then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+    return 1
+end
+if holder == ARGV[1] then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# Only the holder may release it
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class LeaderLock:
+    # One holder among every API process sharing Redis (uvicorn/gunicorn workers, replicas).
+    # The holder renews it on every tick; if it dies the lock expires after `ttl` seconds and the
+    # next process to tick takes over.
+    def __init__(self, redis_client, name: str, ttl: float = 60):
+        self.redis = redis_client
+        self.key = f'leader:{name}'
+        self.ttl = ttl
+        self.token = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}'
+        self._acquire = redis_client.register_script(ACQUIRE_SCRIPT)
+        self._release = redis_client.register_script(RELEASE_SCRIPT)
+
+    def acquire(self) -> bool:
+        held = bool(self._acquire(keys=[self.key], args=[self.token, int(self.ttl * 1000)]))
+        SCHEDULER_LEADER.set(1 if held else 0)
+        return held
+
+    def release(self):
+        self._release(keys=[self.key], args=[self.token])
+        SCHEDULER_LEADER.set(0)
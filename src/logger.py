@@ -1,6 +1,13 @@
 import os
+import json
+import queue
+import atexit
 import logging
 import logging.handlers
+from dotenv import load_dotenv # type: ignore
+
+# this module is imported before main loads .env, the LOG_* settings below come from it too
+load_dotenv()
 
 
 class CustomFormatter(logging.Formatter):
@@ -40,6 +47,38 @@ class CustomFormatter(logging.Formatter):
         return output
 
 
+class JSONFormatter(logging.Formatter):
+    # one JSON object per line, LOG_FORMAT=json
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'name': record.name,
+            'module': record.module,
+            'line': record.lineno,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class BatchedFlush:
+    # StreamHandler flushes after every record; here only every `batch` records,
+    # the listener flushes the rest as soon as the queue goes quiet
+    batch = 100
+    _pending = 0
+
+    def flush(self):
+        self._pending += 1
+        if self._pending >= self.batch:
+            self.force_flush()
+
+    def force_flush(self):
+        self._pending = 0
+        super().flush()
+
+
 class LoggerFactory:
     @staticmethod
     def create_logger(console_formatter, file_formatter, handlers):
@@ -47,35 +86,116 @@ class LoggerFactory:
         logger.setLevel(logging.INFO)
         for handler in handlers:
             handler.setLevel(logging.DEBUG)
+            # only app_logger records, the audit trails share the listener
+            handler.addFilter(logging.Filter('app_logger'))
             # Apply the appropriate formatter to each handler
             if isinstance(handler, ConsoleHandler):
                 handler.setFormatter(console_formatter)
-            elif isinstance(handler, FileHandler):
+            elif isinstance(handler, (FileHandler, TimedFileHandler)):
                 handler.setFormatter(file_formatter)
-            logger.addHandler(handler)
+            listener.add(handler)
+        logger.addHandler(queue_handler)
         return logger
 
 
-class FileHandler(logging.FileHandler):
-    def __init__(self, log_file):
+class FileHandler(BatchedFlush, logging.handlers.RotatingFileHandler):
+    # rotated at LOG_MAX_BYTES (0: never), LOG_BACKUP_COUNT old files kept
+    def __init__(self, log_file, max_bytes=0, backup_count=5):
         os.makedirs(os.path.dirname(log_file), exist_ok=True)
-        super().__init__(log_file)
+        super().__init__(log_file, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
 
 
-class ConsoleHandler(logging.StreamHandler):
+class TimedFileHandler(BatchedFlush, logging.handlers.TimedRotatingFileHandler):
+    # rotated on a schedule instead, LOG_ROTATE_WHEN=midnight, h...
+    def __init__(self, log_file, when='midnight', backup_count=5):
+        os.makedirs(os.path.dirname(log_file), exist_ok=True)
+        super().__init__(log_file, when=when, backupCount=backup_count, encoding='utf-8')
+
+
+class ConsoleHandler(BatchedFlush, logging.StreamHandler):
     pass
 
+
+class LogListener(logging.handlers.QueueListener):
+    # Background thread doing every write: request handlers and tasks only put the record on a queue
+    def __init__(self, log_queue, flush_interval=1.0):
+        super().__init__(log_queue, respect_handler_level=True)
+        self.flush_interval = flush_interval
+
+    def add(self, handler):
+        self.handlers = self.handlers + (handler,)
+
+    def dequeue(self, block):
+        while True:
+            try:
+                return self.queue.get(block, timeout=self.flush_interval)
+            except queue.Empty:
+                self.flush()
+
+    def flush(self):
+        for handler in self.handlers:
+            try:
+                handler.force_flush() if isinstance(handler, BatchedFlush) else handler.flush()
+            except (OSError, ValueError):
+                # a stream closed before the exit flush (the console under a test runner), like logging.shutdown
+                pass
+
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+        self.flush()
+
+
+def file_handler_for(log_file):
+    if os.getenv('LOG_ROTATE_WHEN'):
+        return TimedFileHandler(log_file, os.getenv('LOG_ROTATE_WHEN'), int(os.getenv('LOG_BACKUP_COUNT', 5)))
+    return FileHandler(log_file, int(os.getenv('LOG_MAX_BYTES', 0)), int(os.getenv('LOG_BACKUP_COUNT', 5)))
+
+
+def get_audit_logger(name):
+    # plain lines appended to logs/<name>.txt (openers, messages) through the same background writer
+    audit = logging.getLogger(f'audit.{name}')
+    if not audit.handlers:
+        audit.setLevel(logging.INFO)
+        audit.propagate = False
+        handler = file_handler_for(f'./logs/{name}.txt')
+        handler.addFilter(logging.Filter(audit.name))
+        listener.add(handler)
+        audit.addHandler(queue_handler)
+    return audit
+
+
+def _restart_listener():
+    # a forked Celery worker child has the queue but not the thread, it gets its own
+    global listener
+    log_queue = queue.SimpleQueue()
+    queue_handler.queue = log_queue
+    handlers = listener.handlers
+    listener = LogListener(log_queue, listener.flush_interval)
+    listener.handlers = handlers
+    listener.start()
+
+
+log_queue = queue.SimpleQueue()
+queue_handler = logging.handlers.QueueHandler(log_queue)
+listener = LogListener(log_queue, float(os.getenv('LOG_FLUSH_INTERVAL', 1)))
+listener.start()
+atexit.register(lambda: listener.stop())
+os.register_at_fork(after_in_child=_restart_listener)
+
 # Plain text formatter for file output
 plain_formatter = logging.Formatter(
     '%(asctime)s %(levelname)-8s %(name)s -> %(message)s',
     '%Y-%m-%d %H:%M:%S'
 )
+if os.getenv('LOG_FORMAT') == 'json':
+    plain_formatter = JSONFormatter()
 
 # CustomFormatter with colors for console output
 formatter = CustomFormatter()
 
 # Handlers
-file_handler = FileHandler('./logs/app.log')
+file_handler = file_handler_for('./logs/app.log')
 console_handler = ConsoleHandler()
 
 # Create logger with specified formatters for each handler
@@ -0,0 +1,114 @@
+import os
+import time
+import functools
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, start_http_server, CONTENT_TYPE_LATEST # type: ignore
+
+# Prometheus metrics of one process: the API serves them on /metrics, every Celery worker process
+# serves its own on CELERY_METRICS_PORT (the next free port when several share a host). Tasks run eagerly
+# in the API or a test process report to that process's metrics and open no port.
+
+# Tinder, labelled by endpoint template (/user/{id}) so match and person ids do not explode the series
+TINDER_REQUESTS = Counter('tinder_requests_total', 'Tinder responses', ['method', 'endpoint', 'status'])
+TINDER_LATENCY = Histogram('tinder_request_seconds', 'Tinder request latency, one sample per attempt',
+                           ['method', 'endpoint'])
+TINDER_IN_FLIGHT = Gauge('tinder_requests_in_flight', 'Tinder requests waiting for a response')
+TINDER_RETRIES = Counter('tinder_retries_total', 'Tinder attempts retried after a 429, 5xx or connection error',
+                         ['method', 'endpoint'])
+
+RATE_LIMIT_WAIT = Histogram('tinder_rate_limit_wait_seconds', 'Time spent waiting for a rate limiter token',
+                            buckets=(0, .1, .5, 1, 2.5, 5, 10, 30, 60))
+RATE_LIMITED = Counter('tinder_rate_limited_total', 'Calls refused a token and sent back to retry later')
+RATE_LIMIT_RATE = Gauge('tinder_rate_limit_rate', 'Current shared Tinder rate (requests per second)')
+
+STORAGE_LATENCY = Histogram('storage_operation_seconds', 'Storage operation latency', ['table', 'operation'],
+                            buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 5))
+
+TASK_LATENCY = Histogram('celery_task_seconds', 'Celery task run time', ['task', 'state'],
+                         buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+TASKS_IN_FLIGHT = Gauge('celery_tasks_in_flight', 'Celery tasks running', ['task'])
+
+REPLY_CYCLE = Histogram('reply_cycle_seconds', 'reply_messages cycle duration', ['outcome'],
+                        buckets=(1, 5, 10, 30, 60, 120, 240, 300, 600))
+REPLIES_SENT = Counter('reply_messages_sent_total', 'Replies sent by the reply_messages cycle')
+POLLS = Counter('reply_polls_total', 'Matches polled by the adaptive scheduler, by what it found', ['outcome'])
+POLL_INTERVAL = Histogram('reply_poll_interval_seconds', 'Interval until the next poll of a match',
+                          buckets=(30, 60, 120, 300, 600, 1200, 1800, 3600))
+POLL_SKIPPED = Counter('reply_polls_deferred_total', 'Due matches and replies left for a later tick by the call budget')
+SCHEDULER_LEADER = Gauge('scheduler_leader', '1 while this process holds the scheduler lock')
+OPENERS = Counter('openers_total', 'Openers through the outbox: queued, skipped (already queued or sent), '
+                  'sent, failed (not delivered), unknown (maybe delivered) and duplicate (a task found it taken)',
+                  ['outcome'])
+PERSON_CACHE = Counter('person_cache_requests_total', 'Person lookups by /match: fresh, stale (served while it '
+                       'revalidates), miss and refresh (fetched inline)', ['result'])
+PERSON_REVALIDATIONS = Counter('person_revalidations_total', 'Background refreshes of stale persons: queued, '
+                               'inflight (already queued), deferred (over the refresh budget) and failed '
+                               '(could not be queued)', ['outcome'])
+
+LLM_LATENCY = Histogram('llm_request_seconds', 'OpenAI request latency', ['model', 'operation'],
+                        buckets=(.25, .5, 1, 2.5, 5, 10, 20, 30, 60))
+LLM_IN_FLIGHT = Gauge('llm_requests_in_flight', 'OpenAI requests waiting for a response')
+LLM_ERRORS = Counter('llm_errors_total', 'OpenAI requests that failed', ['model', 'operation'])
+LLM_TOKENS = Counter('llm_tokens_total', 'OpenAI tokens used', ['model', 'kind'])
+LLM_CACHE = Counter('llm_cache_requests_total', 'Completion cache lookups', ['result'])
+
+
+def render():
+    # body and content type of a /metrics response
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def observe_tokens(model, response):
+    usage = (response or {}).get('usage') or {}
+    for kind in ('prompt_tokens', 'completion_tokens'):
+        if usage.get(kind):
+            LLM_TOKENS.labels(model, kind[:-len('_tokens')]).inc(usage[kind])
+
+
+def timed_storage(operation):
+    # decorator for Table methods, labelled with the table's name
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                STORAGE_LATENCY.labels(self.name, operation).observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+_exporter_pid = None
+
+
+def start_exporter(port: int, attempts: int = 32):
+    # once per process: prefork children each take the first free port from `port` on
+    global _exporter_pid
+    if _exporter_pid == os.getpid():
+        return
+    _exporter_pid = os.getpid()
+    for offset in range(attempts):
+        try:
+            start_http_server(port + offset)
+            return port + offset
+        except OSError:
+            continue
+    return None
+
+
+def instrument_celery(port: int):
+    # called once in each process that runs tasks for a worker: serves its metrics and times its tasks
+    from celery.signals import task_prerun, task_postrun # type: ignore
+    start_exporter(port)
+    started = {}
+
+    @task_prerun.connect(weak=False)
+    def on_prerun(task_id=None, task=None, **kwargs):
+        started[task_id] = time.perf_counter()
+        TASKS_IN_FLIGHT.labels(task.name).inc()
+
+    @task_postrun.connect(weak=False)
+    def on_postrun(task_id=None, task=None, state=None, **kwargs):
+        TASKS_IN_FLIGHT.labels(task.name).dec()
+        if task_id in started:
+            TASK_LATENCY.labels(task.name, state or 'UNKNOWN').observe(time.perf_counter() - started.pop(task_id))
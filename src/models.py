@@ -1,33 +1,253 @@
-from typing import List, Dict
+import os
+import json
+import time
+import asyncio
+import threading
+from contextlib import contextmanager
+from typing import AsyncIterator, Iterator, List, Dict
+import httpx
 import openai
+from src.metrics import LLM_LATENCY, LLM_IN_FLIGHT, LLM_ERRORS, observe_tokens
+
+# One long-lived event loop per process for the synchronous batch calls, so an async client and its
+# connection pool built for it are reused by every batch instead of one per asyncio.run.
+_batch_loop = None
+_batch_loop_pid = None
+_batch_loop_lock = threading.Lock()
+
+
+def batch_loop() -> asyncio.AbstractEventLoop:
+    global _batch_loop, _batch_loop_pid
+    with _batch_loop_lock:
+        # a forked worker does not inherit the thread running the parent's loop
+        if _batch_loop is None or _batch_loop_pid != os.getpid():
+            _batch_loop = asyncio.new_event_loop()
+            _batch_loop_pid = os.getpid()
+            threading.Thread(target=_batch_loop.run_forever, name='model-batches', daemon=True).start()
+        return _batch_loop
 
 
 class ModelInterface:
-    def chat_completion(self, messages: List[Dict]) -> str:
+    def chat_completion(self, messages: List[Dict]) -> Dict:
         pass
 
     def image_generation(self, prompt: str) -> str:
         pass
 
+    # The variants below fall back to the blocking calls, a model only overrides what it does natively.
+
+    async def achat_completion(self, messages: List[Dict]) -> Dict:
+        return await asyncio.to_thread(self.chat_completion, messages)
+
+    async def achat_completion_many(self, conversations: List[List[Dict]]) -> List[Dict]:
+        # all conversations at once, the model's own concurrency cap decides how many run together
+        return list(await asyncio.gather(*(self.achat_completion(messages) for messages in conversations)))
+
+    def chat_completion_many(self, conversations: List[List[Dict]]) -> List[Dict]:
+        # for synchronous callers, not from inside a running event loop
+        return asyncio.run_coroutine_threadsafe(self.achat_completion_many(conversations), batch_loop()).result()
+
+    def stream_chat_completion(self, messages: List[Dict]) -> Iterator[str]:
+        yield self.chat_completion(messages)['choices'][0]['message']['content']
+
+    async def astream_chat_completion(self, messages: List[Dict]) -> AsyncIterator[str]:
+        response = await self.achat_completion(messages)
+        yield response['choices'][0]['message']['content']
+
+    async def aimage_generation(self, prompt: str) -> str:
+        return await asyncio.to_thread(self.image_generation, prompt)
+
 
 class OpenAIModel(ModelInterface):
-    def __init__(self, api_key: str, model_engine: str, image_size: str = '512x512'):
-        openai.api_key = api_key
+    # Rate limits and 5xx are retried by the OpenAI client itself (max_retries, exponential backoff),
+    # every call has its own timeout and the async calls share a concurrency cap.
+    def __init__(self, api_key: str, model_engine: str, image_size: str = '512x512', timeout: float = 30,
+                 max_retries: int = 3, concurrency: int = 5, base_url: str = None):
+        self.api_key = api_key
+        self.base_url = base_url
         self.model_engine = model_engine
         self.image_size = image_size
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.concurrency = concurrency
+        self._client = None
+        # event loop -> (AsyncOpenAI client, concurrency semaphore): the uvicorn loop and the batch loop
+        self._async = {}
+        self._async_lock = threading.Lock()
+
+    @property
+    def client(self) -> openai.OpenAI:
+        # built on first use, the OpenAI client refuses to start without an API key
+        if self._client is None:
+            # explicit httpx client, openai 1.54 still passes `proxies` which httpx 0.28 no longer accepts
+            self._client = openai.OpenAI(api_key=self.api_key, timeout=self.timeout, max_retries=self.max_retries,
+                                         base_url=self.base_url, http_client=httpx.Client(timeout=self.timeout))
+        return self._client
+
+    def _async_for_loop(self):
+        # pooled connections and the semaphore belong to one event loop, each loop gets its own pair for
+        # its whole life; the pairs of loops that were closed are dropped
+        loop = asyncio.get_running_loop()
+        with self._async_lock:
+            pair = self._async.get(loop)
+            if pair is None:
+                for closed in [other for other in self._async if other.is_closed()]:
+                    del self._async[closed]
+                client = openai.AsyncOpenAI(api_key=self.api_key, timeout=self.timeout, max_retries=self.max_retries,
+                                            base_url=self.base_url, http_client=httpx.AsyncClient(timeout=self.timeout))
+                pair = self._async[loop] = (client, asyncio.Semaphore(self.concurrency))
+            return pair
+
+    @property
+    def async_client(self) -> openai.AsyncOpenAI:
+        return self._async_for_loop()[0]
+
+    @property
+    def _semaphore(self) -> asyncio.Semaphore:
+        return self._async_for_loop()[1]
+
+    async def aclose(self):
+        # closes the client of the running loop, the app calls it on shutdown
+        with self._async_lock:
+            pair = self._async.pop(asyncio.get_running_loop(), None)
+        if pair is not None:
+            await pair[0].close()
+
+    @contextmanager
+    def _measure(self, operation):
+        # latency, in-flight and failures of one OpenAI call (a stream: until its last chunk)
+        started = time.perf_counter()
+        LLM_IN_FLIGHT.inc()
+        try:
+            yield
+        except Exception:
+            LLM_ERRORS.labels(self.model_engine, operation).inc()
+            raise
+        finally:
+            LLM_IN_FLIGHT.dec()
+            LLM_LATENCY.labels(self.model_engine, operation).observe(time.perf_counter() - started)
 
-    def chat_completion(self, messages) -> str:
-        response = openai.ChatCompletion.create(
-            model=self.model_engine,
-            messages=messages
-        )
+    def chat_completion(self, messages) -> Dict:
+        with self._measure('chat'):
+            response = self.client.chat.completions.create(
+                model=self.model_engine,
+                messages=messages
+            )
+        # plain dict, callers read response['choices'][0]['message']['content']
+        response = response.model_dump()
+        observe_tokens(self.model_engine, response)
         return response
 
+    async def achat_completion(self, messages) -> Dict:
+        client = self.async_client
+        async with self._semaphore:
+            with self._measure('chat'):
+                response = await client.chat.completions.create(
+                    model=self.model_engine,
+                    messages=messages
+                )
+        response = response.model_dump()
+        observe_tokens(self.model_engine, response)
+        return response
+
+    def stream_chat_completion(self, messages) -> Iterator[str]:
+        with self._measure('chat_stream'):
+            stream = self.client.chat.completions.create(
+                model=self.model_engine,
+                messages=messages,
+                stream=True
+            )
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+    async def astream_chat_completion(self, messages) -> AsyncIterator[str]:
+        client = self.async_client
+        async with self._semaphore:
+            with self._measure('chat_stream'):
+                stream = await client.chat.completions.create(
+                    model=self.model_engine,
+                    messages=messages,
+                    stream=True
+                )
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+
     def image_generation(self, prompt: str) -> str:
-        response = openai.Image.create(
-            prompt=prompt,
-            n=1,
-            size=self.image_size
-        )
+        with self._measure('image'):
+            response = self.client.images.generate(
+                prompt=prompt,
+                n=1,
+                size=self.image_size
+            )
         image_url = response.data[0].url
         return image_url
+
+    async def aimage_generation(self, prompt: str) -> str:
+        client = self.async_client
+        async with self._semaphore:
+            with self._measure('image'):
+                response = await client.images.generate(
+                    prompt=prompt,
+                    n=1,
+                    size=self.image_size
+                )
+        return response.data[0].url
+
+
+class CachedModel(ModelInterface):
+    # Serves repeated chat completions from a CompletionCache (src/cache.py), works with any ModelInterface
+    def __init__(self, model: ModelInterface, cache):
+        self.model = model
+        self.cache = cache
+        self.model_engine = getattr(model, 'model_engine', type(model).__name__)
+
+    def chat_completion(self, messages: List[Dict]) -> Dict:
+        key = self.cache.make_key(self.model_engine, messages)
+        response = self.cache.get(key)
+        if response is None:
+            response = self.model.chat_completion(messages)
+            # stored as plain JSON so it can be persisted
+            response = json.loads(json.dumps(response))
+            self.cache.put(key, response)
+        return response
+
+    async def achat_completion(self, messages: List[Dict]) -> Dict:
+        key = self.cache.make_key(self.model_engine, messages)
+        response = await asyncio.to_thread(self.cache.get, key)
+        if response is None:
+            response = json.loads(json.dumps(await self.model.achat_completion(messages)))
+            await asyncio.to_thread(self.cache.put, key, response)
+        return response
+
+    def stream_chat_completion(self, messages: List[Dict]) -> Iterator[str]:
+        key = self.cache.make_key(self.model_engine, messages)
+        response = self.cache.get(key)
+        if response is not None:
+            yield response['choices'][0]['message']['content']
+            return
+        parts = []
+        for part in self.model.stream_chat_completion(messages):
+            parts.append(part)
+            yield part
+        # only a stream that ran to the end is cached
+        self.cache.put(key, {'choices': [{'message': {'role': 'assistant', 'content': ''.join(parts)}}]})
+
+    async def astream_chat_completion(self, messages: List[Dict]) -> AsyncIterator[str]:
+        key = self.cache.make_key(self.model_engine, messages)
+        response = await asyncio.to_thread(self.cache.get, key)
+        if response is not None:
+            yield response['choices'][0]['message']['content']
+            return
+        parts = []
+        async for part in self.model.astream_chat_completion(messages):
+            parts.append(part)
+            yield part
+        await asyncio.to_thread(self.cache.put, key, {'choices': [{'message': {'role': 'assistant', 'content': ''.join(parts)}}]})
+
+    def image_generation(self, prompt: str) -> str:
+        return self.model.image_generation(prompt)
+
+    async def aimage_generation(self, prompt: str) -> str:
+        return await self.model.aimage_generation(prompt)
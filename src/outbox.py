@@ -0,0 +1,124 @@
+import time
+import hashlib
+from typing import Dict, Iterable, List, Optional, Set
+from src.metrics import OPENERS
+
+QUEUED = 'queued'
+SENDING = 'sending'
+SENT = 'sent'
+FAILED = 'failed'
+UNKNOWN = 'unknown'
+
+
+class Outbox:
+    # Every opener goes through a row of the outbox table keyed on (match_id, message), moving
+    # queued -> sending -> sent, failed or unknown. Dispatch only queues matches that have no opener queued, in
+    # flight, sent or unknown yet, and the task takes the row to `sending` before calling Tinder, so a re-run
+    # dispatch or a redelivered task never sends twice.
+    # `failed` means the opener certainly did not go out (Tinder refused it, or the connection was never made)
+    # and the next dispatch may queue it again. `unknown` means it may have gone out (a timeout once the request
+    # was sent, a 5xx, a 2xx without a message id): it is never taken again until `unsettled` rows, together with
+    # rows stuck in `sending` longer than sending_timeout (worker lost mid-call), are checked against the chat.
+    # A row left `queued` longer than queued_timeout lost its task (a broker message dropped, or a dispatch that
+    # failed half way) and is queued again like a failed one; should the old task still arrive, `start` lets only
+    # one of the two send.
+    def __init__(self, table, sending_timeout: float = 600, queued_timeout: float = 3600):
+        self.table = table
+        self.sending_timeout = sending_timeout
+        self.queued_timeout = queued_timeout
+
+    @staticmethod
+    def key(match_id: str, message: str) -> str:
+        return hashlib.sha256(f'{match_id}\n{message}'.encode('utf-8')).hexdigest()
+
+    def busy_matches(self) -> Set[str]:
+        # matches with an opener queued, in flight, sent or maybe sent: indexed lookups, no Tinder call
+        return {row['match_id'] for state in (QUEUED, SENDING, SENT, UNKNOWN) for row in self.table.find('state', state)
+                if not self._lost(row)}
+
+    def _lost(self, row: Dict) -> bool:
+        # queued so long ago that its task is not coming
+        return row.get('state') == QUEUED and time.time() - row.get('updated_at', 0) > self.queued_timeout
+
+    def _claimable(self, row: Optional[Dict]) -> bool:
+        return row is None or row.get('state') == FAILED or self._lost(row)
+
+    def enqueue(self, openers: Iterable[Dict]) -> List[Dict]:
+        # openers: dicts with match_id, person_id and message; returns the ones queued now, each with its key
+        busy = self.busy_matches()
+        now = time.time()
+        candidates = {}
+        for opener in openers:
+            if opener['match_id'] in busy:
+                continue
+            key = self.key(opener['match_id'], opener['message'])
+            candidates[key] = dict(opener, key=key, state=QUEUED, queued_at=now, updated_at=now)
+        claimed = set(self.table.claim_many(candidates, self._claimable))
+        OPENERS.labels('queued').inc(len(claimed))
+        OPENERS.labels('skipped').inc(len(candidates) - len(claimed))
+        return [opener for key, opener in candidates.items() if key in claimed]
+
+    def start(self, key: str, **fields) -> bool:
+        # queued (or never dispatched, for tasks queued before the outbox) -> sending, False if another
+        # attempt holds it or it was already sent
+        now = time.time()
+
+        def can_claim(row):
+            return row is None or row.get('state') == QUEUED or self._claimable(row)
+
+        started = self.table.claim(key, dict(fields, state=SENDING, updated_at=now), can_claim)
+        if not started:
+            OPENERS.labels('duplicate').inc()
+        return started
+
+    def requeue(self, key: str):
+        # a rate limited attempt gives the row back before its retry
+        self.table.update(key, {'state': QUEUED, 'updated_at': time.time()})
+
+    def sent(self, key: str, message_id: str):
+        OPENERS.labels('sent').inc()
+        self.table.update(key, {'state': SENT, 'message_id': message_id, 'sent_at': time.time(), 'updated_at': time.time()})
+
+    def failed(self, key: str, error: str):
+        # certainly not delivered
+        OPENERS.labels('failed').inc()
+        self.table.update(key, {'state': FAILED, 'error': error, 'updated_at': time.time()})
+
+    def unknown(self, key: str, error: str):
+        # maybe delivered, only a look at the chat tells
+        OPENERS.labels('unknown').inc()
+        self.table.update(key, {'state': UNKNOWN, 'error': error, 'updated_at': time.time()})
+
+    def settle(self, key: str, status_code: int, body, retrying: bool = False) -> str:
+        # the outcome of a POST that got an answer from Tinder, returns the new state
+        message_id = body.get('_id') if isinstance(body, dict) else None
+        if 200 <= status_code < 300 and message_id:
+            self.sent(key, message_id)
+            return SENT
+        if status_code == 429 and retrying:
+            # refused before it was processed, the caller sends it again
+            self.requeue(key)
+            return QUEUED
+        if 400 <= status_code < 500:
+            self.failed(key, f'HTTP {status_code}')
+            return FAILED
+        self.unknown(key, f'HTTP {status_code} without a message id')
+        return UNKNOWN
+
+    def unsettled(self) -> List[Dict]:
+        # rows that may or may not have gone out: unknown ones and the ones a lost worker left in `sending`
+        stuck = [row for row in self.table.find('state', SENDING)
+                 if time.time() - row.get('updated_at', 0) > self.sending_timeout]
+        return self.table.find('state', UNKNOWN) + stuck
+
+    def reconcile(self, row: Dict, messages: Iterable[Dict]) -> str:
+        # messages: the chat as Tinder returns it; the opener is there if it went out
+        for message in messages:
+            if message.get('to') == row.get('person_id') and message.get('message') == row.get('message'):
+                self.sent(row['key'], message['_id'])
+                return SENT
+        self.failed(row['key'], 'not found in the chat')
+        return FAILED
+
+    def get(self, key: str) -> Optional[Dict]:
+        return self.table.get(key)
@@ -0,0 +1,163 @@
+import time
+import heapq
+import asyncio
+import itertools
+from src.logger import logger
+from src.metrics import POLLS, POLL_INTERVAL, POLL_SKIPPED
+from src.replier import SENT, ACTIVE
+from src.ratelimit import CallBudget, RateLimited
+
+
+class CountingAPI:
+    # forwards to the Tinder client and counts its calls, the chatrooms built on it send through it too;
+    # every call, replies included, is charged to the budget before it goes out and refused once it is spent
+    def __init__(self, api, budget: CallBudget = None, now: float = 0.0):
+        self._api = api
+        self.budget = budget
+        self.now = now
+        self.calls = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        if not asyncio.iscoroutinefunction(attr):
+            return attr
+
+        async def call(*args, **kwargs):
+            if self.budget is not None:
+                if self.budget.available(self.now) <= 0:
+                    POLL_SKIPPED.inc()
+                    raise RateLimited(self.budget.retry_in(self.now))
+                self.budget.spend(1, self.now)
+            self.calls += 1
+            return await attr(*args, **kwargs)
+        return call
+
+
+class HotMatch:
+    __slots__ = ('match', 'interval', 'due')
+
+    def __init__(self, match, interval, due):
+        self.match = match
+        self.interval = interval
+        self.due = due
+
+
+class AdaptivePoller:
+    # Replaces the fixed 5-minute reply cycle with two speeds:
+    # - the match listing (one call covering match_count chats, only moved chats are pulled) runs every
+    #   listing_interval, the fixed cycle's own interval, so a quiet chat never waits longer than it did before;
+    # - a chat found active (new messages, or we just answered) is hot: it sits in a priority queue by due time
+    #   and is pulled directly every min_interval, the interval growing by `backoff` each time nothing new came in,
+    #   until it reaches the listing's own interval and the listing covers it again. When several hot chats are due
+    #   at once, a listing is cheaper than pulling each of them and is run instead.
+    # Direct polls only spend what is left of the call budget, the most overdue chats first, two calls a chat: the
+    # pull and the reply it may need. A reply past the budget is refused and left to the next listing.
+    def __init__(self, pipeline, min_interval: float = 60, backoff: float = 4.0, listing_interval: float = 300,
+                 budget: CallBudget = None, clock=time.monotonic):
+        self.pipeline = pipeline
+        self.min_interval = min_interval
+        self.backoff = backoff
+        self.base_listing_interval = listing_interval
+        self.listing_interval = listing_interval
+        self.budget = budget or CallBudget()
+        self.clock = clock
+        self._listing_due = 0.0
+        self._last_activity = {}
+        self._hot = {}
+        self._heap = []
+        self._seq = itertools.count()
+
+    def hot_count(self) -> int:
+        return len(self._hot)
+
+    def _schedule(self, hot: HotMatch, interval: float, now: float):
+        hot.interval = interval
+        hot.due = now + interval
+        POLL_INTERVAL.observe(interval)
+        heapq.heappush(self._heap, (hot.due, interval, next(self._seq), hot.match.match_id))
+
+    def _update(self, matches, outcomes, now):
+        for match in matches:
+            outcome = outcomes.get(match.match_id)
+            hot = self._hot.get(match.match_id)
+            if outcome is not None:
+                POLLS.labels(outcome).inc()
+            if outcome in (SENT, ACTIVE):
+                if hot is None:
+                    hot = self._hot[match.match_id] = HotMatch(match, self.min_interval, now)
+                hot.match = match
+                self._schedule(hot, self.min_interval, now)
+            elif hot is not None:
+                # a poll cut by the deadline keeps its interval
+                interval = hot.interval if outcome is None else hot.interval * self.backoff
+                if interval >= self.listing_interval:
+                    del self._hot[match.match_id]
+                else:
+                    self._schedule(hot, interval, now)
+
+    async def _poll(self, api, profile, matches, force):
+        try:
+            return await asyncio.wait_for(self.pipeline.poll(api, profile, matches, force=force), self.pipeline.deadline)
+        except asyncio.TimeoutError:
+            logger.warning(f'poller: {len(matches)} chats cut at the {self.pipeline.deadline}s deadline')
+            return {}
+
+    async def _listing(self, api, profile, now):
+        matches, _ = await api.matches(count=self.pipeline.match_count, message=1)
+        moved = [match.match_id for match in matches
+                 if self._last_activity.get(match.match_id, '') != match.last_activity_date]
+        # a moved chat costs a pull and maybe a reply, the ones past the budget keep their old activity and wait
+        # for the next listing
+        deferred = set(moved[max(0, self.budget.available(now)) // 2:])
+        POLL_SKIPPED.inc(len(deferred))
+        self._last_activity = {
+            match.match_id: self._last_activity.get(match.match_id, '') if match.match_id in deferred
+            else match.last_activity_date for match in matches
+        }
+        # hot chats that left the listing went quiet long ago
+        for match_id in [match_id for match_id in self._hot if match_id not in self._last_activity]:
+            del self._hot[match_id]
+        matches = [match for match in matches if match.match_id not in deferred]
+        self._update(matches, await self._poll(api, profile, matches, force=False), now)
+        # chats left behind by the budget are listed again soon, the listing never stretches past its own interval
+        self.listing_interval = self.min_interval if deferred else self.base_listing_interval
+        self._listing_due = now + self.listing_interval
+        return len(matches)
+
+    async def _poll_hot(self, api, profile, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            hot = self._hot.get(entry[3])
+            # entries left behind by a reschedule or a cooled chat
+            if hot is not None and hot.due == entry[0]:
+                due.append((entry, hot))
+        if len(due) > 1:
+            # one listing tells which of them moved for the price of one pull, only those are pulled next
+            for entry, _ in due:
+                heapq.heappush(self._heap, entry)
+            if self.budget.available(now) <= 0:
+                POLL_SKIPPED.inc(len(due))
+                return 0
+            return await self._listing(api, profile, now)
+        available = max(0, self.budget.available(now)) // 2
+        for entry, _ in due[available:]:
+            heapq.heappush(self._heap, entry)
+        POLL_SKIPPED.inc(max(0, len(due) - available))
+        matches = [hot.match for _, hot in due[:available]]
+        if matches:
+            self._update(matches, await self._poll(api, profile, matches, force=True), now)
+        return len(matches)
+
+    async def tick(self, tinder_api, profile):
+        # run every few seconds: either the listing is due, or the hot chats that are
+        now = self.clock()
+        api = CountingAPI(tinder_api, self.budget, now)
+        if now >= self._listing_due:
+            if self.budget.available(now) > 0:
+                polled = await self._listing(api, profile, now)
+            else:
+                polled = 0
+        else:
+            polled = await self._poll_hot(api, profile, now)
+        return {'polled': polled, 'calls': api.calls, 'hot': len(self._hot), 'listing_interval': self.listing_interval}
@@ -0,0 +1,143 @@
+import time
+import asyncio
+from collections import deque
+from src.metrics import RATE_LIMIT_WAIT, RATE_LIMITED, RATE_LIMIT_RATE
+
+# Token bucket shared by every worker through Redis. A caller always reserves its token, even when the
+# bucket is empty, and is told how long to wait for it; a reservation further out than `max_wait` is
+# refused so the task can be retried later instead of holding a worker slot.
+ACQUIRE_SCRIPT = """
+local bucket_key, rate_key = KEYS[1], KEYS[2]
+local default_rate, capacity, max_wait = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local rate = tonumber(redis.call('GET', rate_key)) or default_rate
+local bucket = redis.call('HMGET', bucket_key, 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens < 1 then
+    wait = (1 - tokens) / rate
+end
+if wait > max_wait then
+    redis.call('HSET', bucket_key, 'tokens', tokens, 'ts', now)
+    return {0, tostring(wait)}
+end
+redis.call('HSET', bucket_key, 'tokens', tokens - 1, 'ts', now)
+redis.call('EXPIRE', bucket_key, 86400)
+return {1, tostring(wait)}
+"""
+
+# 429: halve the shared rate (never below min_rate). Success: claw back `step` of the default rate.
+ADJUST_SCRIPT = """
+local rate_key = KEYS[1]
+local default_rate, min_rate, factor, step = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local current = tonumber(redis.call('GET', rate_key))
+if current == nil then
+    if factor >= 1 then
+        return tostring(default_rate)
+    end
+    current = default_rate
+end
+local rate = math.max(min_rate, math.min(default_rate, current * factor + step))
+if rate >= default_rate then
+    redis.call('DEL', rate_key)
+else
+    redis.call('SET', rate_key, rate, 'EX', 3600)
+end
+return tostring(rate)
+"""
+
+
+class RateLimited(Exception):
+    def __init__(self, wait: float):
+        super().__init__(f'Rate limited, retry in {wait:.1f}s')
+        self.wait = wait
+
+
+class RateLimiter:
+    def __init__(self, redis_client, name: str = 'tinder', rate: float = 0.2, burst: int = 1, min_rate: float = 0.02,
+                 max_wait: float = 30, recovery: float = 0.05):
+        self.redis = redis_client
+        self.bucket_key = f'ratelimit:{name}:bucket'
+        self.rate_key = f'ratelimit:{name}:rate'
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_wait = max_wait
+        self.recovery = recovery
+        self._acquire = redis_client.register_script(ACQUIRE_SCRIPT)
+        self._adjust = redis_client.register_script(ADJUST_SCRIPT)
+
+    def _reserve(self) -> float:
+        granted, wait = self._acquire(keys=[self.bucket_key, self.rate_key], args=[self.rate, self.burst, self.max_wait])
+        wait = float(wait)
+        if not granted:
+            RATE_LIMITED.inc()
+            raise RateLimited(wait)
+        RATE_LIMIT_WAIT.observe(wait)
+        return wait
+
+    def acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def aacquire(self):
+        # the reservation is a Redis round trip made in a thread, the wait for the token an asyncio sleep
+        wait = await asyncio.to_thread(self._reserve)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def current_rate(self) -> float:
+        rate = self.redis.get(self.rate_key)
+        return float(rate) if rate is not None else self.rate
+
+    def observe(self, status_code: int):
+        # called with every Tinder response status
+        if status_code == 429:
+            rate = self._adjust(keys=[self.rate_key], args=[self.rate, self.min_rate, 0.5, 0])
+        elif status_code < 400:
+            rate = self._adjust(keys=[self.rate_key], args=[self.rate, self.min_rate, 1, self.rate * self.recovery])
+        else:
+            return
+        RATE_LIMIT_RATE.set(float(rate))
+
+    async def aobserve(self, status_code: int):
+        await asyncio.to_thread(self.observe, status_code)
+
+
+class CallBudget:
+    # at most `calls` Tinder calls in any `interval` seconds, charged with what was really spent
+    def __init__(self, calls: int = 30, interval: float = 60):
+        self.calls = calls
+        self.interval = interval
+        self._spent = deque()
+
+    def available(self, now: float) -> int:
+        while self._spent and self._spent[0][0] <= now - self.interval:
+            self._spent.popleft()
+        return self.calls - sum(count for _, count in self._spent)
+
+    def spend(self, count: int, now: float):
+        if count:
+            self._spent.append((now, count))
+
+    def refund(self, count: int, now: float):
+        # calls charged at `now` that never went out
+        for i in reversed(range(len(self._spent))):
+            if count <= 0:
+                break
+            at, spent = self._spent[i]
+            if at == now:
+                taken = min(count, spent)
+                count -= taken
+                if taken == spent:
+                    del self._spent[i]
+                else:
+                    self._spent[i] = (at, spent - taken)
+
+    def retry_in(self, now: float) -> float:
+        # seconds until the oldest call leaves the window
+        return max(0.0, self._spent[0][0] + self.interval - now) if self._spent else 0.0
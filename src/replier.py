@@ -0,0 +1,126 @@
+import time
+import asyncio
+import datetime
+from src.logger import logger
+from src.metrics import REPLY_CYCLE, REPLIES_SENT
+from src.ratelimit import RateLimited
+
+# what _reply did with one match: answered it, saw new messages that need no answer, or found nothing new
+SENT = 'sent'
+ACTIVE = 'active'
+IDLE = 'idle'
+
+
+class ReplyPipeline:
+    # One reply cycle: chatrooms are fetched and answered concurrently, Tinder calls and LLM calls
+    # each under their own cap, and the whole cycle is cut at `deadline` seconds.
+    def __init__(self, chatgpt, dialog, sync=None, language: str = None, fetch_concurrency: int = 5,
+                 llm_concurrency: int = 3, deadline: float = 240, match_count: int = 50):
+        self.chatgpt = chatgpt
+        self.dialog = dialog
+        self.sync = sync
+        self.language = language
+        self.fetch_concurrency = fetch_concurrency
+        self.llm_concurrency = llm_concurrency
+        self.deadline = deadline
+        self.match_count = match_count
+        self._running = False
+
+    async def run(self, tinder_api, profile):
+        # a cycle still going when the next one is due is left alone instead of doubling the traffic
+        if self._running:
+            logger.warning('reply_messages: previous cycle still running, skipping this one')
+            REPLY_CYCLE.labels('skipped').observe(0)
+            return None
+        self._running = True
+        started = time.monotonic()
+        outcome = 'error'
+        try:
+            sent = await asyncio.wait_for(self._cycle(tinder_api, profile), self.deadline)
+            outcome = 'done'
+            REPLIES_SENT.inc(sent)
+            return sent
+        except asyncio.TimeoutError:
+            outcome = 'timeout'
+            logger.warning(f'reply_messages: cycle cut at the {self.deadline}s deadline')
+            return None
+        finally:
+            self._running = False
+            REPLY_CYCLE.labels(outcome).observe(time.monotonic() - started)
+            logger.info(f'reply_messages: cycle took {time.monotonic() - started:.1f}s')
+
+    async def _cycle(self, tinder_api, profile):
+        fetch_semaphore = asyncio.Semaphore(self.fetch_concurrency)
+        llm_semaphore = asyncio.Semaphore(self.llm_concurrency)
+        matches, _ = await tinder_api.matches(count=self.match_count, message=1)
+        outcomes = await self._reply_all(tinder_api, profile, matches, fetch_semaphore, llm_semaphore)
+        return sum(1 for outcome in outcomes.values() if outcome == SENT)
+
+    async def poll(self, tinder_api, profile, matches, force: bool = False):
+        # answer just these matches, {match_id: sent/active/idle/error}; force pulls their messages
+        # even when the listing they came from shows no activity (it may be minutes old)
+        outcomes = await self._reply_all(tinder_api, profile, matches, asyncio.Semaphore(self.fetch_concurrency),
+                                         asyncio.Semaphore(self.llm_concurrency), force)
+        REPLIES_SENT.inc(sum(1 for outcome in outcomes.values() if outcome == SENT))
+        return outcomes
+
+    async def _reply_all(self, tinder_api, profile, matches, fetch_semaphore, llm_semaphore, force=False):
+        results = await asyncio.gather(
+            *(self._reply(tinder_api, profile, match, fetch_semaphore, llm_semaphore, force) for match in matches),
+            return_exceptions=True
+        )
+        outcomes = {}
+        for match, result in zip(matches, results):
+            if isinstance(result, RateLimited):
+                # refused before it reached Tinder, the chat still needs attention and is answered later
+                logger.warning(f'reply_messages: match {match.match_id} left for later: {result}')
+                result = 'error'
+            elif isinstance(result, Exception):
+                logger.error(f'reply_messages: match {match.match_id} failed: {result!r}')
+                result = 'error'
+            outcomes[match.match_id] = result
+        return outcomes
+
+    async def _reply(self, tinder_api, profile, match, fetch_semaphore, llm_semaphore, force=False):
+        outcome = IDLE
+        if self.sync is None:
+            async with fetch_semaphore:
+                chatroom = await tinder_api.get_messages(match.match_id)
+        else:
+            # quiet chats are skipped without a Tinder call, the others only pull what is new
+            cursor = self.sync.cursor(match.match_id)
+            if force or self.sync.has_activity(match, cursor):
+                async with fetch_semaphore:
+                    # the first sync of a chat downloads its history, that is not activity
+                    if await self.sync.pull(tinder_api, match, cursor) and cursor is not None:
+                        outcome = ACTIVE
+            elif not self.sync.needs_attention(cursor, profile.id):
+                return IDLE
+            chatroom = self.sync.chatroom(match.match_id, tinder_api)
+        lastest_message = chatroom.get_lastest_message()
+        if not lastest_message:
+            return outcome
+        if lastest_message.from_id == profile.id:
+            from_user_id = lastest_message.from_id
+            to_user_id = lastest_message.to_id
+            last_message = 'me'
+        else:
+            from_user_id = lastest_message.to_id
+            to_user_id = lastest_message.from_id
+            last_message = 'other'
+        # sent_date is parsed from Tinder's UTC timestamps
+        if last_message != 'other' and lastest_message.sent_date + datetime.timedelta(days=5) >= datetime.datetime.utcnow():
+            return outcome
+
+        content = self.dialog.generate_input(from_user_id, to_user_id, chatroom.messages[::-1])
+        interests = ', '.join(profile.user_interests)
+        async with llm_semaphore:
+            response = await self.chatgpt.aget_response(interests, profile.bio, content, self.language)
+        logger.info(f'Content: {content}, Reply: {response}')
+        if not response:
+            return outcome
+        if response.startswith('[Sender]'):
+            response = response[8:]
+        async with fetch_semaphore:
+            await chatroom.send(response, from_user_id, to_user_id)
+        return SENT
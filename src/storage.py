@@ -0,0 +1,586 @@
+import os
+import sys
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+from tinydb import TinyDB, Query  # type: ignore
+
+from src.metrics import timed_storage
+
+# key field, indexed fields, composite (field, order field) indexes for `latest` and histogram fields
+# (counts per whole unit, kept up to date on every write) of every table, shared by all backends
+TABLE_SCHEMAS = {
+    'matches': {'key': 'match_id', 'indexes': ('person_id', 'distance', 'birth_date'), 'histograms': ('distance',)},
+    'profile': {'key': 'id', 'indexes': ()},
+    'messages': {'key': '_id', 'indexes': ('match_id', 'sent_date'), 'composite': (('match_id', 'sent_date'),)},
+    'sync': {'key': 'match_id', 'indexes': ()},
+    'completions': {'key': 'key', 'indexes': ('stored_at',)},
+    'exports': {'key': 'match_id', 'indexes': ()},
+    'outbox': {'key': 'key', 'indexes': ('match_id', 'state')},
+}
+
+
+class Table:
+    # Every backend stores plain dict rows keyed on one field (match_id for matches).
+    # Fields listed in `indexes` can be looked up and range-scanned without decoding every row.
+    def __init__(self, name: str, key: str, indexes: Iterable[str] = (), histograms: Iterable[str] = (),
+                 composite: Iterable[Iterable[str]] = ()):
+        self.name = name
+        self.key = key
+        self.indexes = tuple(indexes)
+        self.histograms = tuple(histograms)
+        self.composite = tuple(tuple(pair) for pair in composite)
+
+    def get(self, key) -> Optional[Dict]:
+        raise NotImplementedError
+
+    def contains(self, key) -> bool:
+        return self.get(key) is not None
+
+    def insert(self, row: Dict):
+        raise NotImplementedError
+
+    def upsert(self, row: Dict):
+        raise NotImplementedError
+
+    def update(self, key, fields: Dict) -> bool:
+        raise NotImplementedError
+
+    def bulk_upsert(self, rows: Iterable[Dict]) -> Dict[str, int]:
+        # merge a whole page of rows and report what actually changed
+        counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+        for row in rows:
+            current = self.get(row[self.key])
+            if current is None:
+                self.insert(row)
+                counts['inserted'] += 1
+            elif any(current.get(field) != value for field, value in row.items()):
+                self.update(row[self.key], row)
+                counts['updated'] += 1
+            else:
+                counts['unchanged'] += 1
+        return counts
+
+    def update_many(self, updates: Dict[str, Dict]) -> int:
+        # {key: fields}, rows that do not exist are skipped
+        return sum(1 for key, fields in updates.items() if self.update(key, fields))
+
+    def claim_many(self, claims: Dict[str, Dict], can_claim: Callable[[Optional[Dict]], bool]) -> List[str]:
+        # {key: fields}: merge the fields into every row can_claim accepts (it gets None for a missing row),
+        # atomically against other claimers, and return the keys claimed
+        claimed = []
+        for key, fields in claims.items():
+            current = self.get(key)
+            if can_claim(current):
+                self.upsert({**(current or {}), **fields, self.key: key})
+                claimed.append(key)
+        return claimed
+
+    def claim(self, key, fields: Dict, can_claim: Callable[[Optional[Dict]], bool]) -> bool:
+        return bool(self.claim_many({key: fields}, can_claim))
+
+    def remove(self, key) -> bool:
+        raise NotImplementedError
+
+    def truncate(self):
+        raise NotImplementedError
+
+    def iter(self, after=None, limit: Optional[int] = None) -> Iterator[Dict]:
+        # rows in key order, starting after the `after` key, read lazily where the backend allows it
+        raise NotImplementedError
+
+    def all(self) -> List[Dict]:
+        return list(self.iter())
+
+    def find(self, field: str, value) -> List[Dict]:
+        return [row for row in self.iter() if row.get(field) == value]
+
+    def range(self, field: str, lo=None, hi=None) -> Iterator[Dict]:
+        # rows ordered by `field`, lo is inclusive, hi is exclusive and rows without the field are left out
+        rows = [row for row in self.iter() if _in_range(row.get(field), lo, hi)]
+        return iter(sorted(rows, key=lambda row: row[field]))
+
+    def missing(self, field: str) -> Iterator[Dict]:
+        # rows where the field is absent or null
+        return (row for row in self.iter() if row.get(field) is None)
+
+    def latest(self, field: str, value, order_by: str, limit: int) -> List[Dict]:
+        # the `limit` rows with field == value that sort last on `order_by`, last first
+        return sorted(self.find(field, value), key=lambda row: row.get(order_by) or '', reverse=True)[:limit]
+
+    def count(self, field: Optional[str] = None, lo=None, hi=None) -> int:
+        if field is None:
+            return sum(1 for _ in self.iter())
+        return sum(1 for row in self.iter() if _in_range(row.get(field), lo, hi))
+
+    def histogram(self, field: str) -> Dict[Optional[int], int]:
+        # {whole unit (floor of the value): rows}, rows without the field are counted under None
+        counts = {}
+        for row in self.iter():
+            value = row.get(field)
+            bucket = int(value) if value is not None else None
+            counts[bucket] = counts.get(bucket, 0) + 1
+        return counts
+
+    def __len__(self):
+        return self.count()
+
+
+def _in_range(value, lo, hi) -> bool:
+    if value is None:
+        return False
+    if lo is not None and value < lo:
+        return False
+    if hi is not None and value >= hi:
+        return False
+    return True
+
+
+class SQLiteTable(Table):
+    def __init__(self, storage: 'SQLiteStorage', name: str, key: str, indexes: Iterable[str] = (),
+                 histograms: Iterable[str] = (), composite: Iterable[Iterable[str]] = ()):
+        super().__init__(name, key, indexes, histograms, composite)
+        self.storage = storage
+        self._create()
+        for field in self.histograms:
+            self._create_histogram(field)
+
+    def _create(self):
+        with self.storage.transaction() as conn:
+            conn.execute(f'CREATE TABLE IF NOT EXISTS "{self.name}" (key TEXT PRIMARY KEY, data TEXT NOT NULL)')
+            columns = {row[1] for row in conn.execute(f'PRAGMA table_info("{self.name}")')}
+            for field in self.indexes:
+                if field not in columns:
+                    # a newly indexed field is backfilled from the stored rows
+                    conn.execute(f'ALTER TABLE "{self.name}" ADD COLUMN "{field}"')
+                    conn.execute(f'UPDATE "{self.name}" SET "{field}" = json_extract(data, ?)', (f'$.{field}',))
+                conn.execute(f'CREATE INDEX IF NOT EXISTS "{self.name}_{field}" ON "{self.name}" ("{field}")')
+            for field, order_by in self.composite:
+                # both are in `indexes`, so their columns exist
+                conn.execute(f'CREATE INDEX IF NOT EXISTS "{self.name}_{field}_{order_by}" '
+                             f'ON "{self.name}" ("{field}", "{order_by}")')
+
+    def _create_histogram(self, field: str):
+        # Triggers keep per-unit counts in the same transaction as the write, so reading the totals
+        # never scans the table. Bucket -1 holds the rows where the field is missing.
+        histogram = f'{self.name}_{field}_histogram'
+        bucket = lambda row: f'COALESCE(CAST({row}."{field}" AS INTEGER), -1)'
+        with self.storage.transaction() as conn:
+            exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (histogram,)).fetchone()
+            if exists:
+                return
+            conn.execute(f'CREATE TABLE "{histogram}" (bucket INTEGER PRIMARY KEY, count INTEGER NOT NULL)')
+            conn.execute(f'INSERT INTO "{histogram}" (bucket, count) '
+                         f'SELECT {bucket(self.name)}, COUNT(*) FROM "{self.name}" GROUP BY 1')
+            increment = (f'INSERT INTO "{histogram}" (bucket, count) VALUES ({bucket("NEW")}, 1) '
+                         f'ON CONFLICT(bucket) DO UPDATE SET count = count + 1;')
+            decrement = f'UPDATE "{histogram}" SET count = count - 1 WHERE bucket = {bucket("OLD")};'
+            conn.execute(f'CREATE TRIGGER "{histogram}_insert" AFTER INSERT ON "{self.name}" BEGIN {increment} END')
+            conn.execute(f'CREATE TRIGGER "{histogram}_delete" AFTER DELETE ON "{self.name}" BEGIN {decrement} END')
+            conn.execute(f'CREATE TRIGGER "{histogram}_update" AFTER UPDATE OF "{field}" ON "{self.name}" '
+                         f'WHEN {bucket("OLD")} != {bucket("NEW")} BEGIN {decrement} {increment} END')
+
+    def _column(self, field: str) -> str:
+        if field == self.key:
+            return 'key'
+        if field in self.indexes:
+            return f'"{field}"'
+        return f"json_extract(data, '$.{field}')"
+
+    def _values(self, row: Dict):
+        return [str(row[self.key]), json.dumps(row, ensure_ascii=False)] + [row.get(field) for field in self.indexes]
+
+    def _insert_sql(self, replace: bool = False) -> str:
+        columns = ['key', 'data'] + [f'"{field}"' for field in self.indexes]
+        sql = f'INSERT INTO "{self.name}" ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})'
+        if replace:
+            # an upsert rather than INSERT OR REPLACE, so update triggers see the old and new values
+            sql += ' ON CONFLICT(key) DO UPDATE SET ' + ', '.join(f'{column} = excluded.{column}' for column in columns[1:])
+        return sql
+
+    def _write(self, conn, row: Dict, replace: bool = False):
+        conn.execute(self._insert_sql(replace), self._values(row))
+
+    def _get(self, conn, key) -> Optional[Dict]:
+        found = conn.execute(f'SELECT data FROM "{self.name}" WHERE key = ?', (str(key),)).fetchone()
+        return json.loads(found[0]) if found else None
+
+    @timed_storage('get')
+    def get(self, key) -> Optional[Dict]:
+        return self._get(self.storage.connection(), key)
+
+    @timed_storage('contains')
+    def contains(self, key) -> bool:
+        conn = self.storage.connection()
+        return conn.execute(f'SELECT 1 FROM "{self.name}" WHERE key = ?', (str(key),)).fetchone() is not None
+
+    @timed_storage('insert')
+    def insert(self, row: Dict):
+        with self.storage.transaction() as conn:
+            self._write(conn, row)
+
+    @timed_storage('upsert')
+    def upsert(self, row: Dict):
+        # merge into the stored row so fields filled in later (distance, bio...) are kept
+        with self.storage.transaction() as conn:
+            current = self._get(conn, row[self.key]) or {}
+            current.update(row)
+            self._write(conn, current, replace=True)
+
+    @timed_storage('update')
+    def update(self, key, fields: Dict) -> bool:
+        with self.storage.transaction() as conn:
+            current = self._get(conn, key)
+            if current is None:
+                return False
+            current.update(fields)
+            self._write(conn, current, replace=True)
+            return True
+
+    @timed_storage('bulk_upsert')
+    def bulk_upsert(self, rows: Iterable[Dict]) -> Dict[str, int]:
+        # one SELECT for the keys of the page and one transaction for every changed row
+        rows = {str(row[self.key]): row for row in rows}
+        counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+        if not rows:
+            return counts
+        with self.storage.transaction() as conn:
+            existing = {}
+            keys = list(rows)
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                cursor = conn.execute(
+                    f'SELECT key, data FROM "{self.name}" WHERE key IN ({", ".join("?" * len(chunk))})', chunk)
+                existing.update((key, json.loads(data)) for key, data in cursor)
+            changed = []
+            for key, row in rows.items():
+                current = existing.get(key)
+                if current is None:
+                    changed.append(row)
+                    counts['inserted'] += 1
+                elif any(current.get(field) != value for field, value in row.items()):
+                    current.update(row)
+                    changed.append(current)
+                    counts['updated'] += 1
+                else:
+                    counts['unchanged'] += 1
+            if changed:
+                conn.executemany(self._insert_sql(replace=True), [self._values(row) for row in changed])
+        return counts
+
+    @timed_storage('update_many')
+    def update_many(self, updates: Dict[str, Dict]) -> int:
+        updated = 0
+        with self.storage.transaction() as conn:
+            for key, fields in updates.items():
+                current = self._get(conn, key)
+                if current is not None:
+                    current.update(fields)
+                    self._write(conn, current, replace=True)
+                    updated += 1
+        return updated
+
+    @timed_storage('claim_many')
+    def claim_many(self, claims: Dict[str, Dict], can_claim: Callable[[Optional[Dict]], bool]) -> List[str]:
+        # read and write in one BEGIN IMMEDIATE transaction, so two processes never claim the same row
+        claimed = []
+        if not claims:
+            return claimed
+        with self.storage.transaction() as conn:
+            existing = {}
+            keys = [str(key) for key in claims]
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                cursor = conn.execute(
+                    f'SELECT key, data FROM "{self.name}" WHERE key IN ({", ".join("?" * len(chunk))})', chunk)
+                existing.update((key, json.loads(data)) for key, data in cursor)
+            rows = []
+            for key, fields in claims.items():
+                current = existing.get(str(key))
+                if can_claim(current):
+                    rows.append({**(current or {}), **fields, self.key: key})
+                    claimed.append(key)
+            if rows:
+                conn.executemany(self._insert_sql(replace=True), [self._values(row) for row in rows])
+        return claimed
+
+    @timed_storage('remove')
+    def remove(self, key) -> bool:
+        with self.storage.transaction() as conn:
+            return conn.execute(f'DELETE FROM "{self.name}" WHERE key = ?', (str(key),)).rowcount > 0
+
+    @timed_storage('truncate')
+    def truncate(self):
+        with self.storage.transaction() as conn:
+            conn.execute(f'DELETE FROM "{self.name}"')
+
+    def iter(self, after=None, limit: Optional[int] = None) -> Iterator[Dict]:
+        sql, params = f'SELECT data FROM "{self.name}"', []
+        if after is not None:
+            sql += ' WHERE key > ?'
+            params.append(str(after))
+        sql += ' ORDER BY key'
+        if limit is not None:
+            # SQLite reads a negative LIMIT as no limit at all
+            sql += ' LIMIT ?'
+            params.append(max(0, int(limit)))
+        # the cursor is consumed row by row, the table is never loaded as a whole
+        for (data,) in self.storage.connection().execute(sql, params):
+            yield json.loads(data)
+
+    @timed_storage('find')
+    def find(self, field: str, value) -> List[Dict]:
+        cursor = self.storage.connection().execute(
+            f'SELECT data FROM "{self.name}" WHERE {self._column(field)} = ?', (value,))
+        return [json.loads(data) for (data,) in cursor]
+
+    def _where_range(self, field: str, lo, hi):
+        column = self._column(field)
+        clauses, params = [f'{column} IS NOT NULL'], []
+        if lo is not None:
+            clauses.append(f'{column} >= ?')
+            params.append(lo)
+        if hi is not None:
+            clauses.append(f'{column} < ?')
+            params.append(hi)
+        return ' AND '.join(clauses), params, column
+
+    def range(self, field: str, lo=None, hi=None) -> Iterator[Dict]:
+        # walks the index on `field`, only the rows inside the range are read and decoded
+        where, params, column = self._where_range(field, lo, hi)
+        cursor = self.storage.connection().execute(
+            f'SELECT data FROM "{self.name}" WHERE {where} ORDER BY {column}', params)
+        return (json.loads(data) for (data,) in cursor)
+
+    @timed_storage('latest')
+    def latest(self, field: str, value, order_by: str, limit: int) -> List[Dict]:
+        # with a composite (field, order_by) index SQLite walks it backwards and stops after `limit` rows,
+        # however many rows share the value
+        cursor = self.storage.connection().execute(
+            f'SELECT data FROM "{self.name}" WHERE {self._column(field)} = ? '
+            f'ORDER BY {self._column(order_by)} DESC LIMIT ?', (value, max(0, int(limit))))
+        return [json.loads(data) for (data,) in cursor]
+
+    def missing(self, field: str) -> Iterator[Dict]:
+        cursor = self.storage.connection().execute(
+            f'SELECT data FROM "{self.name}" WHERE {self._column(field)} IS NULL ORDER BY key')
+        return (json.loads(data) for (data,) in cursor)
+
+    @timed_storage('count')
+    def count(self, field: Optional[str] = None, lo=None, hi=None) -> int:
+        if field is None:
+            return self.storage.connection().execute(f'SELECT COUNT(*) FROM "{self.name}"').fetchone()[0]
+        where, params, _ = self._where_range(field, lo, hi)
+        return self.storage.connection().execute(f'SELECT COUNT(*) FROM "{self.name}" WHERE {where}', params).fetchone()[0]
+
+    @timed_storage('histogram')
+    def histogram(self, field: str) -> Dict[Optional[int], int]:
+        if field not in self.histograms:
+            return super().histogram(field)
+        cursor = self.storage.connection().execute(
+            f'SELECT bucket, count FROM "{self.name}_{field}_histogram" WHERE count > 0')
+        return {(bucket if bucket >= 0 else None): count for bucket, count in cursor}
+
+
+class SQLiteStorage:
+    # SQLite in WAL mode: readers never block, and writers from the API process and the Celery workers
+    # are serialized by BEGIN IMMEDIATE plus busy_timeout instead of overwriting each other's file.
+    def __init__(self, path: str, timeout: float = 30):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._tables = {}
+        folder_path = os.path.dirname(path)
+        if folder_path:
+            os.makedirs(folder_path, exist_ok=True)
+
+    def connection(self) -> sqlite3.Connection:
+        # one connection per thread, and a forked worker opens its own instead of reusing the parent's
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA busy_timeout={int(self.timeout * 1000)}')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def table(self, name: str) -> SQLiteTable:
+        if name not in self._tables:
+            self._tables[name] = SQLiteTable(self, name, **TABLE_SCHEMAS[name])
+        return self._tables[name]
+
+    def get_meta(self, name: str):
+        self.connection().execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+        found = self.connection().execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+        return found[0] if found else None
+
+    def set_meta(self, name: str, value: str):
+        with self.transaction() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+            conn.execute('INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)', (name, value))
+
+
+class TinyDBTable(Table):
+    # Legacy backend: every lookup and histogram is a scan and every write rewrites the JSON file.
+    # The lock only protects threads of one process, run a single writer process with it.
+    def __init__(self, storage: 'TinyDBStorage', name: str, key: str, indexes: Iterable[str] = (),
+                 histograms: Iterable[str] = (), composite: Iterable[Iterable[str]] = ()):
+        super().__init__(name, key, indexes, histograms, composite)
+        self._table = storage.db.table(name)
+        self._lock = storage.lock
+
+    def _query(self, key):
+        return Query()[self.key] == key
+
+    @timed_storage('get')
+    def get(self, key) -> Optional[Dict]:
+        row = self._table.get(self._query(key))
+        return dict(row) if row else None
+
+    @timed_storage('insert')
+    def insert(self, row: Dict):
+        with self._lock:
+            self._table.insert(row)
+
+    @timed_storage('upsert')
+    def upsert(self, row: Dict):
+        with self._lock:
+            self._table.upsert(row, self._query(row[self.key]))
+
+    @timed_storage('update')
+    def update(self, key, fields: Dict) -> bool:
+        with self._lock:
+            return len(self._table.update(fields, self._query(key))) > 0
+
+    @timed_storage('bulk_upsert')
+    def bulk_upsert(self, rows: Iterable[Dict]) -> Dict[str, int]:
+        # one scan to build the key -> row map and a single file rewrite per kind of change
+        counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+        with self._lock:
+            existing = {row.get(self.key): row for row in self._table.all()}
+            inserts, updates = [], []
+            for row in rows:
+                current = existing.get(row[self.key])
+                if current is None:
+                    inserts.append(row)
+                    existing[row[self.key]] = row
+                    counts['inserted'] += 1
+                elif any(current.get(field) != value for field, value in row.items()):
+                    updates.append((row, self._query(row[self.key])))
+                    counts['updated'] += 1
+                else:
+                    counts['unchanged'] += 1
+            if inserts:
+                self._table.insert_multiple(inserts)
+            if updates:
+                self._table.update_multiple(updates)
+        return counts
+
+    @timed_storage('update_many')
+    def update_many(self, updates: Dict[str, Dict]) -> int:
+        with self._lock:
+            return len(self._table.update_multiple([(fields, self._query(key)) for key, fields in updates.items()]))
+
+    @timed_storage('claim_many')
+    def claim_many(self, claims: Dict[str, Dict], can_claim: Callable[[Optional[Dict]], bool]) -> List[str]:
+        with self._lock:
+            return super().claim_many(claims, can_claim)
+
+    @timed_storage('remove')
+    def remove(self, key) -> bool:
+        with self._lock:
+            return len(self._table.remove(self._query(key))) > 0
+
+    @timed_storage('truncate')
+    def truncate(self):
+        with self._lock:
+            self._table.truncate()
+
+    def iter(self, after=None, limit: Optional[int] = None) -> Iterator[Dict]:
+        rows = self._table.all()
+        if after is not None or limit is not None:
+            rows = sorted((row for row in rows if after is None or str(row[self.key]) > str(after)),
+                          key=lambda row: str(row[self.key]))[:None if limit is None else max(0, limit)]
+        for row in rows:
+            yield dict(row)
+
+    def __len__(self):
+        return len(self._table)
+
+
+class TinyDBStorage:
+    def __init__(self, path: str):
+        folder_path = os.path.dirname(path)
+        if folder_path:
+            os.makedirs(folder_path, exist_ok=True)
+        self.db = TinyDB(path)
+        self.lock = threading.RLock()
+        self._tables = {}
+
+    def table(self, name: str) -> TinyDBTable:
+        if name not in self._tables:
+            self._tables[name] = TinyDBTable(self, name, **TABLE_SCHEMAS[name])
+        return self._tables[name]
+
+
+LEGACY_DB_PATH = 'database/db.json'
+
+
+def migrate_tinydb(json_path: str, storage: SQLiteStorage) -> Dict[str, int]:
+    # One-shot copy of the legacy TinyDB file, recorded in the meta table so it never runs twice
+    if storage.get_meta('migrated_from'):
+        return {}
+    counts = {}
+    with open(json_path, 'r', encoding='utf-8') as f:
+        content = f.read()
+    data = json.loads(content) if content.strip() else {}
+    for name, rows in data.items():
+        if name not in TABLE_SCHEMAS:
+            continue
+        table = storage.table(name)
+        key = table.key
+        with storage.transaction() as conn:
+            for row in rows.values():
+                if row.get(key) is not None:
+                    current = table._get(conn, row[key]) or {}
+                    current.update(row)
+                    table._write(conn, current, replace=True)
+        counts[name] = len(rows)
+    storage.set_meta('migrated_from', json_path)
+    return counts
+
+
+def open_storage(backend: Optional[str] = None, path: Optional[str] = None, migrate: bool = True):
+    backend = backend or os.getenv('STORAGE_BACKEND', 'sqlite')
+    if backend == 'tinydb':
+        return TinyDBStorage(path or os.getenv('DATABASE_PATH', LEGACY_DB_PATH))
+    if backend != 'sqlite':
+        raise ValueError(f'Unknown storage backend: {backend}')
+    storage = SQLiteStorage(path or os.getenv('DATABASE_PATH', 'database/db.sqlite3'))
+    # the first start on SQLite picks up the matches already saved by TinyDB
+    if migrate and os.path.exists(LEGACY_DB_PATH) and not storage.get_meta('migrated_from'):
+        migrate_tinydb(LEGACY_DB_PATH, storage)
+    return storage
+
+
+if __name__ == '__main__':
+    # python -m src.storage database/db.json database/db.sqlite3
+    json_path = sys.argv[1] if len(sys.argv) > 1 else LEGACY_DB_PATH
+    sqlite_path = sys.argv[2] if len(sys.argv) > 2 else 'database/db.sqlite3'
+    print(migrate_tinydb(json_path, SQLiteStorage(sqlite_path)))
@@ -0,0 +1,70 @@
+import time
+import datetime
+from src.tinder import Chatroom
+
+
+class ConversationSync:
+    # Per-match cursor (last activity, last message) so a cycle only downloads chats that moved,
+    # and only the messages newer than the cursor are appended to the local message store.
+    def __init__(self, sync_table, messages_table, history: int = 50, delta_count: int = 10, idle_days: int = 5):
+        self.sync_table = sync_table
+        self.messages_table = messages_table
+        self.history = history
+        self.delta_count = delta_count
+        self.idle_days = idle_days
+
+    def cursor(self, match_id):
+        return self.sync_table.get(match_id)
+
+    def has_activity(self, match, cursor) -> bool:
+        if cursor is None or not match.last_activity_date:
+            return True
+        # ISO timestamps in the same format compare in time order
+        return match.last_activity_date > cursor.get('last_activity_date', '')
+
+    def needs_attention(self, cursor, user_id) -> bool:
+        # nothing new arrived: only an unanswered message or our own stale last message needs a reply
+        if not cursor or not cursor.get('last_message_id'):
+            return False
+        if cursor.get('last_from_id') != user_id:
+            return True
+        sent_date = datetime.datetime.strptime(cursor['last_sent_date'], '%Y-%m-%dT%H:%M:%S.%fZ')
+        return sent_date + datetime.timedelta(days=self.idle_days) < datetime.datetime.utcnow()
+
+    async def pull(self, tinder_api, match, cursor):
+        # a few messages are enough when the cursor is found among them, otherwise read the full window
+        last_message_id = cursor.get('last_message_id') if cursor else None
+        data = []
+        if last_message_id:
+            data = await tinder_api.get_message_data(match.match_id, count=self.delta_count)
+        if not last_message_id or (len(data) >= self.delta_count and all(m['_id'] != last_message_id for m in data)):
+            data = await tinder_api.get_message_data(match.match_id, count=self.history)
+        return self.apply(match, data, last_message_id)
+
+    def apply(self, match, data, last_message_id=None):
+        new_messages = []
+        for message in data:  # newest first
+            if message['_id'] == last_message_id:
+                break
+            new_messages.append(dict(message, match_id=match.match_id))
+        if new_messages:
+            self.messages_table.bulk_upsert(new_messages)
+        cursor = {
+            'match_id': match.match_id,
+            'last_activity_date': match.last_activity_date or '',
+            'synced_at': time.time(),
+        }
+        if data:
+            cursor.update({
+                'last_message_id': data[0]['_id'],
+                'last_from_id': data[0]['from'],
+                'last_sent_date': data[0]['sent_date'],
+            })
+        self.sync_table.upsert(cursor)
+        return new_messages
+
+    def chatroom(self, match_id, tinder_api):
+        # the latest `history` messages from the local store, newest first like Tinder returns them;
+        # read off the (match_id, sent_date) index, the rest of the stored history is never loaded
+        messages = self.messages_table.latest('match_id', match_id, 'sent_date', self.history)
+        return Chatroom({'messages': messages}, match_id, tinder_api)
@@ -1,51 +1,158 @@
-import requests
+import os
+import time
+import random
 import datetime
+import threading
+import asyncio
+import httpx
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from src.metrics import TINDER_REQUESTS, TINDER_LATENCY, TINDER_IN_FLIGHT, TINDER_RETRIES
 
 TINDER_URL = "https://api.gotinder.com"
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/130.0.0.0 Safari/537.36"
+
+
+class RetryPolicy(object):
+    # 429 means Tinder rejected the call without processing it, so it is safe to retry for every method.
+    # 5xx and connection errors are only retried for idempotent methods, a POST may already have sent the message.
+    def __init__(self, total=3, backoff_factor=0.5, backoff_max=30, status_forcelist=(429, 500, 502, 503, 504),
+                 allowed_methods=("GET", "DELETE")):
+        self.total = total
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.status_forcelist = set(status_forcelist)
+        self.allowed_methods = set(allowed_methods)
+
+    def is_retryable(self, method, status_code=None):
+        if status_code == 429:
+            return True
+        if status_code is not None and status_code not in self.status_forcelist:
+            return False
+        return method.upper() in self.allowed_methods
+
+    def get_backoff(self, attempt, retry_after=None):
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        # exponential backoff with full jitter: 0.5, 1, 2, 4... seconds at most
+        return random.uniform(0, min(self.backoff_factor * (2 ** attempt), self.backoff_max))
+
+
+def request_not_sent(error):
+    # True when the connection to Tinder was never made, so the request cannot have been processed.
+    # A read timeout or a connection dropped once the request was out may still have delivered it.
+    if isinstance(error, (requests.ConnectTimeout, httpx.ConnectError, httpx.ConnectTimeout)):
+        return True
+    if isinstance(error, requests.ConnectionError):
+        reason = error.args[0] if error.args else None
+        # requests wraps urllib3's MaxRetryError, whose reason is the underlying failure
+        reason = getattr(reason, 'reason', reason)
+        return isinstance(reason, urllib3.exceptions.NewConnectionError)
+    return False
+
+
+def build_session(pool_size=10):
+    session = requests.Session()
+    # keep-alive pool shared by every call made through this session
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"User-Agent": USER_AGENT})
+    return session
+
 
 class TinderAPI():
-    def __init__(self, token):
+    def __init__(self, token, base_url=TINDER_URL, session=None, pool_size=10, timeout=(5, 30), retry=None,
+                 rate_limiter=None):
         self._token = token
+        self.base_url = base_url
+        self.timeout = timeout
+        self.retry = retry or RetryPolicy()
+        # shared limiter (src/ratelimit.py): a token is taken before every attempt and every status is reported back
+        self.rate_limiter = rate_limiter
+        self._session = session or build_session(pool_size)
         self.chatroom_match_id = []
 
+    def _request(self, method, path, endpoint=None, **kwargs):
+        # endpoint: the path with ids as placeholders, the label of the metrics
+        endpoint = endpoint or path.split("?")[0]
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            started = time.perf_counter()
+            TINDER_IN_FLIGHT.inc()
+            try:
+                response = self._session.request(method, self.base_url + path, headers={"X-Auth-Token": self._token},
+                                                 timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                TINDER_REQUESTS.labels(method, endpoint, "error").inc()
+                if attempt >= self.retry.total or not self.retry.is_retryable(method):
+                    raise
+                retry_after = None
+            else:
+                TINDER_REQUESTS.labels(method, endpoint, response.status_code).inc()
+                if self.rate_limiter:
+                    self.rate_limiter.observe(response.status_code)
+                if attempt >= self.retry.total or not self.retry.is_retryable(method, response.status_code):
+                    return response
+                retry_after = response.headers.get("Retry-After")
+            finally:
+                TINDER_IN_FLIGHT.dec()
+                TINDER_LATENCY.labels(method, endpoint).observe(time.perf_counter() - started)
+            TINDER_RETRIES.labels(method, endpoint).inc()
+            time.sleep(self.retry.get_backoff(attempt, retry_after))
+            attempt += 1
+
+    def close(self):
+        self._session.close()
+
     def profile(self):
-        data = requests.get(TINDER_URL + "/v2/profile?include=account%2Cuser", headers={
-            "X-Auth-Token": self._token, "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/130.0.0.0 Safari/537.36" }).json()
-        return Profile(data["data"], self)
+        data = self._request("GET", "/v2/profile?include=account%2Cuser").json()
+        return Profile(data["data"])
 
     def matches(self, count=50, message=0, page_token=None):
         # data = requests.get(TINDER_URL + f"/v2/matches?count={count}&message={message}", headers={"X-Auth-Token": self._token}).json()
         # self.chatroom_match_id = list(map(lambda match: match['id'], data["data"]["matches"]))
         # return list(map(lambda match: Match(match, self), data["data"]["matches"]))
-        url = f"{TINDER_URL}/v2/matches?count={count}&message={message}"
+        path = f"/v2/matches?count={count}&message={message}"
         
         if page_token:
-            url += f"&page_token={page_token}"
+            path += f"&page_token={page_token}"
         
-        response = requests.get(url, headers={"X-Auth-Token": self._token}).json()
+        response = self._request("GET", path).json()
         matches_data = response["data"]["matches"]
 
         # Extract the next page token if available
         page_token = response["data"].get("next_page_token")
 
         # Convert data to Match objects
-        matches = list(map(lambda match: Match(match, self), matches_data))
+        matches = list(map(lambda match: Match(match), matches_data))
         
         return matches, page_token
 
-    def get_messages(self, match_id):
-        data = requests.get(TINDER_URL + f"/v2/matches/{match_id}/messages?count=50", headers={"X-Auth-Token": self._token}).json()
-        return Chatroom(data['data'], match_id, self)
+    def get_messages(self, match_id, count=50):
+        return Chatroom({'messages': self.get_message_data(match_id, count)}, match_id, self)
+
+    def get_message_data(self, match_id, count=50):
+        # raw message dicts, newest first, for callers that only decode what they need
+        data = self._request("GET", f"/v2/matches/{match_id}/messages?count={count}", "/v2/matches/{id}/messages").json()
+        return data['data']['messages']
 
     def get_user_info(self, user_id):
-        data = requests.get(TINDER_URL + f"/user/{user_id}", headers={"X-Auth-Token": self._token}).json()
-        return Person(data["results"], self)
+        data = self._request("GET", f"/user/{user_id}", "/user/{id}").json()
+        return Person(data["results"])
     
     def unmatch(self, match_id):
-        data = requests.delete(TINDER_URL + f'/user/matches/{match_id}', headers={"X-Auth-Token": self._token}).json()
+        data = self._request("DELETE", f'/user/matches/{match_id}', "/user/matches/{id}").json()
         return data
 
-    def send_message(self, match_id, from_id, to_id, message):
+    def post_message(self, match_id, from_id, to_id, message):
+        # the raw response, for callers that must tell a refused message from one that may have gone out
         body = {
             'matchId': match_id,
             'message': message,
@@ -53,79 +160,295 @@ class TinderAPI():
             'otherId': to_id,
             'sessonId': None
         }
-        data = requests.post(TINDER_URL + f'/user/matches/{match_id}', json=body, headers={"X-Auth-Token": self._token}).json()
+        return self._request("POST", f'/user/matches/{match_id}', "/user/matches/{id}", json=body)
+
+    def send_message(self, match_id, from_id, to_id, message):
+        data = self.post_message(match_id, from_id, to_id, message).json()
         return data
 
 
+class AsyncTinderAPI():
+    # asyncio counterpart of TinderAPI for the async routes, so a slow Tinder response does not stall the event loop
+    def __init__(self, token, base_url=TINDER_URL, client=None, pool_size=10, timeout=(5, 30), retry=None,
+                 rate_limiter=None):
+        self._token = token
+        self.base_url = base_url
+        self.retry = retry or RetryPolicy()
+        # the same shared limiter as TinderAPI, taken and fed back without blocking the loop
+        self.rate_limiter = rate_limiter
+        self._client = client or httpx.AsyncClient(
+            headers={"User-Agent": USER_AGENT},
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(timeout[1], connect=timeout[0]),
+        )
+
+    async def _request(self, method, path, endpoint=None, **kwargs):
+        endpoint = endpoint or path.split("?")[0]
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                await self.rate_limiter.aacquire()
+            started = time.perf_counter()
+            TINDER_IN_FLIGHT.inc()
+            try:
+                response = await self._client.request(method, self.base_url + path, headers={"X-Auth-Token": self._token}, **kwargs)
+            except httpx.TransportError:
+                TINDER_REQUESTS.labels(method, endpoint, "error").inc()
+                if attempt >= self.retry.total or not self.retry.is_retryable(method):
+                    raise
+                retry_after = None
+            else:
+                TINDER_REQUESTS.labels(method, endpoint, response.status_code).inc()
+                if self.rate_limiter:
+                    await self.rate_limiter.aobserve(response.status_code)
+                if attempt >= self.retry.total or not self.retry.is_retryable(method, response.status_code):
+                    return response
+                retry_after = response.headers.get("Retry-After")
+            finally:
+                TINDER_IN_FLIGHT.dec()
+                TINDER_LATENCY.labels(method, endpoint).observe(time.perf_counter() - started)
+            TINDER_RETRIES.labels(method, endpoint).inc()
+            await asyncio.sleep(self.retry.get_backoff(attempt, retry_after))
+            attempt += 1
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    async def profile(self):
+        data = (await self._request("GET", "/v2/profile?include=account%2Cuser")).json()
+        return Profile(data["data"])
+
+    async def matches(self, count=50, message=0, page_token=None):
+        path = f"/v2/matches?count={count}&message={message}"
+        if page_token:
+            path += f"&page_token={page_token}"
+        response = (await self._request("GET", path)).json()
+        matches = list(map(lambda match: Match(match), response["data"]["matches"]))
+        return matches, response["data"].get("next_page_token")
+
+    async def get_messages(self, match_id, count=50):
+        return Chatroom({'messages': await self.get_message_data(match_id, count)}, match_id, self)
+
+    async def get_message_data(self, match_id, count=50):
+        data = (await self._request("GET", f"/v2/matches/{match_id}/messages?count={count}", "/v2/matches/{id}/messages")).json()
+        return data['data']['messages']
+
+    async def get_user_info(self, user_id):
+        data = (await self._request("GET", f"/user/{user_id}", "/user/{id}")).json()
+        return Person(data["results"])
+
+    async def unmatch(self, match_id):
+        return (await self._request("DELETE", f'/user/matches/{match_id}', "/user/matches/{id}")).json()
+
+    async def post_message(self, match_id, from_id, to_id, message):
+        body = {
+            'matchId': match_id,
+            'message': message,
+            'userId': from_id,
+            'otherId': to_id,
+            'sessonId': None
+        }
+        return await self._request("POST", f'/user/matches/{match_id}', "/user/matches/{id}", json=body)
+
+    async def send_message(self, match_id, from_id, to_id, message):
+        return (await self.post_message(match_id, from_id, to_id, message)).json()
+
+
+def _client_options(base_url=None):
+    return {
+        "base_url": base_url or os.getenv("TINDER_URL", TINDER_URL),
+        "pool_size": int(os.getenv("TINDER_POOL_SIZE", 10)),
+        "timeout": (float(os.getenv("TINDER_CONNECT_TIMEOUT", 5)), float(os.getenv("TINDER_READ_TIMEOUT", 30))),
+        "retry": RetryPolicy(
+            total=int(os.getenv("TINDER_MAX_RETRIES", 3)),
+            backoff_factor=float(os.getenv("TINDER_BACKOFF_FACTOR", 0.5)),
+        ),
+    }
+
+
+# One client per (process, token): the pooled session is reused by every route and every task
+# of a worker process, and a forked Celery child builds its own instead of sharing the parent's sockets.
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_tinder_api(token, base_url=None, rate_limiter=None):
+    key = (os.getpid(), token, base_url, rate_limiter)
+    api = _clients.get(key)
+    if api is None:
+        with _clients_lock:
+            api = _clients.get(key)
+            if api is None:
+                api = TinderAPI(token, rate_limiter=rate_limiter, **_client_options(base_url))
+                _clients[key] = api
+    return api
+
+
+# The async client is bound to the event loop it was first used on, which is the uvicorn loop for the routes.
+_async_clients = {}
+
+
+def get_async_tinder_api(token, base_url=None, rate_limiter=None):
+    key = (os.getpid(), token, base_url, rate_limiter)
+    api = _async_clients.get(key)
+    if api is None:
+        api = AsyncTinderAPI(token, rate_limiter=rate_limiter, **_client_options(base_url))
+        _async_clients[key] = api
+    return api
+
+
+async def close_async_tinder_apis():
+    while _async_clients:
+        _, api = _async_clients.popitem()
+        await api.aclose()
+
+
+def parse_date(value):
+    # Tinder timestamps look like 2024-01-31T18:04:05.123Z, fromisoformat is much cheaper than strptime
+    try:
+        return datetime.datetime.fromisoformat(value[:-1] if value.endswith('Z') else value)
+    except ValueError:
+        return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class lazy(object):
+    # Attribute decoded from the raw dict on first access and kept in the `_<name>` slot,
+    # so a listing pass that only reads id and name never builds the rest.
+    def __init__(self, decode):
+        self.decode = decode
+        self.slot = '_' + decode.__name__
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        try:
+            return getattr(obj, self.slot)
+        except AttributeError:
+            value = self.decode(obj)
+            setattr(obj, self.slot, value)
+            return value
+
+
 class Chatroom(object):
+    __slots__ = ('_api', '_data', 'match_id', '_messages')
+
     def __init__(self, data, match_id, api):
         self._api = api
+        self._data = data['messages']
         self.match_id = match_id
-        self.messages = list(map(lambda message: Message(match_id, message, self), data['messages']))
+
+    @lazy
+    def messages(self):
+        return [Message(self.match_id, message) for message in self._data]
 
     def send(self, message, from_id, to_id):
         return self._api.send_message(self.match_id, from_id, to_id, message)
 
     def get_lastest_message(self):
-        if len(self.messages) > 0:
-            return self.messages[0]
+        if len(self._data) > 0:
+            # newest first, only that one needs decoding
+            return self.messages[0] if hasattr(self, '_messages') else Message(self.match_id, self._data[0])
         return None
 
 
 class Message(object):
-    def __init__(self, match_id, data, api):
-        self._api = api
+    __slots__ = ('_data', 'match_id', '_sent_date')
+
+    def __init__(self, match_id, data):
+        self._data = data
         self.match_id = match_id
-        self.message_id = data['_id']
-        self.sent_date = data['sent_date']
-        self.message = data['message']
-        self.to_id = data['to']
-        self.from_id = data['from']
-        self.sent_date = datetime.datetime.strptime(data['sent_date'], '%Y-%m-%dT%H:%M:%S.%fZ')
+
+    @property
+    def message_id(self):
+        return self._data['_id']
+
+    @property
+    def message(self):
+        return self._data['message']
+
+    @property
+    def to_id(self):
+        return self._data['to']
+
+    @property
+    def from_id(self):
+        return self._data['from']
+
+    @lazy
+    def sent_date(self):
+        return parse_date(self._data['sent_date'])
 
     def __repr__(self):
         return f'{self.from_id}: {self.message}'
 
 
 class Match(object):
-    def __init__(self, data, api):
+    __slots__ = ('match_id', 'last_activity_date', 'person')
+
+    def __init__(self, data):
         self.match_id = data['id']
-        self.person = Person(data['person'], api)
+        self.last_activity_date = data.get('last_activity_date')
+        self.person = Person(data['person'])
 
 
 class Person(object):
+    __slots__ = ('_data', 'id', 'name', '_bio', '_city', '_relationship_intent', '_selected_descriptors', '_distance',
+                 '_birth_date', '_gender', '_images', '_jobs', '_schools')
 
-    def __init__(self, data, api):
-        self._api = api
+    def __init__(self, data):
+        self._data = data
 
         self.id = data["_id"]
 
         self.name = data.get("name", "Unknown")
 
-        self.bio = data.get("bio", "")
-        self.city = data.get("city", {}).get('name', "")
-        self.relationship_intent = data.get("relationship_intent", {}).get('body_text', "")
-        selected_descriptors = data.get('selected_descriptors', [])
-        self.selected_descriptors = []
-        for selected_descriptor in selected_descriptors:
+    @lazy
+    def bio(self):
+        return self._data.get("bio", "")
+
+    @lazy
+    def city(self):
+        return self._data.get("city", {}).get('name', "")
+
+    @lazy
+    def relationship_intent(self):
+        return self._data.get("relationship_intent", {}).get('body_text', "")
+
+    @lazy
+    def selected_descriptors(self):
+        selected_descriptors = []
+        for selected_descriptor in self._data.get('selected_descriptors', []):
+            choices = '/'.join([s['name'] for s in selected_descriptor.get('choice_selections', [])])
             if selected_descriptor.get('prompt'):
-                # self.selected_descriptors.append(f"{selected_descriptor.get('prompt')} {'/'.join([s['name'] for s in selected_descriptor['choice_selections']])}")
-                self.selected_descriptors.append(f"{selected_descriptor.get('prompt', '')} {'/'.join([s['name'] for s in selected_descriptor.get('choice_selections', [])])}")
+                selected_descriptors.append(f"{selected_descriptor.get('prompt', '')} {choices}")
             else:
-                # self.selected_descriptors.append(f"{selected_descriptor.get('name')}: {'/'.join([s['name'] for s in selected_descriptor['choice_selections']])}")
-                self.selected_descriptors.append(f"{selected_descriptor.get('name', '')} {'/'.join([s['name'] for s in selected_descriptor.get('choice_selections', [])])}")
+                selected_descriptors.append(f"{selected_descriptor.get('name', '')} {choices}")
+        return selected_descriptors
 
-        self.distance = data.get("distance_mi", 0) / 1.60934
+    @lazy
+    def distance(self):
+        return self._data.get("distance_mi", 0) / 1.60934
 
-        self.birth_date = datetime.datetime.strptime(data["birth_date"], '%Y-%m-%dT%H:%M:%S.%fZ') if data.get(
-            "birth_date", False) else None
-        self.gender = ["Male", "Female", "Unknown"][data.get("gender", 2)]
+    @lazy
+    def birth_date(self):
+        return parse_date(self._data["birth_date"]) if self._data.get("birth_date", False) else None
 
-        self.images = list(map(lambda photo: photo["url"], data.get("photos", [])))
+    @lazy
+    def gender(self):
+        return ["Male", "Female", "Unknown"][self._data.get("gender", 2)]
 
-        self.jobs = list(
-            map(lambda job: {"title": job.get("title", {}).get("name"), "company": job.get("company", {}).get("name")}, data.get("jobs", [])))
-        self.schools = list(map(lambda school: school["name"], data.get("schools", [])))
+    @lazy
+    def images(self):
+        return list(map(lambda photo: photo["url"], self._data.get("photos", [])))
+
+    @lazy
+    def jobs(self):
+        return list(
+            map(lambda job: {"title": job.get("title", {}).get("name"), "company": job.get("company", {}).get("name")}, self._data.get("jobs", [])))
+
+    @lazy
+    def schools(self):
+        return list(map(lambda school: school["name"], self._data.get("schools", [])))
 
     def infos(self):
         return {
@@ -145,10 +468,11 @@ class Person(object):
 
 
 class Profile(object):
+    __slots__ = ('email', 'phone_number', 'id', 'bio', 'age_min', 'age_max', 'user_interests', 'max_distance',
+                 'gender_filter')
 
-    def __init__(self, data, api):
+    def __init__(self, data):
 
-        self._api = api
         self.email = data["account"].get("account_email")
         self.phone_number = data["account"].get("account_phone_number")
 
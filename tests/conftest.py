@@ -0,0 +1,91 @@
+import os
+import sys
+import json
+import contextlib
+
+import pytest
+import fakeredis
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from benchmarks.fake_server import FakeConfig, serve_in_thread  # noqa: E402
+
+ACCOUNTS = ['acct0', 'acct1']
+
+
+@pytest.fixture(scope='session')
+def fake_server():
+    # one local fake Tinder for the whole run, see benchmarks/fake_server.py
+    config = FakeConfig(matches=20, seed=1)
+    base_url, server = serve_in_thread(config)
+    yield base_url, config
+    server.should_exit = True
+
+
+@pytest.fixture
+def fake_tinder(fake_server):
+    # the shared fake with its counters and scripted failures cleared
+    base_url, config = fake_server
+    config.scripted.clear()
+    config.outgoing.clear()
+    config.echo_sent = False
+    config.requests = config.sent = config.unmatched = 0
+    config.throttle_rate = config.error_rate = config.latency = 0.0
+    config.matches = 20
+    for counter in (config.requests_by_token, config.sent_by_token, config.requests_by_method):
+        counter.clear()
+    return base_url, config
+
+
+class Clock:
+    # stands in for the time module of src/cache.py
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    import src.cache
+    clock = Clock()
+    monkeypatch.setattr(src.cache, 'time', clock)
+    return clock
+
+
+@pytest.fixture(scope='session')
+def app(fake_server, tmp_path_factory):
+    # the whole app over the fake Tinder, two accounts from an accounts file, Redis in memory, tasks run eagerly
+    import redis
+    base_url, config = fake_server
+    workdir = tmp_path_factory.mktemp('accounts')
+    (workdir / 'logs').mkdir()
+    (workdir / 'accounts.json').write_text(json.dumps({account_id: {'token': f'token-{account_id}'}
+                                                       for account_id in ACCOUNTS}))
+    server = fakeredis.FakeServer()
+    with pytest.MonkeyPatch.context() as patch:
+        patch.chdir(workdir)
+        patch.setattr(redis.Redis, 'from_url', classmethod(lambda cls, url, **kwargs: fakeredis.FakeRedis(server=server)))
+        for name, value in {
+            'TINDER_URL': base_url,
+            'TINDER_TOKEN': 'token-default',
+            'TINDER_RATE': '1000000',
+            'TINDER_BURST': '1000000',
+            'STORAGE_BACKEND': 'sqlite',
+            'DATABASE_PATH': str(workdir / 'db.sqlite3'),
+            'ACCOUNTS_FILE': str(workdir / 'accounts.json'),
+            'ACCOUNTS_DIR': str(workdir / 'accounts'),
+            'SCHEDULER_ENABLED': 'false',
+            'GREETING_MESSAGE': 'Hi <match_name>!',
+        }.items():
+            patch.setenv(name, value)
+        from fastapi.testclient import TestClient
+        import main
+        import worker
+        worker.celery.conf.task_always_eager = True
+        with contextlib.ExitStack() as stack:
+            clients = {account_id: stack.enter_context(TestClient(main.app)) for account_id in ACCOUNTS}
+            yield main, config, clients
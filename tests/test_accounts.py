@@ -0,0 +1,77 @@
+import pytest
+
+
+@pytest.fixture
+def queues(app, monkeypatch):
+    # the queue every task was dispatched to, by task name
+    import worker
+    seen = []
+    for task in (worker.enrich_persons, worker.send_tinder_opener):
+        apply_async = task.apply_async
+
+        def record(args=None, kwargs=None, queue=None, apply_async=apply_async, task=task, **options):
+            seen.append((task.name, (kwargs or {}).get('account_id'), queue))
+            return apply_async(args, kwargs, queue=queue, **options)
+        monkeypatch.setattr(task, 'apply_async', record)
+    return seen
+
+
+def drive(client, account_id):
+    prefix = f'/accounts/{account_id}'
+    for path, params in (('/all-matches', {'limit': 1}), ('/all-persons', {}),
+                         ('/dispatch-openers-from-table', {'include_unenriched': False})):
+        response = client.get(prefix + path, params=params)
+        assert response.status_code == 200, response.text
+
+
+def test_accounts_are_isolated(app, queues):
+    main, config, clients = app
+    accounts = list(clients)
+    config.matches = 20
+    config.requests_by_token.clear()
+    config.sent_by_token.clear()
+    for account_id in accounts:
+        drive(clients[account_id], account_id)
+
+    storage_paths = set()
+    for account_id in accounts:
+        services = main.account_services(account_id)
+        token = f'token-{account_id}'
+        # its own partition, filled and enriched
+        assert services.matches_table.count() == 20
+        assert services.matches_table.count('distance') == 20
+        storage_paths.add(services.storage.path)
+        # only its own token went to Tinder
+        assert config.requests_by_token[token] > 0
+        assert config.sent_by_token[token] > 0
+        # its own limiter keys
+        assert services.tinder_limiter.bucket_key == f'ratelimit:tinder:{account_id}:bucket'
+        assert services.tinder_limiter.redis.exists(services.tinder_limiter.bucket_key)
+        # every task of the account on the account's queue
+        assert {queue for _, owner, queue in queues if owner == account_id} == {services.account.queue}
+    assert len(storage_paths) == len(accounts)
+    assert len({queue for _, _, queue in queues}) == len(accounts)
+    # the default account was neither called nor written to
+    assert config.requests_by_token['token-default'] == 0
+    assert main.matches_table.count() == 0
+
+
+def test_unknown_account_is_404(app):
+    _, _, clients = app
+    response = next(iter(clients.values())).get('/accounts/nobody/matches/totals')
+    assert response.status_code == 404
+
+
+def test_accounts_are_listed(app):
+    _, _, clients = app
+    listed = {account['account_id'] for account in next(iter(clients.values())).get('/accounts').json()}
+    assert listed == set(clients) | {'default'}
+
+
+def test_eager_tasks_open_no_metrics_port(app):
+    # the worker's exporter belongs to worker processes, not to the API or the tests running tasks eagerly
+    import worker
+    from src import metrics
+    _, _, clients = app
+    worker.reconcile_openers.apply((), {'account_id': next(iter(clients))}).get()
+    assert metrics._exporter_pid is None
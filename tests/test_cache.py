@@ -0,0 +1,56 @@
+import pytest
+
+from src.cache import PersonCache
+from src.ratelimit import CallBudget
+from src.storage import SQLiteStorage
+
+
+@pytest.fixture
+def stale(tmp_path, clock):
+    # three matches enriched two days ago
+    table = SQLiteStorage(str(tmp_path / 'db.sqlite3')).table('matches')
+    table.bulk_upsert([{'match_id': f'm{i}', 'person_id': f'p{i}', 'distance': 5, 'fetched_at': clock.now - 2 * 86400}
+                       for i in range(3)])
+    return table
+
+
+class InFlight:
+    # stands in for the enrich_inflight set of worker.py
+    def __init__(self):
+        self.claimed = set()
+
+    def claim(self, match_id):
+        if match_id in self.claimed:
+            return False
+        self.claimed.add(match_id)
+        return True
+
+    def release(self, match_id):
+        self.claimed.discard(match_id)
+
+
+def fetch(person_id):
+    raise AssertionError('a stale row is served, not fetched')
+
+
+def test_refresh_in_flight_costs_no_budget(stale):
+    inflight, dispatched = InFlight(), []
+    cache = PersonCache(stale, revalidate=lambda match_id, person_id: dispatched.append(match_id),
+                        claim=inflight.claim, release=inflight.release, budget=CallBudget(2, 60))
+    for match_id in ('m0', 'm0', 'm0', 'm1', 'm2'):
+        assert cache.get(match_id, fetch)['distance'] == 5
+    # m0 was paid once however often it was served, m2 found the budget spent and was left unclaimed
+    assert dispatched == ['m0', 'm1']
+    assert inflight.claimed == {'m0', 'm1'}
+
+
+def test_refresh_that_cannot_be_queued_still_serves_the_row(stale, clock):
+    inflight, budget = InFlight(), CallBudget(2, 60)
+
+    def broker_down(match_id, person_id):
+        raise ConnectionError('broker unreachable')
+    cache = PersonCache(stale, revalidate=broker_down, claim=inflight.claim, release=inflight.release, budget=budget)
+    assert cache.get('m0', fetch)['distance'] == 5
+    # the claim and the budget are given back, the next request tries again
+    assert inflight.claimed == set()
+    assert budget.available(clock.now) == 2
@@ -0,0 +1,104 @@
+import asyncio
+
+from src.cache import CompletionCache
+from src.models import CachedModel
+from src.storage import SQLiteStorage
+from benchmarks.fake_server import FakeModel
+
+
+def conversation(text):
+    return [{'role': 'system', 'content': 'Be nice.'}, {'role': 'user', 'content': text}]
+
+
+def cached_model(path, **options):
+    table = SQLiteStorage(str(path)).table('completions')
+    model = FakeModel(latency=0)
+    return CachedModel(model, CompletionCache(table, **options)), model
+
+
+def test_hit_does_not_call_the_model(tmp_path, clock):
+    cached, model = cached_model(tmp_path / 'db.sqlite3')
+    first = cached.chat_completion(conversation('hi'))
+    second = cached.chat_completion(conversation('hi'))
+    assert first == second
+    assert model.calls == 1
+    # another conversation is another key
+    cached.chat_completion(conversation('hello'))
+    assert model.calls == 2
+
+
+def test_async_hit_does_not_call_the_model(tmp_path, clock):
+    cached, model = cached_model(tmp_path / 'db.sqlite3')
+
+    async def run():
+        await cached.achat_completion(conversation('hi'))
+        return await cached.achat_completion(conversation('hi'))
+    assert asyncio.run(run())['choices'][0]['message']['content'] == model.reply
+    assert model.calls == 1
+
+
+def test_expired_entry_calls_the_model_again(tmp_path, clock):
+    cached, model = cached_model(tmp_path / 'db.sqlite3', ttl=60)
+    cached.chat_completion(conversation('hi'))
+    clock.now += 59
+    cached.chat_completion(conversation('hi'))
+    assert model.calls == 1
+    clock.now += 2
+    cached.chat_completion(conversation('hi'))
+    assert model.calls == 2
+
+
+def test_lru_evicts_at_capacity(tmp_path, clock):
+    cached, model = cached_model(tmp_path / 'db.sqlite3', max_entries=2)
+    cache = cached.cache
+    for text in ('a', 'b'):
+        cached.chat_completion(conversation(text))
+    # touching `a` makes `b` the least recently used
+    cached.chat_completion(conversation('a'))
+    cached.chat_completion(conversation('c'))
+    assert cache.stats()['size'] == 2
+    keys = [cache.make_key(cached.model_engine, conversation(text)) for text in ('a', 'b', 'c')]
+    assert list(cache._entries) == [keys[0], keys[2]]
+    # evicted from memory only, the persisted entry still answers
+    cached.chat_completion(conversation('b'))
+    assert model.calls == 3
+
+
+def test_cache_survives_a_reload(tmp_path, clock):
+    path = tmp_path / 'db.sqlite3'
+    cached, model = cached_model(path)
+    response = cached.chat_completion(conversation('hi'))
+    # a new process: new storage connection, new cache, new model
+    reloaded, reloaded_model = cached_model(path)
+    assert reloaded.chat_completion(conversation('hi')) == response
+    assert reloaded_model.calls == 0
+    assert reloaded.cache.stats()['hits'] == 1
+
+
+def test_prune_drops_expired_entries(tmp_path, clock):
+    cached, _ = cached_model(tmp_path / 'db.sqlite3', ttl=60)
+    cached.chat_completion(conversation('hi'))
+    clock.now += 120
+    cached.cache.prune()
+    assert cached.cache.table.count() == 0
+
+
+def test_batches_share_one_async_client():
+    from src.models import OpenAIModel
+
+    class RecordingModel(OpenAIModel):
+        # records the client and semaphore each call would use instead of calling OpenAI
+        def __init__(self):
+            super().__init__(api_key='test', model_engine='test', concurrency=2)
+            self.seen = set()
+
+        async def achat_completion(self, messages):
+            self.seen.add((id(self.async_client), id(self._semaphore)))
+            return {}
+
+    model = RecordingModel()
+    for _ in range(3):
+        model.chat_completion_many([conversation('a'), conversation('b')])
+    assert len(model.seen) == 1
+    assert len(model._async) == 1
+
@@ -0,0 +1,173 @@
+import pytest
+
+from src.outbox import Outbox, QUEUED, SENT, FAILED, UNKNOWN
+from src.storage import SQLiteStorage
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    return Outbox(SQLiteStorage(str(tmp_path / 'db.sqlite3')).table('outbox'))
+
+
+def opener(match_id='m1', message='Hi!'):
+    return {'match_id': match_id, 'person_id': 'p' + match_id, 'message': message}
+
+
+def started(outbox, item=None):
+    item = item or opener()
+    key, = [queued['key'] for queued in outbox.enqueue([item])]
+    assert outbox.start(key)
+    return key
+
+
+@pytest.mark.parametrize('status, body, retrying, state', [
+    (200, {'_id': 'sent1'}, False, SENT),
+    (200, {}, False, UNKNOWN),
+    (200, None, False, UNKNOWN),
+    (500, {'status': 500}, False, UNKNOWN),
+    (400, {'status': 400}, False, FAILED),
+    (429, {'status': 429}, True, QUEUED),
+    (429, {'status': 429}, False, FAILED),
+])
+def test_settle(outbox, status, body, retrying, state):
+    key = started(outbox)
+    assert outbox.settle(key, status, body, retrying=retrying) == state
+    assert outbox.get(key)['state'] == state
+
+
+def test_unknown_is_never_taken_again(outbox):
+    key = started(outbox)
+    outbox.unknown(key, 'ReadTimeout')
+    assert outbox.enqueue([opener()]) == []
+    assert not outbox.start(key)
+    assert 'm1' in outbox.busy_matches()
+    assert [row['key'] for row in outbox.unsettled()] == [key]
+
+
+def test_failed_is_queued_again(outbox):
+    key = started(outbox)
+    outbox.failed(key, 'HTTP 400')
+    assert [item['key'] for item in outbox.enqueue([opener()])] == [key]
+
+
+def test_stuck_sending_is_reconciled_not_resent(outbox):
+    outbox.sending_timeout = 0
+    key = started(outbox)
+    assert not outbox.start(key)
+    assert [row['key'] for row in outbox.unsettled()] == [key]
+
+
+def test_lost_queued_is_queued_again(outbox):
+    key, = [queued['key'] for queued in outbox.enqueue([opener()])]
+    assert outbox.enqueue([opener()]) == []
+    outbox.queued_timeout = 0
+    assert 'm1' not in outbox.busy_matches()
+    assert [item['key'] for item in outbox.enqueue([opener()])] == [key]
+    # the old task turning up late and the new one: only one gets to send
+    assert outbox.start(key)
+    assert not outbox.start(key)
+
+
+def test_reconcile(outbox):
+    found, missing = started(outbox, opener('m1')), started(outbox, opener('m2'))
+    for key in (found, missing):
+        outbox.unknown(key, 'HTTP 502 without a message id')
+    chat = [{'_id': 'x1', 'to': 'pm1', 'message': 'Hi!'}, {'_id': 'x0', 'to': 'me', 'message': 'Hi!'}]
+    assert outbox.reconcile(outbox.get(found), chat) == SENT
+    assert outbox.get(found)['message_id'] == 'x1'
+    assert outbox.reconcile(outbox.get(missing), chat) == FAILED
+    assert outbox.unsettled() == []
+
+
+def test_delivered_opener_with_a_bad_answer_is_not_sent_twice(app, fake_tinder):
+    # Tinder takes the message but answers 502: the opener is unknown, not failed, until the chat is checked
+    main, config, _ = app
+    import worker
+    account_id, match_id, person_id = 'acct1', 'match00000099', 'person00000099'
+    outbox = worker.get_outbox(account_id)
+    outbox.table.truncate()
+    item = {'match_id': match_id, 'person_id': person_id, 'message': 'Hi there!'}
+    key, = [queued['key'] for queued in outbox.enqueue([item])]
+
+    config.fail_next(502, deliver=True)
+    worker.send_tinder_opener.apply((match_id, 'me', person_id, 'Hi there!'), {'account_id': account_id, 'key': key})
+    assert outbox.get(key)['state'] == UNKNOWN
+    assert outbox.enqueue([item]) == []
+    assert worker.send_tinder_opener.apply((match_id, 'me', person_id, 'Hi there!'),
+                                           {'account_id': account_id, 'key': key}).get()['skipped'] == key
+
+    config.echo_sent = True
+    assert worker.reconcile_openers.apply((), {'account_id': account_id}).get() == {SENT: 1, FAILED: 0}
+    assert outbox.get(key)['state'] == SENT
+    assert config.sent == 1
+
+
+def test_refused_opener_fails_and_can_be_queued_again(app, fake_tinder):
+    main, config, _ = app
+    import worker
+    account_id = 'acct1'
+    outbox = worker.get_outbox(account_id)
+    outbox.table.truncate()
+    item = {'match_id': 'match00000098', 'person_id': 'person00000098', 'message': 'Hello!'}
+    key, = [queued['key'] for queued in outbox.enqueue([item])]
+
+    config.fail_next(403)
+    worker.send_tinder_opener.apply(('match00000098', 'me', 'person00000098', 'Hello!'),
+                                    {'account_id': account_id, 'key': key})
+    assert outbox.get(key)['state'] == FAILED
+    assert config.sent == 0
+    assert [queued['key'] for queued in outbox.enqueue([item])] == [key]
+
+
+def test_broker_failure_leaves_no_opener_queued(app, fake_tinder, monkeypatch):
+    main, config, clients = app
+    import worker
+    account_id = 'acct1'
+    outbox = worker.get_outbox(account_id)
+    outbox.table.truncate()
+    apply_async, calls = worker.send_tinder_opener.apply_async, []
+
+    def broker_down_after_one(*args, **kwargs):
+        calls.append(args)
+        if len(calls) > 1:
+            raise ConnectionError('broker down')
+        return apply_async(*args, **kwargs)
+    monkeypatch.setattr(worker.send_tinder_opener, 'apply_async', broker_down_after_one)
+    with pytest.raises(ConnectionError):
+        clients[account_id].get(f'/accounts/{account_id}/dispatch-openers')
+    states = [row['state'] for row in outbox.table.all()]
+    assert sorted(states) == [FAILED] * (config.matches - 1) + [SENT]
+
+    monkeypatch.setattr(worker.send_tinder_opener, 'apply_async', apply_async)
+    response = clients[account_id].get(f'/accounts/{account_id}/dispatch-openers')
+    assert len(response.json()) == config.matches - 1
+    assert {row['state'] for row in outbox.table.all()} == {SENT}
+
+
+def test_manual_opener_shares_the_dispatched_key(app, fake_tinder):
+    main, config, clients = app
+    import worker
+    account_id, client = 'acct1', clients['acct1']
+    outbox = worker.get_outbox(account_id)
+    outbox.table.truncate()
+    assert client.get(f'/accounts/{account_id}/all-matches').status_code == 200
+    match_id, = [row['match_id'] for row in main.account_services(account_id).matches_table.iter(limit=1)]
+    client.get(f'/accounts/{account_id}/dispatch-openers')
+    sent = config.sent
+
+    assert client.get(f'/accounts/{account_id}/send-opener/{match_id}').json()['state'] == SENT
+    assert config.sent == sent
+    assert len(outbox.table.find('match_id', match_id)) == 1
+
+
+@pytest.mark.parametrize('path', ['/dispatch-openers', '/dispatch-openers-from-table'])
+def test_dispatch_reports_the_countdown(app, fake_tinder, path):
+    main, config, clients = app
+    import worker
+    account_id = 'acct1'
+    worker.get_outbox(account_id).table.truncate()
+    assert clients[account_id].get(f'/accounts/{account_id}/all-matches').status_code == 200
+    delays = [item['delay'] for item in clients[account_id].get(f'/accounts/{account_id}{path}',
+                                                                  params={'jitter': True}).json()]
+    assert len(delays) == config.matches
+    assert all(5 <= later - earlier <= 10 for earlier, later in zip([0] + delays, delays))
@@ -0,0 +1,40 @@
+import asyncio
+
+from benchmarks.bench_polling import World, SimPipeline, SimAPI
+from src.poller import AdaptivePoller
+from src.ratelimit import CallBudget
+
+
+class RecordingAPI(SimAPI):
+    # the simulated Tinder, with the time of every call
+    def __init__(self, world):
+        super().__init__(world)
+        self.times = []
+
+    async def matches(self, count=50, message=0, page_token=None):
+        self.times.append(self.world.clock.now)
+        return await super().matches(count, message)
+
+    async def get_message_data(self, match_id, count=50):
+        self.times.append(self.world.clock.now)
+        await super().get_message_data(match_id, count)
+
+    async def send_message(self, match_id, *args):
+        self.times.append(self.world.clock.now)
+        await super().send_message(match_id, *args)
+
+
+def test_replies_are_charged_to_the_call_budget():
+    # every chat moves at first and many go live: pulls and the replies they trigger share 10 calls a minute
+    world = World(matches=50, hours=2, live=30, seed=1)
+    api = RecordingAPI(world)
+    poller = AdaptivePoller(SimPipeline(world), budget=CallBudget(10, 60), clock=world.clock)
+
+    async def run():
+        for step in range(2 * 3600 // 15):
+            world.advance(step * 15.0)
+            await poller.tick(api, None)
+    asyncio.run(run())
+
+    assert world.sends > 0
+    assert max(sum(1 for t in api.times if start <= t < start + 60) for start in api.times) <= 10
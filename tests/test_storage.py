@@ -0,0 +1,112 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from src.storage import SQLiteStorage, TinyDBStorage, Table, migrate_tinydb
+
+
+@pytest.fixture(params=['sqlite', 'tinydb'])
+def storage(request, tmp_path):
+    # every test below runs against both backends and expects the same answers from each
+    return SQLiteStorage(str(tmp_path / 'db.sqlite3')) if request.param == 'sqlite' else TinyDBStorage(str(tmp_path / 'db.json'))
+
+
+@pytest.fixture
+def matches(storage):
+    table = storage.table('matches')
+    table.bulk_upsert({'match_id': f'match{i:02d}', 'person_id': f'person{i:02d}', 'name': str(i)} for i in range(10))
+    return table
+
+
+def born(years):
+    # a birth date that makes the person `years` old today, well away from the birthday
+    return (datetime.utcnow().date() - timedelta(days=int(years * 365.25) + 100)).isoformat()
+
+
+def test_iter_pages_in_key_order(matches):
+    first = list(matches.iter(limit=4))
+    assert [row['match_id'] for row in first] == ['match00', 'match01', 'match02', 'match03']
+    assert [row['match_id'] for row in matches.iter(after='match03', limit=2)] == ['match04', 'match05']
+
+
+def test_negative_limit_is_not_unlimited(matches):
+    assert list(matches.iter(limit=-1)) == []
+
+
+def test_histogram_follows_every_write(matches):
+    steps = [
+        (lambda: None, {None: 10}),
+        (lambda: matches.update('match00', {'distance': 3.5}), {3: 1, None: 9}),
+        (lambda: matches.upsert({'match_id': 'match01', 'person_id': 'person01', 'distance': 3.9}), {3: 2, None: 8}),
+        (lambda: matches.insert({'match_id': 'match10', 'person_id': 'person10', 'distance': 20}), {3: 2, 20: 1, None: 8}),
+        (lambda: matches.update('match00', {'distance': 7.2}), {3: 1, 7: 1, 20: 1, None: 8}),
+        (lambda: matches.update('match00', {'name': 'renamed'}), {3: 1, 7: 1, 20: 1, None: 8}),
+        (lambda: matches.remove('match01'), {7: 1, 20: 1, None: 8}),
+        (lambda: matches.update('match00', {'distance': None}), {20: 1, None: 9}),
+        (lambda: matches.bulk_upsert([{'match_id': 'match02', 'distance': 1}, {'match_id': 'match11', 'distance': 1.5}]),
+         {1: 2, 20: 1, None: 8}),
+    ]
+    for write, expected in steps:
+        write()
+        assert matches.histogram('distance') == expected
+        # the maintained counts agree with a scan of the rows
+        assert Table.histogram(matches, 'distance') == expected
+
+
+def test_bulk_upsert_counts(matches):
+    page = [{'match_id': 'match00', 'person_id': 'person00'},
+            {'match_id': 'match01', 'person_id': 'person01', 'name': '1'},
+            {'match_id': 'match02', 'person_id': 'person02', 'distance': 4},
+            {'match_id': 'match10', 'person_id': 'person10'},
+            {'match_id': 'match11', 'person_id': 'person11'}]
+    assert matches.bulk_upsert(page) == {'inserted': 2, 'updated': 1, 'unchanged': 2}
+    # an update merges the new fields into the stored row
+    assert matches.get('match02') == {'match_id': 'match02', 'person_id': 'person02', 'name': '2', 'distance': 4}
+    assert matches.bulk_upsert(page) == {'inserted': 0, 'updated': 0, 'unchanged': 5}
+    assert matches.bulk_upsert([]) == {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    assert len(matches) == 12
+
+
+def test_range_missing_and_age_selection(app, matches):
+    main, _, _ = app
+    for match_id, distance, age in (('match00', 2.5, 22), ('match01', 14.9, 31), ('match02', 15, 27),
+                                    ('match03', 40, 45), ('match04', 0, None)):
+        matches.update(match_id, {'distance': distance, 'birth_date': born(age) if age else None})
+
+    def keys(rows):
+        return [row['match_id'] for row in rows]
+    assert keys(matches.range('distance', None, 15)) == ['match04', 'match00', 'match01']
+    assert keys(matches.range('distance', 15)) == ['match02', 'match03']
+    assert keys(matches.range('distance', 2.5, 15)) == ['match00', 'match01']
+    assert matches.count('distance', None, 15) == 3
+    assert matches.count('distance') == 5
+    assert sorted(keys(matches.missing('distance'))) == [f'match{i:02d}' for i in range(5, 10)]
+
+    def selected(**filters):
+        return sorted(keys(main.select_matches(matches, **filters)))
+    assert selected(max_km=15) == ['match00', 'match01', 'match04']
+    assert selected(min_km=15, max_km=None) == ['match02', 'match03']
+    assert selected(min_km=None, max_km=None, min_age=25, max_age=35) == ['match01', 'match02']
+    assert selected(max_km=15, min_age=30) == ['match01']
+    assert selected(min_km=30, max_km=None, include_unenriched=True) == ['match03'] + [f'match{i:02d}' for i in range(5, 10)]
+
+
+def test_migrate_tinydb(tmp_path):
+    legacy = TinyDBStorage(str(tmp_path / 'db.json'))
+    legacy.table('matches').bulk_upsert(
+        {'match_id': f'match{i:02d}', 'person_id': f'person{i:02d}', 'distance': i * 3 if i % 3 else None}
+        for i in range(10))
+    legacy.table('profile').insert({'id': 'me', 'bio': 'hi'})
+    legacy.db.table('unknown').insert({'anything': 1})
+
+    storage = SQLiteStorage(str(tmp_path / 'db.sqlite3'))
+    assert migrate_tinydb(str(tmp_path / 'db.json'), storage) == {'matches': 10, 'profile': 1}
+    for name in ('matches', 'profile'):
+        assert storage.table(name).all() == sorted(legacy.table(name).all(), key=lambda row: row[storage.table(name).key])
+    assert storage.table('matches').histogram('distance') == legacy.table('matches').histogram('distance')
+    assert [row['match_id'] for row in storage.table('matches').range('distance', 10)] == \
+        [row['match_id'] for row in legacy.table('matches').range('distance', 10)]
+    # recorded once, a second run copies nothing
+    legacy.table('matches').update('match00', {'distance': 99})
+    assert migrate_tinydb(str(tmp_path / 'db.json'), storage) == {}
+    assert storage.table('matches').get('match00')['distance'] is None
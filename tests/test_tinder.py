@@ -0,0 +1,137 @@
+import time
+import asyncio
+
+import pytest
+
+from src.tinder import TinderAPI, AsyncTinderAPI, RetryPolicy
+
+
+def client(base_url, total=3):
+    # tiny backoff, the tests only care about how many attempts reach the server
+    return TinderAPI('token', base_url=base_url, retry=RetryPolicy(total=total, backoff_factor=0.001))
+
+
+def test_429_waits_for_retry_after(fake_tinder):
+    base_url, config = fake_tinder
+    config.fail_next(429, retry_after=0.3)
+    started = time.perf_counter()
+    person = client(base_url).get_user_info('person00000001')
+    assert time.perf_counter() - started >= 0.3
+    assert person.id
+    assert config.requests == 2
+
+
+def test_429_is_retried_for_post(fake_tinder):
+    # a 429 was rejected before Tinder processed it, resending cannot deliver twice
+    base_url, config = fake_tinder
+    config.fail_next(429, retry_after=0)
+    message = client(base_url).send_message('match00000001', 'me', 'person00000001', 'hi')
+    assert message['_id']
+    assert config.requests_by_method['POST'] == 2
+    assert config.sent == 1
+
+
+def test_5xx_is_retried_then_succeeds(fake_tinder):
+    base_url, config = fake_tinder
+    config.fail_next(503, times=2)
+    matches, _ = client(base_url).matches(count=5)
+    assert len(matches) == 5
+    assert config.requests == 3
+
+
+def test_post_is_not_retried_on_5xx(fake_tinder):
+    base_url, config = fake_tinder
+    config.fail_next(500, times=3)
+    data = client(base_url).send_message('match00000001', 'me', 'person00000001', 'hi')
+    assert data == {'status': 500}
+    assert config.requests_by_method['POST'] == 1
+
+
+def test_gives_up_after_max_retries(fake_tinder):
+    base_url, config = fake_tinder
+    config.fail_next(502, times=10)
+    response = client(base_url, total=2)._request('GET', '/v2/profile')
+    assert response.status_code == 502
+    assert config.requests == 3
+    assert len(config.scripted) == 7
+
+
+def test_connection_error_gives_up(fake_tinder):
+    import requests
+    # nothing listens on port 1
+    with pytest.raises(requests.ConnectionError):
+        client('http://127.0.0.1:1', total=1).get_user_info('person00000001')
+
+
+def test_async_client_retries_5xx(fake_tinder):
+    base_url, config = fake_tinder
+    config.fail_next(500)
+
+    async def run():
+        api = AsyncTinderAPI('token', base_url=base_url, retry=RetryPolicy(backoff_factor=0.001))
+        try:
+            return await api.get_user_info('person00000001')
+        finally:
+            await api.aclose()
+    assert asyncio.run(run()).id
+    assert config.requests == 2
+
+
+class CountingLimiter:
+    def __init__(self):
+        self.acquired = 0
+        self.statuses = []
+
+    def acquire(self):
+        self.acquired += 1
+
+    def observe(self, status_code):
+        self.statuses.append(status_code)
+
+    async def aacquire(self):
+        self.acquire()
+
+    async def aobserve(self, status_code):
+        self.observe(status_code)
+
+
+def test_every_attempt_goes_through_the_limiter(fake_tinder):
+    base_url, config = fake_tinder
+    config.fail_next(429, retry_after=0)
+    limiter = CountingLimiter()
+    api = TinderAPI('token', base_url=base_url, retry=RetryPolicy(backoff_factor=0.001), rate_limiter=limiter)
+    api.get_user_info('person00000001')
+    assert limiter.acquired == 2
+    assert limiter.statuses == [429, 200]
+
+
+def test_async_client_goes_through_the_limiter(fake_tinder):
+    base_url, config = fake_tinder
+    config.fail_next(503)
+    limiter = CountingLimiter()
+
+    async def run():
+        api = AsyncTinderAPI('token', base_url=base_url, retry=RetryPolicy(backoff_factor=0.001), rate_limiter=limiter)
+        try:
+            await api.get_user_info('person00000001')
+        finally:
+            await api.aclose()
+    asyncio.run(run())
+    assert limiter.acquired == 2
+    assert limiter.statuses == [503, 200]
+
+
+def test_request_not_sent(fake_tinder):
+    import requests
+    from src.tinder import request_not_sent
+    base_url, config = fake_tinder
+    # nothing listens on port 1: the request never left
+    with pytest.raises(requests.ConnectionError) as refused:
+        client('http://127.0.0.1:1', total=0).send_message('match00000001', 'me', 'person00000001', 'hi')
+    assert request_not_sent(refused.value)
+    # the request reached the server, the answer came too late
+    config.latency = 0.5
+    api = TinderAPI('token', base_url=base_url, timeout=(5, 0.1), retry=RetryPolicy(total=0))
+    with pytest.raises(requests.Timeout) as timed_out:
+        api.send_message('match00000001', 'me', 'person00000001', 'hi')
+    assert not request_not_sent(timed_out.value)
@@ -0,0 +1,311 @@
+# Celery tasks, importable without the web app: `celery -A worker.celery worker --loglevel=info`.
+# Nothing is read or opened at import. .env, the database, Redis and the loggers are set up on first use
+# in the process that needs them, so a worker never builds the FastAPI app, the scheduler or the OpenAI clients.
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from celery import Celery # type: ignore
+from celery.signals import worker_init, worker_process_init # type: ignore
+from src import metrics
+from src.ratelimit import RateLimited
+from src.tinder import get_tinder_api, request_not_sent
+from src.outbox import SENT, QUEUED, FAILED
+
+_lock = threading.RLock()
+_built = {}
+
+
+def _once(name, build):
+    # one instance per process, built by the first caller
+    value = _built.get(name)
+    if value is None:
+        with _lock:
+            value = _built.get(name)
+            if value is None:
+                value = _built[name] = build()
+    return value
+
+
+def load_settings():
+    def build():
+        from dotenv import load_dotenv # type: ignore
+        load_dotenv()
+        return True
+    return _once('settings', build)
+
+
+def setting(name, default=None):
+    load_settings()
+    return os.getenv(name, default)
+
+
+class CeleryConfig:
+    # read by Celery the first time it needs its configuration, not when this module is imported
+    @property
+    def broker_url(self):
+        return setting('REDIS_URL', 'redis://localhost:6379/0')
+
+    @property
+    def result_backend(self):
+        return self.broker_url
+
+
+celery = Celery('main')
+celery.config_from_object(CeleryConfig())
+
+
+# task run times and in-flight counts, each worker process serves its own metrics from CELERY_METRICS_PORT on.
+# Only real workers: eager tasks in the API or the tests must not open a port.
+@worker_process_init.connect(weak=False)
+def instrument_worker_process(**kwargs):
+    metrics.instrument_celery(int(setting('CELERY_METRICS_PORT', 9100)))
+
+
+@worker_init.connect(weak=False)
+def instrument_worker(sender=None, **kwargs):
+    # solo and thread pools run tasks in the worker process itself, which gets no worker_process_init
+    from celery.concurrency import get_implementation # type: ignore
+    if get_implementation(sender.pool_cls).__module__ != 'celery.concurrency.prefork':
+        instrument_worker_process()
+
+
+def get_accounts():
+    def build():
+        from src.accounts import registry_from_env
+        load_settings()
+        return registry_from_env()
+    return _once('accounts', build)
+
+
+def get_account(account_id=None):
+    return get_accounts().get(account_id)
+
+
+def get_storage(account_id=None):
+    return get_account(account_id).storage()
+
+
+def get_matches_table(account_id=None):
+    return get_storage(account_id).table('matches')
+
+
+def get_redis():
+    def build():
+        import redis # type: ignore
+        return redis.Redis.from_url(setting('REDIS_URL', 'redis://localhost:6379/0'))
+    return _once('redis', build)
+
+
+def get_rate_limiter(account_id=None):
+    # One token bucket per account in Redis paces every worker's Tinder calls for that account
+    # and slows down when Tinder answers 429
+    account = get_account(account_id)
+
+    def build():
+        from src.ratelimit import RateLimiter
+        return RateLimiter(
+            get_redis(),
+            name=account.limiter_name,
+            rate=account.rate or float(setting('TINDER_RATE', 0.2)),
+            burst=int(setting('TINDER_BURST', 1)),
+            min_rate=float(setting('TINDER_MIN_RATE', 0.02)),
+            max_wait=float(setting('TINDER_RATE_MAX_WAIT', 30)),
+        )
+    return _once(('rate_limiter', account.account_id), build)
+
+
+def get_enrich_inflight(account_id=None):
+    # match ids with an enrichment task queued, so calling /all-persons twice does not enqueue them twice
+    account = get_account(account_id)
+
+    def build():
+        from src.inflight import InFlightSet
+        return InFlightSet(get_redis(), account.inflight_name, ttl=int(setting('ENRICH_INFLIGHT_TTL', 3600)))
+    return _once(('enrich_inflight', account.account_id), build)
+
+
+def get_outbox(account_id=None):
+    account = get_account(account_id)
+
+    def build():
+        from src.outbox import Outbox
+        return Outbox(get_storage(account.account_id).table('outbox'),
+                      sending_timeout=float(setting('OUTBOX_SENDING_TIMEOUT', 600)),
+                      queued_timeout=float(setting('OUTBOX_QUEUED_TIMEOUT', 3600)))
+    return _once(('outbox', account.account_id), build)
+
+
+def get_person_cache(account_id=None):
+    # stale persons are refreshed by enrich_persons in the background, claimed like /all-persons does
+    account = get_account(account_id)
+
+    def claim(match_id):
+        return bool(get_enrich_inflight(account.account_id).claim([match_id]))
+
+    def release(match_id):
+        get_enrich_inflight(account.account_id).release([match_id])
+
+    def revalidate(match_id, person_id):
+        dispatch(enrich_persons, ([(match_id, person_id)],), account.account_id)
+
+    def build():
+        from src.cache import PersonCache
+        from src.ratelimit import CallBudget
+        return PersonCache(get_matches_table(account.account_id), max_age=float(setting('PERSON_MAX_AGE', 86400)),
+                           revalidate=revalidate, claim=claim, release=release,
+                           budget=CallBudget(int(setting('PERSON_REFRESH_BUDGET', 10)),
+                                             float(setting('PERSON_REFRESH_INTERVAL', 60))))
+    return _once(('person_cache', account.account_id), build)
+
+
+def get_openers_log():
+    def build():
+        from src.logger import get_audit_logger
+        return get_audit_logger('openers')
+    return _once('openers_log', build)
+
+
+def tinder_api(account_id=None):
+    return get_tinder_api(get_account(account_id).token, rate_limiter=get_rate_limiter(account_id))
+
+
+def dispatch(task, args, account_id=None, countdown=0, **kwargs):
+    # every account's work goes to its own queue, workers pick the accounts they serve with -Q
+    account = get_account(account_id)
+    return task.apply_async(args, dict(kwargs, account_id=account.account_id), queue=account.queue,
+                            countdown=countdown)
+
+
+# fields of a match row filled in from the person's profile
+def person_fields(person):
+    return {
+        'distance': person.distance,
+        'birth_date': person.birth_date.strftime('%Y-%m-%dT%H:%M:%S.%fZ') if person.birth_date else None,
+        'bio': person.bio,
+        'fetched_at': time.time()
+    }
+
+# the task names predate this module, queued tasks keep routing to them
+@celery.task(name='main.send_tinder_opener', bind=True, max_retries=None)
+def send_tinder_opener(self, match_id, from_id, to_id, message, account_id=None, key=None):
+    # key: the outbox row dispatch queued, tasks queued before the outbox get theirs from match_id and message
+    outbox = get_outbox(account_id)
+    key = key or outbox.key(match_id, message)
+    if not outbox.start(key, match_id=match_id, person_id=to_id, message=message):
+        # already sent, or another delivery of this task is sending it
+        return {"skipped": key, "state": (outbox.get(key) or {}).get('state')}
+    openers_log = get_openers_log()
+    openers_log.info(f' {message}')
+    try:
+        response = tinder_api(account_id).post_message(match_id, from_id, to_id, message)
+    except RateLimited as e:
+        outbox.requeue(key)
+        raise self.retry(countdown=e.wait)
+    except Exception as e:
+        if not request_not_sent(e):
+            # the request may have reached Tinder, only reconcile_openers can tell
+            outbox.unknown(key, repr(e))
+            raise
+        if self.request.retries >= int(setting('OUTBOX_CONNECT_RETRIES', 3)):
+            outbox.failed(key, repr(e))
+            raise
+        # no connection was made, sending again cannot deliver it twice
+        outbox.requeue(key)
+        raise self.retry(countdown=float(setting('OUTBOX_RETRY_DELAY', 30)))
+    try:
+        data = response.json()
+    except ValueError:
+        data = None
+    openers_log.info(json.dumps(data))
+    state = outbox.settle(key, response.status_code, data, retrying=True)
+    if state == SENT:
+        return data
+    if state == QUEUED:
+        # 429 after the client's own retries, Tinder did not take it
+        raise self.retry(countdown=float(response.headers.get('Retry-After') or setting('OUTBOX_RETRY_DELAY', 30)))
+    raise ValueError(f"Failed to send message to user: HTTP {response.status_code}, opener {state}")
+
+# settle the openers that may have gone out (unknown, or left in `sending` by a lost worker) by looking for
+# them in the chat: found ones are sent, the others failed and queued again by the next dispatch
+@celery.task(name='main.reconcile_openers', bind=True, max_retries=None)
+def reconcile_openers(self, account_id=None):
+    outbox = get_outbox(account_id)
+    api = tinder_api(account_id)
+    settled = {SENT: 0, FAILED: 0}
+    for row in outbox.unsettled():
+        try:
+            messages = api.get_message_data(row['match_id'])
+        except RateLimited as e:
+            raise self.retry(countdown=e.wait)
+        settled[outbox.reconcile(row, messages)] += 1
+    return settled
+
+@celery.task(name='main.get_tinder_person', bind=True, max_retries=None)
+def get_tinder_person(self, match_id, person_id, account_id=None, refresh=False):
+    # a person fetched less than PERSON_MAX_AGE ago is not fetched again unless refresh is set
+    person_cache = get_person_cache(account_id)
+    row = person_cache.table.get(match_id)
+    if not refresh and row and person_cache.is_fresh(row):
+        return row
+    try:
+        person = tinder_api(account_id).get_user_info(person_id)
+    except RateLimited as e:
+        raise self.retry(countdown=e.wait)
+    if hasattr(person, "id") and person.id:  # Check if "id" exists and is not empty
+        # add only missing fields not present in match
+        matches_table = get_matches_table(account_id)
+        matches_table.update(match_id, person_fields(person))
+        return matches_table.get(match_id)
+    else:
+        raise ValueError("Failed to get profile")
+
+# enrich a chunk of (match_id, person_id) pairs: concurrent fetches, one bulk write
+@celery.task(name='main.enrich_persons', bind=True, max_retries=None)
+def enrich_persons(self, pairs, account_id=None):
+    api = tinder_api(account_id)
+    # pairs refreshed since they were queued (by /match or another task) are released without a call
+    person_cache = get_person_cache(account_id)
+    fresh = []
+    for match_id, _ in pairs:
+        row = person_cache.table.get(match_id)
+        if row and person_cache.is_fresh(row):
+            fresh.append(match_id)
+    get_enrich_inflight(account_id).release(fresh)
+    pairs = [(match_id, person_id) for match_id, person_id in pairs if match_id not in fresh]
+
+    def fetch(pair):
+        try:
+            return pair, api.get_user_info(pair[1]), None
+        except Exception as e:
+            return pair, None, e
+
+    with ThreadPoolExecutor(max_workers=int(setting('ENRICH_CONCURRENCY', 4))) as executor:
+        results = list(executor.map(fetch, pairs))
+
+    updates, limited, failed = {}, [], []
+    for (match_id, person_id), person, error in results:
+        if isinstance(error, RateLimited):
+            limited.append((match_id, person_id))
+        elif person is not None and person.id:
+            updates[match_id] = person_fields(person)
+        else:
+            failed.append(match_id)
+    get_matches_table(account_id).update_many(updates)
+    get_enrich_inflight(account_id).release(list(updates) + failed)
+    if limited:
+        # the pairs that could not get a token stay claimed and come back once the limiter allows
+        raise self.retry(args=(limited,), countdown=max(e.wait for _, _, e in results if isinstance(e, RateLimited)))
+    return {"updated": len(updates), "failed": failed, "fresh": len(fresh)}
+
+@celery.task(name='main.unmatch_tinder_person', bind=True, max_retries=None)
+def unmatch_tinder_person(self, match_id, account_id=None):
+    try:
+        response = tinder_api(account_id).unmatch(match_id)
+    except RateLimited as e:
+        raise self.retry(countdown=e.wait)
+    if response.get("status") == 200:
+        get_matches_table(account_id).remove(match_id)
+        return "ok"
+    raise ValueError("Failed to unmatch")